@@ -0,0 +1,262 @@
+"""
+Benchmark the main processing functions at increasing scale.
+
+Written by Ed Oughton
+
+Each function is timed on synthetic inputs (see synthetic.py) at 1x, 10x
+and national scale. Timings are written as JSON lines, and a scaling
+exponent is fitted for each function, where an exponent of 1 means run
+time grows linearly with the number of input records and 2 means it
+grows with the square.
+
+Where the exponent fitted so far predicts a run would take longer than
+the time budget, that scale is skipped and recorded as such.
+
+Usage:
+
+    python -m scripts.benchmark
+    python -m scripts.benchmark --scales 1x 10x national --max-seconds 600
+
+"""
+import os
+import argparse
+import copy
+import json
+import math
+import tempfile
+import time
+
+import scripts.preprocess as preprocess
+
+from scripts import synthetic
+from scripts.capacity import lookup_capacity, lookup_capacity_array
+from scripts.core import connect, design_network, process_islands
+from scripts.traffic import SCENARIOS, edge_loads
+from scripts.config import BASE_PATH
+
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+
+
+#####################################
+# benchmark setup
+#####################################
+
+def setup_lad_assignment(scale, directory):
+    postcode_sectors = synthetic.generate_postcode_sectors(scale)
+    lads = synthetic.generate_lads(scale)
+    return len(postcode_sectors), lambda: preprocess.add_lad_to_postcode_sector(
+        postcode_sectors, lads)
+
+
+def setup_asset_processing(scale, directory):
+    sites = synthetic.generate_sitefinder(scale)
+    return len(sites), lambda: preprocess.process_asset_data(copy.deepcopy(sites))
+
+
+def setup_coverage_allocation(scale, directory):
+    lads = synthetic.generate_lads(scale)
+    synthetic.write_coverage_data(lads, directory)
+    columns, coverage = preprocess.load_coverage_table(os.path.join(
+        directory, 'ofcom_2018', '201809_mobile_laua_r02.csv'))
+    postcode_sectors = synthetic.generate_sectors_with_population(scale)
+    lad_ids = [lad['properties']['name'] for lad in lads]
+    return len(postcode_sectors), lambda: preprocess.allocate_4G_coverage(
+        copy.deepcopy(postcode_sectors), lad_ids, coverage)
+
+
+def setup_connect(scale, directory):
+    exchanges = synthetic.generate_core_nodes(scale)
+    return len(exchanges), lambda: connect(copy.deepcopy(exchanges), [], [])
+
+
+def setup_design_network(scale, directory):
+    nodes = synthetic.generate_island_nodes(scale)
+    return len(nodes), lambda: design_network(nodes)
+
+
+def setup_edge_loads(scale, directory):
+    exchanges = synthetic.generate_core_nodes(scale)
+    islands_lut = synthetic.generate_islands_lut(exchanges, scale)
+    node_populations = {
+        exchange['properties']['OLO']: exchange['properties']['population']
+        for exchange in exchanges
+    }
+    #the edges written by core.py, including the island spanning trees
+    exchanges, islands, island_edges = process_islands(exchanges, islands_lut)
+    edges = connect(exchanges, islands, islands_lut) + island_edges
+    return len(edges), lambda: edge_loads(edges, node_populations, SCENARIOS)
+
+
+def setup_lookup_capacity(scale, directory):
+    lookup_table = synthetic.generate_capacity_lookup_table()
+    densities = synthetic.generate_site_densities(scale)
+    return len(densities), lambda: [
+        lookup_capacity(lookup_table, 'urban', 'macro', '800', '10', '4G', d)
+        for d in densities
+    ]
+
+
+def setup_lookup_capacity_array(scale, directory):
+    lookup_table = synthetic.generate_capacity_lookup_table()
+    densities = synthetic.generate_site_densities(scale)
+    return len(densities), lambda: lookup_capacity_array(
+        lookup_table, 'urban', 'macro', '800', '10', '4G', densities)
+
+
+BENCHMARKS = [
+    ('add_lad_to_postcode_sector', setup_lad_assignment),
+    ('process_asset_data', setup_asset_processing),
+    ('allocate_4G_coverage', setup_coverage_allocation),
+    ('connect', setup_connect),
+    ('design_network', setup_design_network),
+    ('edge_loads', setup_edge_loads),
+    ('lookup_capacity', setup_lookup_capacity),
+    ('lookup_capacity_array', setup_lookup_capacity_array),
+]
+
+
+#####################################
+# timing and scaling
+#####################################
+
+def time_function(function, repeats):
+    """
+    Time a function, returning the fastest of a number of repeats.
+
+    """
+    timings = []
+
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def scaling_exponent(results):
+    """
+    Fit the exponent b in t = a * n^b by least squares on log-log scale.
+
+    """
+    points = [
+        (math.log(r['records']), math.log(r['seconds']))
+        for r in results if r['seconds'] is not None and r['seconds'] > 0
+    ]
+
+    if len(points) < 2:
+        return None
+
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+
+    numerator = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    denominator = sum((x - mean_x) ** 2 for x, y in points)
+
+    if denominator == 0:
+        return None
+
+    return numerator / denominator
+
+
+def predict_seconds(results, records):
+    """
+    Predict the run time for a number of records from earlier timings,
+    assuming quadratic growth until an exponent can be fitted.
+
+    """
+    timed = [r for r in results if r['seconds'] is not None]
+
+    if len(timed) == 0:
+        return 0
+
+    exponent = scaling_exponent(timed)
+    if exponent is None:
+        exponent = 2
+
+    largest = timed[-1]
+
+    return largest['seconds'] * (records / largest['records']) ** exponent
+
+
+def run_benchmarks(benchmarks, scales, repeats, max_seconds, path):
+    """
+    Run each benchmark at each scale, writing results as JSON lines.
+
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    summary = []
+
+    with open(path, 'a') as sink, tempfile.TemporaryDirectory() as scratch:
+
+        for name, setup in benchmarks:
+
+            results = []
+
+            for scale in scales:
+
+                records, function = setup(scale, scratch)
+
+                if predict_seconds(results, records) > max_seconds:
+                    seconds = None
+                    print('{:<28} {:>9} {:>9} records  skipped (over budget)'.format(
+                        name, scale, records))
+                else:
+                    seconds = time_function(function, repeats)
+                    print('{:<28} {:>9} {:>9} records  {:>10.4f}s'.format(
+                        name, scale, records, seconds))
+
+                result = {
+                    'function': name,
+                    'scale': scale,
+                    'records': records,
+                    'seconds': seconds,
+                    'repeats': repeats,
+                    'timestamp': time.time(),
+                }
+                results.append(result)
+                sink.write(json.dumps(result) + '\n')
+
+            exponent = scaling_exponent(results)
+            summary.append({
+                'function': name,
+                'scaling_exponent': exponent,
+                'timestamp': time.time(),
+            })
+            sink.write(json.dumps(summary[-1]) + '\n')
+
+    return summary
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the main functions on synthetic data.')
+    parser.add_argument('--scales', nargs='+', default=['1x', '10x'],
+        choices=list(synthetic.SCALES.keys()))
+    parser.add_argument('--functions', nargs='+',
+        choices=[name for name, setup in BENCHMARKS],
+        help='only run these benchmarks')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-seconds', type=float, default=300,
+        help='skip runs predicted to take longer than this')
+    parser.add_argument('--output', default=os.path.join(
+        DATA_INTERMEDIATE, 'benchmarks', 'benchmark_results.jsonl'))
+    args = parser.parse_args()
+
+    benchmarks = [
+        (name, setup) for name, setup in BENCHMARKS
+        if args.functions is None or name in args.functions
+    ]
+
+    summary = run_benchmarks(benchmarks, args.scales, args.repeats,
+        args.max_seconds, args.output)
+
+    print('Scaling exponents:')
+    for item in summary:
+        exponent = item['scaling_exponent']
+        print('{:<28} {}'.format(item['function'],
+            'n/a' if exponent is None else round(exponent, 2)))
@@ -0,0 +1,120 @@
+"""
+Content hashing and small json caches.
+
+Written by Ed Oughton
+
+Helpers shared by the pipeline runner and the on-disk caches (spatial
+indexes, simplified geometries, joins), which are keyed on the content
+of the raw files they were built from.
+
+"""
+import os
+import hashlib
+import json
+
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+def read_json(path):
+    """
+    Read a json file, returning an empty dict if it does not exist.
+
+    """
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r') as source:
+        return json.load(source)
+
+
+def write_json(data, path):
+    """
+    Write a json file, replacing any existing file in a single step.
+
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as sink:
+        json.dump(data, sink, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def related_files(path):
+    """
+    Return a file path, along with any shapefile sidecar files.
+
+    """
+    stem, extension = os.path.splitext(path)
+
+    if extension.lower() != '.shp':
+        return [path]
+
+    return [stem + ext for ext in SHAPEFILE_EXTENSIONS
+        if os.path.exists(stem + ext)]
+
+
+def file_hash(path, cache=None):
+    """
+    Hash the contents of a file (and any shapefile sidecars).
+
+    Hashes are cached by path, size and modification time, so unchanged
+    national datasets are only read once.
+
+    """
+    hasher = hashlib.sha256()
+
+    for filename in related_files(path):
+
+        if not os.path.exists(filename):
+            raise FileNotFoundError('Input file not found: {}'.format(filename))
+
+        stat = os.stat(filename)
+        signature = [stat.st_size, stat.st_mtime_ns]
+
+        if cache is not None and filename in cache and \
+            cache[filename]['signature'] == signature:
+            digest = cache[filename]['sha256']
+        else:
+            file_hasher = hashlib.sha256()
+            with open(filename, 'rb') as source:
+                for chunk in iter(lambda: source.read(1 << 20), b''):
+                    file_hasher.update(chunk)
+            digest = file_hasher.hexdigest()
+            if cache is not None:
+                cache[filename] = {'signature': signature, 'sha256': digest}
+
+        hasher.update(os.path.basename(filename).encode('utf-8'))
+        hasher.update(digest.encode('utf-8'))
+
+    return hasher.hexdigest()
+
+
+def combine_hashes(*hashes):
+    """
+    Combine several hashes (or other strings) into a single hash.
+
+    """
+    hasher = hashlib.sha256()
+
+    for item in hashes:
+        hasher.update(str(item).encode('utf-8'))
+        hasher.update(b'|')
+
+    return hasher.hexdigest()
+
+
+def cached_file_hash(path, directory):
+    """
+    Hash a file, keeping the hash cache in a json file in directory.
+
+    """
+    cache_path = os.path.join(directory, 'file_hashes.json')
+
+    cache = read_json(cache_path)
+    digest = file_hash(path, cache)
+    write_json(cache, cache_path)
+
+    return digest
@@ -14,15 +14,13 @@ then allocates the estimated capacity to the area.
 """
 import os
 import sys
-import configparser
+import argparse
 import csv
 from itertools import tee
 
 from collections import OrderedDict
 
-CONFIG = configparser.ConfigParser()
-CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
-BASE_PATH = CONFIG['file_locations']['base_path']
+from scripts.config import BASE_PATH
 
 DATA_RAW = os.path.join(BASE_PATH, 'raw')
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
@@ -89,10 +87,7 @@ def estimate_area_capacity(assets, area, clutter_environment,
 
         bandwidth = find_frequency_bandwidth(frequency,
             simulation_parameters)
-        if frequency == '700' or frequency == '3500' or frequency == '26000':
-            generation = '5G'
-        else:
-            generation = '4G'
+        generation = find_generation(frequency)
 
         if site_density > 0:
             tech_capacity = lookup_capacity(
@@ -127,6 +122,17 @@ def find_frequency_bandwidth(frequency, simulation_parameters):
     return bandwidth
 
 
+def find_generation(frequency):
+    """
+    Finds the technology generation deployed on a specific frequency.
+
+    """
+    if frequency == '700' or frequency == '3500' or frequency == '26000':
+        return '5G'
+
+    return '4G'
+
+
 def pairwise(iterable):
     """
     Return iterable of 2-tuples in a sliding window.
@@ -178,6 +184,40 @@ def lookup_capacity(lookup_table, environment, cell_type, frequency, bandwidth,
     return highest_capacity
 
 
+def lookup_capacity_array(lookup_table, environment, cell_type, frequency,
+    bandwidth, generation, site_densities):
+    """
+    Vectorised version of lookup_capacity, returning the capacity for
+    an array of site densities in a single pass.
+
+    As with lookup_capacity, densities below the lowest entry in the
+    lookup table have zero capacity and densities above the highest
+    entry receive the highest capacity.
+
+    """
+    #numpy is only imported when needed, so the rest of the module loads
+    #quickly for the command line
+    import numpy as np
+
+    if (environment, cell_type, frequency, bandwidth, generation) not in lookup_table:
+        raise KeyError("Combination %s not found in lookup table",
+                       (environment, cell_type, frequency, bandwidth, generation))
+
+    density_capacities = lookup_table[
+        (environment, cell_type, frequency, bandwidth, generation)
+    ]
+
+    densities = np.array([d for d, c in density_capacities], dtype=float)
+    capacities = np.array([c for d, c in density_capacities], dtype=float)
+
+    site_densities = np.asarray(site_densities, dtype=float)
+
+    result = np.interp(site_densities, densities, capacities)
+    result[site_densities < densities[0]] = 0
+
+    return result
+
+
 def interpolate(x0, y0, x1, y1, x):
     """
     Linear interpolation between two values.
@@ -189,6 +229,22 @@ def interpolate(x0, y0, x1, y1, x):
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(
+        description='Estimate the capacity of an area from its sites.')
+    parser.add_argument('--sites', type=int, default=2,
+        help='number of macrocell sites in the area')
+    parser.add_argument('--frequencies', nargs='+', default=['800', '2600'],
+        help='frequencies (MHz) deployed on each site')
+    parser.add_argument('--area', type=float, default=10,
+        help='area (km^2)')
+    parser.add_argument('--environment', default='urban')
+    parser.add_argument('--channel-bandwidth', nargs=2, action='append',
+        default=[], metavar=('FREQUENCY', 'BANDWIDTH'),
+        help='channel bandwidth (MHz) of a frequency, may be repeated')
+    parser.add_argument('--capacity-lookup-table', default=os.path.join(
+        DATA_RAW, 'capacity_lut_by_frequency_10.csv'))
+    args = parser.parse_args()
+
     #define parameters
     PARAMETERS = {
         'channel_bandwidth_700': '10',
@@ -202,31 +258,26 @@ if __name__ == '__main__':
         'small-cell_sectors': 1,
         'mast_height': 30,
     }
+    for frequency, bandwidth in args.channel_bandwidth:
+        PARAMETERS['channel_bandwidth_{}'.format(frequency)] = bandwidth
 
     #define assets
     ASSETS = [
         {
-            'site_ngr': 'A',
-            'frequency': ['800', '2600'],
-            'technology': '4G',
-            'type': 'macrocell_site',
-            'bandwidth': '2x10MHz',
-            'build_date': 2018,
-        },
-        {
-            'site_ngr': 'B',
-            'frequency': ['800', '2600'],
+            'site_ngr': 'site_{}'.format(site),
+            'frequency': args.frequencies,
             'technology': '4G',
             'type': 'macrocell_site',
             'bandwidth': '2x10MHz',
             'build_date': 2018,
-        },
+        }
+        for site in range(args.sites)
     ]
 
-    path = os.path.join(DATA_RAW, 'capacity_lut_by_frequency_10.csv')
-    capacity_lookup_table = load_capacity_lookup_table(path)
+    capacity_lookup_table = load_capacity_lookup_table(
+        args.capacity_lookup_table)
 
-    area_capacity = estimate_area_capacity(ASSETS, 10, 'urban',
-        capacity_lookup_table, PARAMETERS)
+    area_capacity = estimate_area_capacity(ASSETS, args.area,
+        args.environment, capacity_lookup_table, PARAMETERS)
 
     print(area_capacity)
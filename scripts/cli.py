@@ -0,0 +1,83 @@
+"""
+Command line entry point for the scripts.
+
+Written by Ed Oughton
+
+Runs any of the scripts as a subcommand, e.g.
+
+    uk-digital-networks preprocess
+    uk-digital-networks pipeline --workers 4
+    uk-digital-networks --base-path /data/ukdn capacity
+
+Arguments after the command are passed on to the script. The script
+module is only imported once its command is chosen, so commands which
+need no GIS libraries (such as capacity and demand) start without
+loading fiona, shapely, rtree or networkx.
+
+The data directory and config file can be given with --base-path and
+--config, or the UKDN_BASE_PATH and UKDN_CONFIG environment variables,
+in place of the base_path in script_config.ini.
+
+"""
+import os
+import sys
+import argparse
+import runpy
+
+#The script module and description of each command
+COMMANDS = {
+    'preprocess': ('preprocess', 'preprocess the cellular network inputs'),
+    'core': ('core', 'define the fixed core network'),
+    'capacity': ('capacity', 'estimate the capacity of an area'),
+    'demand': ('demand', 'estimate the data demand of an area'),
+    'pipeline': ('pipeline', 'run the checkpointed preprocessing pipeline'),
+    'incremental': ('incremental', 'patch the pipeline for new releases'),
+    'query': ('query', 'serve point lookups over HTTP'),
+    'sweep': ('sweep', 'sweep the fixed network parameters'),
+    'traffic': ('traffic', 'load the fixed network with busy hour traffic'),
+    'evaluate': ('evaluate', 'evaluate the capacity margin of each area'),
+    'shard': ('shard', 'plan, work and merge sharded evaluation jobs'),
+    'montecarlo': ('montecarlo', 'run Monte Carlo capacity scenarios'),
+    'upgrade': ('upgrade', 'plan capacity upgrades'),
+    'benchmark': ('benchmark', 'benchmark the preprocessing functions'),
+    'equivalence': ('equivalence', 'check optimised functions against their references'),
+}
+
+
+def main(argv=None):
+    """
+    Run the script chosen on the command line.
+
+    """
+    parser = argparse.ArgumentParser(prog='uk-digital-networks',
+        description='Model UK digital networks.')
+    parser.add_argument('--base-path',
+        help='data directory (or set UKDN_BASE_PATH)')
+    parser.add_argument('--config',
+        help='config file (or set UKDN_CONFIG)')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    #every script parses its own arguments, so --help after a command
+    #reaches the script's parser
+    for command, (module, description) in COMMANDS.items():
+        subparsers.add_parser(command, help=description, add_help=False)
+
+    args, arguments = parser.parse_known_args(argv)
+
+    #set before the script is imported, as paths are read at import time
+    if args.base_path is not None:
+        os.environ['UKDN_BASE_PATH'] = args.base_path
+    if args.config is not None:
+        os.environ['UKDN_CONFIG'] = os.path.abspath(args.config)
+
+    module = COMMANDS[args.command][0]
+
+    sys.argv = ['uk-digital-networks {}'.format(args.command)] + arguments
+
+    runpy.run_module('scripts.{}'.format(module), run_name='__main__',
+        alter_sys=True)
+
+
+if __name__ == '__main__':
+    main()
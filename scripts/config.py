@@ -0,0 +1,37 @@
+"""
+Locate the data directory.
+
+Written by Ed Oughton
+
+The data directory is taken from the UKDN_BASE_PATH environment
+variable if set, and otherwise from the base_path in the config file,
+which is script_config.ini unless UKDN_CONFIG names another. The config
+file is only read when UKDN_BASE_PATH is unset, so a config without a
+[file_locations] section is fine alongside an explicit data directory.
+
+Usage:
+
+    from scripts.config import BASE_PATH
+
+"""
+import os
+import configparser
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'script_config.ini')
+
+
+def read_base_path():
+    """
+    Return the data directory, from UKDN_BASE_PATH or the config file.
+
+    """
+    if 'UKDN_BASE_PATH' in os.environ:
+        return os.environ['UKDN_BASE_PATH']
+
+    config = configparser.ConfigParser()
+    config.read(os.environ.get('UKDN_CONFIG', CONFIG_PATH))
+
+    return config['file_locations']['base_path']
+
+
+BASE_PATH = read_base_path()
@@ -5,50 +5,130 @@ Written by Ed Oughton
 
 """
 import os
-import sys
-import configparser
+import argparse
 import csv
 import fiona
-import time
 
 from shapely.geometry import shape, Point, LineString, mapping
-from shapely.ops import  cascaded_union
-import networkx as nx
-
-from rtree import index
 
 from collections import OrderedDict
 
-CONFIG = configparser.ConfigParser()
-CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
-BASE_PATH = CONFIG['file_locations']['base_path']
+from scripts.cache import cached_file_hash, combine_hashes
+from scripts.instrument import stage_timer
+from scripts.geoparquet import (read_features, write_features,
+    write_partitioned_features)
+from scripts.overlay import catchment_population as overlay_catchment_population
+from scripts.preprocess import read_shapefile, exchange_area_key
+from scripts.spatial_index import (INDEX_DIRECTORY, feature_bounds,
+    build_index, cached_feature_index)
+from scripts.config import BASE_PATH
 
 DATA_RAW = os.path.join(BASE_PATH, 'raw')
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 
+CATCHMENTS = os.path.join(DATA_INTERMEDIATE, 'catchments')
+
+#The inputs of catchment_population, with --catchment-population
+POSTCODE_SECTOR_PATH = os.path.join(BASE_PATH, 'processed', 'postcode_sectors.shp')
+EXCHANGE_AREA_PATH = os.path.join(DATA_RAW, 'exchanges', '_exchange_areas_fixed.shp')
+
+#The properties nodes and edges are partitioned by in GeoParquet outputs
+NODE_PARTITIONS = ['inner', 'outer', 'metro', 'lower']
+EDGE_PARTITIONS = ['level']
+
+#The number of tier_1 nodes, and the number of nearest nodes each outer
+#core, metro, tier_1 and MSAN node is connected to
+TIER_1_COUNT = 1000
+CORE_LINKS = 4
+METRO_LINKS = 3
+TIER_1_LINKS = 3
+MSAN_LINKS = 3
 
-def read_existing_nodes(path):
+
+def read_existing_nodes(path, bbox=None, population=None):
     """
-    Load in the existing node data.
+    Load in the existing node data, optionally only the nodes within a
+    bbox (minx, miny, maxx, maxy).
+
+    Only the OLO and population attributes are decoded. A population
+    lookup by exchange_id (such as from catchment_population) can be
+    given to replace the population attribute. Exchanges missing from
+    the lookup (e.g. outside the postcode sectors it was derived from)
+    keep their population attribute, with a warning, and a lookup
+    covering none of the exchanges is refused.
 
     """
     output = []
+    missing = 0
+
+    for item in read_shapefile(path, bbox, properties=['OLO', 'population']):
+        if not item['properties']['OLO'] is None:
+            node_population = item['properties']['population']
+            if population is not None:
+                key = exchange_area_key(item['properties']['OLO'])
+                if key in population:
+                    node_population = population[key]
+                else:
+                    missing += 1
+            output.append({
+                'type': item['type'],
+                'geometry': item['geometry'],
+                'properties': {
+                    'OLO': item['properties']['OLO'],
+                    'population': node_population,
+                }
+            })
 
-    with fiona.open(path, 'r') as source:
-        for item in source:
-            if not item['properties']['OLO'] is None:
-                output.append({
-                    'type': item['type'],
-                    'geometry': item['geometry'],
-                    'properties': {
-                        'OLO': item['properties']['OLO'],
-                        'population': item['properties']['population'],
-                    }
-                })
+    if population is not None and missing > 0:
+        if missing == len(output):
+            raise ValueError('The catchment population covers none of the '
+                '{} exchanges'.format(len(output)))
+        print('Warning: {} of {} exchanges have no catchment population, '
+            'using their population attribute'.format(missing, len(output)))
 
     return output
 
 
+def catchment_population(postcode_sector_path, exchange_area_path,
+    field='id', directory=CATCHMENTS):
+    """
+    Derive the population of each exchange's catchment from the processed
+    postcode sector populations and the exchange area polygons.
+
+    The area-weighted join (see overlay.py) is cached, keyed on the hashes
+    of both files, so it only reruns when the boundaries or populations
+    change. Returns a dict of population by exchange_id.
+
+    """
+    source_hash = combine_hashes(
+        cached_file_hash(postcode_sector_path, directory),
+        cached_file_hash(exchange_area_path, directory),
+        field)
+
+    path = os.path.join(directory, 'catchment_population_{}.parquet'.format(
+        source_hash[:16]))
+
+    if os.path.exists(path):
+        return {
+            record['exchange_id']: record['population']
+            for record in read_features(path)
+        }
+
+    postcode_sectors = read_shapefile(postcode_sector_path,
+        properties=['population'])
+    exchange_areas = read_shapefile(exchange_area_path, properties=[field])
+
+    population = overlay_catchment_population(postcode_sectors, exchange_areas,
+        lambda area: exchange_area_key(area['properties'][field]))
+
+    write_features([
+        {'exchange_id': exchange_id, 'population': value}
+        for exchange_id, value in sorted(population.items())
+    ], path)
+
+    return population
+
+
 def read_lookup(path):
     """
     Import lookup of BT 21CN core node locations.
@@ -209,12 +289,12 @@ def process_islands(exchanges, islands_lut):
                     'source': link['properties']['from'],
                     'sink': link['properties']['to'],
                     'population': 0,
-                    'level': 'unknown',
-                    'inner': 'unknown',
-                    'outer': 'unknown',
-                    'metro': 'unknown',
-                    'tier_1': 'unknown',
-                    'msan': 'unknown',
+                    'level': 'island_tree',
+                    'inner': 0,
+                    'outer': 0,
+                    'metro': 0,
+                    'tier_1': 0,
+                    'msan': 0,
                 }
             })
 
@@ -253,6 +333,9 @@ def design_network(nodes):
                     }
                 })
 
+    #networkx is only needed here, so is not imported with the module
+    import networkx as nx
+
     G = nx.Graph()
 
     for node in nodes:
@@ -272,23 +355,20 @@ def design_network(nodes):
     return links
 
 
-def connect(exchanges, islands, islands_lut):
+def rank_exchanges(exchanges):
     """
+    Split exchanges into the inner core, outer core (including the inner
+    core), metro and lower layers, with the lower exchanges ranked by
+    population (largest first).
 
     """
-    output = []
-
     inner = []
     outer = []
     metro = []
-    tier_1 = []
-    msan = []
     lower = []
 
     for exchange in exchanges:
 
-        coords = shape(exchange['geometry'])
-
         if int(exchange['properties']['inner']) > 0:
             inner.append(exchange)
 
@@ -301,9 +381,21 @@ def connect(exchanges, islands, islands_lut):
         if int(exchange['properties']['lower']) > 0:
             lower.append(exchange)
 
-    ranked = sorted(lower, reverse = True, key=lambda x: x['properties']['population'])[:1000]
+    ranked = sorted(lower, reverse = True, key=lambda x: x['properties']['population'])
+
+    return inner, outer, metro, lower, ranked
+
+
+def split_lower_exchanges(lower, ranked, tier_1_count=TIER_1_COUNT):
+    """
+    Split the lower exchanges into tier_1 nodes (the tier_1_count most
+    populous, from the ranking) and MSANs.
 
-    tier_1_ids = [e['properties']['OLO'] for e in ranked]
+    """
+    tier_1 = []
+    msan = []
+
+    tier_1_ids = set([e['properties']['OLO'] for e in ranked[:tier_1_count]])
 
     for exchange in lower:
         if exchange['properties']['OLO'] in tier_1_ids:
@@ -337,210 +429,136 @@ def connect(exchanges, islands, islands_lut):
                 }
             })
 
-    print(len(msan), len(tier_1), len(metro), len(outer), len(inner))
+    return tier_1, msan
 
-    idx_inner_core = index.Index()
-    for exchange in inner:
-        coords = shape(exchange['geometry'])
-        idx_inner_core.insert(0, coords.bounds, exchange)
 
-    idx_all_core = index.Index()
-    for exchange in outer:
-        coords = shape(exchange['geometry'])
-        idx_all_core.insert(0, coords.bounds, exchange)
+def classify_exchanges(exchanges, tier_1_count=TIER_1_COUNT):
+    """
+    Split exchanges into the inner core, outer core (including the inner
+    core), metro, tier_1 and MSAN layers.
 
-    idx_metro = index.Index()
-    for exchange in metro:
-        coords = shape(exchange['geometry'])
-        idx_metro.insert(0, coords.bounds, exchange)
+    The tier_1_count (by default 1,000) most populous lower exchanges
+    become tier_1 nodes, with all other lower exchanges becoming MSANs.
 
-    idx_tier_1 = index.Index()
-    for exchange in tier_1:
-        coords = shape(exchange['geometry'])
-        idx_tier_1.insert(0, coords.bounds, exchange)
+    """
+    inner, outer, metro, lower, ranked = rank_exchanges(exchanges)
 
-    idx_all = index.Index()
-    for exchange in exchanges:
-        coords = shape(exchange['geometry'])
-        idx_all.insert(0, coords.bounds, exchange)
+    tier_1, msan = split_lower_exchanges(lower, ranked, tier_1_count)
 
-    exchanges = metro + msan + tier_1
+    return inner, outer, metro, tier_1, msan
 
-    for exchange in exchanges:
 
-        geom = shape(exchange['geometry'])
+def connect_indexes(inner, outer, metro, tier_1, source_hash=None,
+    directory=None):
+    """
+    Build the rtree indexes of each network layer used by connect, with
+    each exchange's position in its layer as its id.
 
-        if int(exchange['properties']['inner']) > 0:
+    If a source hash (e.g. of the node and lookup files) is given, the
+    indexes are saved to disk and reopened on later runs. Each index is
+    also keyed on the exchanges in its layer, in order, as the layers
+    depend on more than the files (e.g. tier_1 on the population used).
 
-            closest_nodes =  list(
-                idx_inner_core.nearest(
-                    coords.bounds,
-                    len(inner)+1,
-                    objects='raw')
-                    )
-
-            for node_1 in closest_nodes:
-
-                coords_node_1 = shape(node_1['geometry'])
-
-                for node_2 in closest_nodes:
-
-                    coords_node_2 = shape(node_2['geometry'])
-
-                    output.append({
-                        'type': exchange['type'],
-                        'geometry': {
-                            'type': 'LineString',
-                            'coordinates': [
-                                list(coords_node_1.coords)[0],
-                                list(coords_node_2.coords)[0]]
-                        },
-                        'properties': {
-                            'source': node_1['properties']['OLO'],
-                            'sink': node_2['properties']['OLO'],
-                            'population': exchange['properties']['population'],
-                            'level': 'core',
-                            'inner': exchange['properties']['inner'],
-                            'outer': exchange['properties']['outer'],
-                            'metro': exchange['properties']['metro'],
-                            'tier_1': exchange['properties']['tier_1'],
-                            'msan': exchange['properties']['msan'],
-                        }
-                    })
+    """
+    layers = [
+        ('inner', inner),
+        ('outer', outer),
+        ('metro', metro),
+        ('tier_1', tier_1),
+    ]
+
+    indexes = {}
+
+    for name, layer in layers:
+        if source_hash is None:
+            indexes[name] = build_index(feature_bounds(layer), stream=False)
+        else:
+            layer_hash = combine_hashes(source_hash,
+                *[exchange['properties']['OLO'] for exchange in layer])
+            indexes[name] = cached_feature_index('connect_{}'.format(name),
+                layer, layer_hash, directory or INDEX_DIRECTORY, stream=False)
 
-        if int(exchange['properties']['outer']) > 0:
+    return indexes
 
-            closest_nodes =  list(
-                idx_all_core.nearest(
-                    coords.bounds,
-                    4, objects='raw')
-                    )
 
-            for node_1 in closest_nodes:
+def first_coordinate(feature):
+    """
+    Return the first coordinate of a feature's geometry.
 
-                coords_node_1 = shape(node_1['geometry'])
+    """
+    return list(shape(feature['geometry']).coords)[0]
 
-                output.append({
-                    'type': exchange['type'],
-                    'geometry': {
-                        'type': 'LineString',
-                        'coordinates': [
-                            list(geom.coords)[0],
-                            list(coords_node_1.coords)[0],
-                        ]
-                    },
-                    'properties': {
-                        'source': exchange['properties']['OLO'],
-                        'sink': node_1['properties']['OLO'],
-                        'population': exchange['properties']['population'],
-                        'level': 'core',
-                        'inner': exchange['properties']['inner'],
-                        'outer': exchange['properties']['outer'],
-                        'metro': exchange['properties']['metro'],
-                        'tier_1': exchange['properties']['tier_1'],
-                        'msan': exchange['properties']['msan'],
-                    }
-                })
 
-        if int(exchange['properties']['metro']) > 0:
+def link(exchange, source, sink, level, coordinates):
+    """
+    Create a link between two nodes, found for an exchange.
 
-            closest_nodes =  list(
-                idx_all_core.nearest(
-                    geom.bounds,
-                    3, objects='raw')
-                    )
+    """
+    return {
+        'type': exchange['type'],
+        'geometry': {
+            'type': 'LineString',
+            'coordinates': coordinates,
+        },
+        'properties': {
+            'source': source['properties']['OLO'],
+            'sink': sink['properties']['OLO'],
+            'population': exchange['properties']['population'],
+            'level': level,
+            'inner': exchange['properties']['inner'],
+            'outer': exchange['properties']['outer'],
+            'metro': exchange['properties']['metro'],
+            'tier_1': exchange['properties']['tier_1'],
+            'msan': exchange['properties']['msan'],
+        }
+    }
 
-            for node_1 in closest_nodes:
 
-                coords_node_1 = shape(node_1['geometry'])
+def inner_core_links(exchange, inner, idx_inner_core, coords):
+    """
+    Fully connect the inner core nodes.
 
-                output.append({
-                    'type': exchange['type'],
-                    'geometry': {
-                        'type': 'LineString',
-                        'coordinates': [
-                            list(geom.coords)[0],
-                            list(coords_node_1.coords)[0]]
-                    },
-                    'properties': {
-                        'source': exchange['properties']['OLO'],
-                        'sink': node_1['properties']['OLO'],
-                        'population': exchange['properties']['population'],
-                        'level': 'metro',
-                        'inner': exchange['properties']['inner'],
-                        'outer': exchange['properties']['outer'],
-                        'metro': exchange['properties']['metro'],
-                        'tier_1': exchange['properties']['tier_1'],
-                        'msan': exchange['properties']['msan'],
-                    }
-                })
+    """
+    closest_nodes = [inner[i] for i in
+        idx_inner_core.nearest(coords.bounds, len(inner)+1)]
 
-        if int(exchange['properties']['tier_1']) > 0:
+    return [
+        link(exchange, node_1, node_2, 'core',
+            [first_coordinate(node_1), first_coordinate(node_2)])
+        for node_1 in closest_nodes
+        for node_2 in closest_nodes
+    ]
 
-            closest_nodes =  list(
-                idx_metro.nearest(
-                    geom.bounds,
-                    3, objects='raw')
-                    )
 
-            for node_1 in closest_nodes:
+def nearest_links(exchange, layer, idx, count, level, origin=None,
+    reverse=False):
+    """
+    Connect an exchange to the count nearest nodes of a layer, nearest to
+    origin if given, or else the exchange itself.
 
-                coords_node_1 = shape(node_1['geometry'])
+    """
+    if origin is None:
+        origin = shape(exchange['geometry'])
 
-                output.append({
-                    'type': exchange['type'],
-                    'geometry': {
-                        'type': 'LineString',
-                        'coordinates': [
-                            list(geom.coords)[0],
-                            list(coords_node_1.coords)[0]]
-                    },
-                    'properties': {
-                        'source': exchange['properties']['OLO'],
-                        'sink': node_1['properties']['OLO'],
-                        'population': exchange['properties']['population'],
-                        'level': 'tier_1',
-                        'inner': exchange['properties']['inner'],
-                        'outer': exchange['properties']['outer'],
-                        'metro': exchange['properties']['metro'],
-                        'tier_1': exchange['properties']['tier_1'],
-                        'msan': exchange['properties']['msan'],
-                    }
-                })
+    closest_nodes = [layer[i] for i in idx.nearest(origin.bounds, count)]
 
-        if int(exchange['properties']['msan']) > 0:
+    output = []
 
-            closest_nodes =  list(
-                idx_tier_1.nearest(
-                    geom.bounds,
-                    3, objects='raw')
-                    )
+    for node in closest_nodes:
+        coordinates = [first_coordinate(exchange), first_coordinate(node)]
+        if reverse:
+            coordinates.reverse()
+        output.append(link(exchange, exchange, node, level, coordinates))
 
-            for node in closest_nodes:
+    return output
 
-                coords_nearest = shape(node['geometry'])
 
-                output.append({
-                    'type': exchange['type'],
-                    'geometry': {
-                        'type': 'LineString',
-                        'coordinates': [
-                            list(coords_nearest.coords)[0],
-                            list(geom.coords)[0]]
-                    },
-                    'properties': {
-                        'source': exchange['properties']['OLO'],
-                        'sink': node['properties']['OLO'],
-                        'population': exchange['properties']['population'],
-                        'level': 'msan',
-                        'inner': exchange['properties']['inner'],
-                        'outer': exchange['properties']['outer'],
-                        'metro': exchange['properties']['metro'],
-                        'tier_1': exchange['properties']['tier_1'],
-                        'msan': exchange['properties']['msan'],
-                    }
-                })
+def island_links(islands, islands_lut, tier_1, idx_tier_1):
+    """
+    Connect each island to the mainland, by the shortest link from any of
+    its exchanges to the nearest tier_1 node.
 
+    """
     island_names = set()
     for exchange in islands_lut:
         island_names.add(exchange['island'])
@@ -553,11 +571,11 @@ def connect(exchanges, islands, islands_lut):
             if exchange['properties']['island'] == island_name:
                 geom1 = shape(exchange['geometry'])
 
-                closest_node =  list(
+                closest_node = tier_1[list(
                     idx_tier_1.nearest(
                         geom1.bounds,
-                        1, objects='raw')
-                        )[0]
+                        1)
+                        )[0]]
 
                 geom2 = shape(closest_node['geometry'])
 
@@ -570,7 +588,7 @@ def connect(exchanges, islands, islands_lut):
                     'OLO_mainland_geom': mapping(geom2),
                     'line': mapping(line),
                     'length': line.length,
-                    'population': exchange['properties']['OLO'],
+                    'population': exchange['properties']['population'],
                     'inner': exchange['properties']['inner'],
                     'outer': exchange['properties']['outer'],
                     'metro': exchange['properties']['metro'],
@@ -596,6 +614,60 @@ def connect(exchanges, islands, islands_lut):
             }
         })
 
+    return island_edges
+
+
+def connect(exchanges, islands, islands_lut, indexes=None,
+    tier_1_count=TIER_1_COUNT, core_links=CORE_LINKS, metro_links=METRO_LINKS,
+    tier_1_links=TIER_1_LINKS, msan_links=MSAN_LINKS):
+    """
+    Connect each exchange to the layer above it in the network hierarchy.
+
+    The indexes for each layer can be provided from connect_indexes. The
+    number of tier_1 nodes, and the number of nearest nodes each layer
+    connects to, can be changed from the defaults (see sweep.py).
+
+    """
+    output = []
+
+    inner, outer, metro, tier_1, msan = classify_exchanges(exchanges, tier_1_count)
+
+    if indexes is None:
+        indexes = connect_indexes(inner, outer, metro, tier_1)
+
+    idx_inner_core = indexes['inner']
+    idx_all_core = indexes['outer']
+    idx_metro = indexes['metro']
+    idx_tier_1 = indexes['tier_1']
+
+    #the inner and outer core links are found relative to the last exchange
+    coords = shape(exchanges[-1]['geometry'])
+
+    exchanges = metro + msan + tier_1
+
+    for exchange in exchanges:
+
+        if int(exchange['properties']['inner']) > 0:
+            output.extend(inner_core_links(exchange, inner, idx_inner_core, coords))
+
+        if int(exchange['properties']['outer']) > 0:
+            output.extend(nearest_links(exchange, outer, idx_all_core,
+                core_links, 'core', origin=coords))
+
+        if int(exchange['properties']['metro']) > 0:
+            output.extend(nearest_links(exchange, outer, idx_all_core,
+                metro_links, 'metro'))
+
+        if int(exchange['properties']['tier_1']) > 0:
+            output.extend(nearest_links(exchange, metro, idx_metro,
+                tier_1_links, 'tier_1'))
+
+        if int(exchange['properties']['msan']) > 0:
+            output.extend(nearest_links(exchange, tier_1, idx_tier_1,
+                msan_links, 'msan', reverse=True))
+
+    island_edges = island_links(islands, islands_lut, tier_1, idx_tier_1)
+
     return output + island_edges
 
 
@@ -631,25 +703,93 @@ def write_shapefile(data, directory, filename, crs):
             sink.write(datum)
 
 
+def write_network(data, directory, name, crs, partition_by, output_format):
+    """
+    Write nodes or edges to shapefile, or to GeoParquet with row groups
+    for each tier (the values of the partition_by properties).
+
+    """
+    if output_format == 'geoparquet':
+        write_partitioned_features(data,
+            os.path.join(directory, '{}.parquet'.format(name)), partition_by, crs)
+    else:
+        write_shapefile(data, directory, '{}.shp'.format(name), crs)
+
+
 if __name__ == '__main__':
 
-    path = os.path.join(BASE_PATH, 'telecoms_nodes.shp')
-    exchanges = read_existing_nodes(path)#[:10]
+    parser = argparse.ArgumentParser(description='Define the core network.')
+    parser.add_argument('--output-format', choices=['shapefile', 'geoparquet'],
+        default='shapefile',
+        help='write nodes and edges to shapefile, or GeoParquet with row '
+        'groups for each tier')
+    parser.add_argument('--catchment-population', action='store_true',
+        help='replace the population attribute of each exchange with the '
+        'population of its catchment, from the processed postcode sectors '
+        'and exchange areas')
+    args = parser.parse_args()
+
+    if args.catchment_population:
+        for path in [POSTCODE_SECTOR_PATH, EXCHANGE_AREA_PATH]:
+            if not os.path.exists(path):
+                parser.error('--catchment-population needs {}'.format(path))
+
+    log_path = os.path.join(DATA_INTERMEDIATE, 'logs', 'core_stages.jsonl')
+
+    population = None
+    if args.catchment_population:
+        with stage_timer('catchment_population', None, log_path) as record:
+            population = catchment_population(
+                POSTCODE_SECTOR_PATH, EXCHANGE_AREA_PATH)
+            record['records_out'] = len(population)
+
+    with stage_timer('read_existing_nodes', None, log_path) as record:
+        path = os.path.join(BASE_PATH, 'telecoms_nodes.shp')
+        exchanges = read_existing_nodes(path, population=population)#[:10]
+        record['records_out'] = len(exchanges)
     print('total number of exchanges: {}'.format(len(exchanges)))
 
     path = os.path.join(BASE_PATH, 'core_bt_21cn.csv')
     lookup = read_lookup(path)
 
-    exchanges = determine_nodes(exchanges, lookup)
+    with stage_timer('determine_nodes', len(exchanges), log_path) as record:
+        exchanges = determine_nodes(exchanges, lookup)
+        record['records_out'] = len(exchanges)
 
     crs = 'epsg:27700'
-    write_shapefile(exchanges, DATA_INTERMEDIATE, 'nodes.shp', crs)
+    with stage_timer('write_nodes', len(exchanges), log_path):
+        write_network(exchanges, DATA_INTERMEDIATE, 'nodes', crs,
+            NODE_PARTITIONS, args.output_format)
 
     path = os.path.join(DATA_INTERMEDIATE, 'islands', 'all_islands.csv')
     islands_lut = import_islands(path)
 
-    exchanges, islands, island_edges = process_islands(exchanges, islands_lut)
-
-    edges = connect(exchanges, islands, islands_lut)
-
-    write_shapefile(edges + island_edges, DATA_INTERMEDIATE, 'edges.shp', crs)
+    with stage_timer('process_islands', len(exchanges), log_path) as record:
+        exchanges, islands, island_edges = process_islands(exchanges, islands_lut)
+        record['records_out'] = [len(exchanges), len(islands), len(island_edges)]
+
+    with stage_timer('connect_indexes', len(exchanges), log_path):
+        source_hash = combine_hashes(*[
+            cached_file_hash(path, INDEX_DIRECTORY) for path in [
+                os.path.join(BASE_PATH, 'telecoms_nodes.shp'),
+                os.path.join(BASE_PATH, 'core_bt_21cn.csv'),
+                os.path.join(DATA_INTERMEDIATE, 'islands', 'all_islands.csv'),
+            ]
+        ])
+        inner, outer, metro, tier_1, msan = classify_exchanges(exchanges)
+        indexes = connect_indexes(inner, outer, metro, tier_1, source_hash)
+
+    with stage_timer('connect', len(exchanges), log_path) as record:
+        edges = connect(exchanges, islands, islands_lut, indexes)
+        record['records_out'] = len(edges)
+        record['layers'] = {
+            'msan': len(msan),
+            'tier_1': len(tier_1),
+            'metro': len(metro),
+            'outer': len(outer),
+            'inner': len(inner),
+        }
+
+    with stage_timer('write_edges', len(edges) + len(island_edges), log_path):
+        write_network(edges + island_edges, DATA_INTERMEDIATE, 'edges', crs,
+            EDGE_PARTITIONS, args.output_format)
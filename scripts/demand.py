@@ -9,6 +9,9 @@ using the gross population served by the
 asset.
 
 """
+import argparse
+
+
 def calculate_user_demand(parameters):
     """
     Calculate Mb/second from GB/month supplied by throughput scenario.
@@ -68,17 +71,33 @@ def total_demand(user_demand, population, area, parameters):
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(
+        description='Estimate the data demand of an area.')
+    parser.add_argument('--population', type=float, default=1000)
+    parser.add_argument('--area', type=float, default=10,
+        help='area (km^2)')
+    parser.add_argument('--monthly-data-consumption', type=float, default=3,
+        help='GB per user per month')
+    parser.add_argument('--busy-hour-traffic', type=float, default=20,
+        help='percentage of daily traffic in the busy hour')
+    parser.add_argument('--penetration', type=float, default=80,
+        help='smartphone penetration percentage')
+    parser.add_argument('--market-share', type=float, default=25,
+        help='market share percentage')
+    args = parser.parse_args()
+
     #define parameters
     PARAMETERS = {
-        'monthly_data_consumption_GB': 3,
-        'busy_hour_traffic_percentage': 20,
-        'penetration_percentage': 80,
-        'market_share_percentage': 25,
+        'monthly_data_consumption_GB': args.monthly_data_consumption,
+        'busy_hour_traffic_percentage': args.busy_hour_traffic,
+        'penetration_percentage': args.penetration,
+        'market_share_percentage': args.market_share,
 
     }
 
     user_demand = calculate_user_demand(PARAMETERS)
 
-    demand_km2 = total_demand(user_demand, 1000, 10, PARAMETERS)
+    demand_km2 = total_demand(user_demand, args.population, args.area,
+        PARAMETERS)
 
     print(demand_km2)
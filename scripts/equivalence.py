@@ -0,0 +1,699 @@
+"""
+Check the optimised functions reproduce the outputs of the reference
+implementations, and compare their speed.
+
+Written by Ed Oughton
+
+Each engine is run beside its reference implementation (see reference.py)
+on seeded synthetic fixtures (see synthetic.py) and, where the pipeline
+checkpoints and raw data exist, on fixtures sampled from the real data.
+
+Outputs are compared as sets of features, matched on the key properties
+of each engine. Geometries are compared within a distance tolerance (in
+metres) and numeric properties within a relative tolerance, so a change
+in feature order or float rounding is reported separately from a change
+in the results:
+
+    identical   same features, in the same order, with no tolerance used
+    equivalent  same features within the tolerances, or in another order
+    differs     features are missing, extra or outside the tolerances
+
+Differences an engine is known to have are listed in KNOWN_DIFFERENCES
+with the reason for them, and are reported but not counted as failures.
+The script exits with a non-zero status if any engine differs otherwise.
+
+Timings are the fastest of a number of repeats, each on a fresh copy of
+the inputs (the copy is not timed), and are written as JSON lines.
+
+Usage:
+
+    python -m scripts.equivalence
+    python -m scripts.equivalence --scales 1x 10x --samples 2000 --seed 7
+    python -m scripts.equivalence --engines connect --checkpoints path/to/checkpoints
+
+"""
+import os
+import sys
+import argparse
+import contextlib
+import copy
+import json
+import math
+import random
+import tempfile
+import time
+
+from collections import defaultdict
+
+from shapely.geometry import shape
+
+import scripts.preprocess as preprocess
+import scripts.reference as reference
+
+from scripts import synthetic
+from scripts.capacity import load_capacity_lookup_table, lookup_capacity_array
+from scripts.core import (connect, read_existing_nodes, read_lookup,
+    determine_nodes, import_islands, process_islands)
+from scripts.geoparquet import read_features
+from scripts.pipeline import CHECKPOINTS, checkpoint_path
+from scripts.simplify import simplify_boundaries
+from scripts.config import BASE_PATH
+
+DATA_RAW = os.path.join(BASE_PATH, 'raw')
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+
+#Largest distance (m) between matching geometries
+GEOMETRY_TOLERANCE = 1e-6
+
+#Largest relative difference between matching numeric properties
+RELATIVE_TOLERANCE = 1e-9
+
+#Tolerance (m) of the simplified LAD boundaries engine
+SIMPLIFY_TOLERANCE = 100
+
+#Differences which are expected, by engine and property, with the reason
+KNOWN_DIFFERENCES = {}
+
+
+#####################################
+# engines
+#####################################
+
+def simplified_lad_assignment(postcode_sectors, lads):
+    """
+    Assign LADs using simplified LAD boundaries, as the pipeline does with
+    --simplify.
+
+    """
+    simplified = simplify_boundaries(lads, SIMPLIFY_TOLERANCE)
+    return preprocess.add_lad_to_postcode_sector(postcode_sectors, lads,
+        simplified=simplified)
+
+
+def reference_capacities(lookup_table, densities):
+    """
+    Look up the capacity of every density for every lookup table curve,
+    one density at a time.
+
+    """
+    return [
+        reference.lookup_capacity(lookup_table, *key, density)
+        for key in sorted(lookup_table) for density in densities
+    ]
+
+
+def fast_capacities(lookup_table, densities):
+    """
+    Look up the capacity of every density for every lookup table curve,
+    one curve at a time.
+
+    """
+    output = []
+
+    for key in sorted(lookup_table):
+        output.extend(lookup_capacity_array(lookup_table, *key, densities).tolist())
+
+    return output
+
+
+#####################################
+# synthetic fixtures
+#####################################
+
+def synthetic_lad_assignment(scale, seed, directory):
+    postcode_sectors = synthetic.generate_postcode_sectors(scale, seed)
+    lads = synthetic.generate_lads(scale, seed)
+    return {'records': len(postcode_sectors), 'args': (postcode_sectors, lads)}
+
+
+def synthetic_asset_processing(scale, seed, directory):
+    sites = synthetic.generate_sitefinder(scale, seed)
+    return {'records': len(sites), 'args': (sites,)}
+
+
+def synthetic_coverage_allocation(scale, seed, directory):
+    lads = synthetic.generate_lads(scale, seed)
+    synthetic.write_coverage_data(lads, directory, seed)
+    postcode_sectors = synthetic.generate_sectors_with_population(scale, seed)
+    lad_ids = [lad['properties']['name'] for lad in lads]
+    return {
+        'records': len(postcode_sectors),
+        'args': (postcode_sectors, lad_ids),
+        'data_raw': directory,
+    }
+
+
+def synthetic_connect(scale, seed, directory):
+    exchanges = synthetic.generate_core_nodes(scale, seed)
+    return {'records': len(exchanges), 'args': (exchanges, [], [])}
+
+
+def synthetic_capacity(scale, seed, directory):
+    lookup_table = synthetic.generate_capacity_lookup_table(seed=seed)
+    densities = synthetic.generate_site_densities(scale, seed)
+    return {
+        'records': len(densities) * len(lookup_table),
+        'args': (lookup_table, densities),
+    }
+
+
+#####################################
+# sampled fixtures
+#####################################
+
+def read_checkpoint(checkpoints, dataset):
+    """
+    Read a pipeline checkpoint, or return None if it does not exist.
+
+    """
+    path = checkpoint_path(checkpoints, dataset)
+    if not os.path.exists(path):
+        return None
+    return read_features(path)
+
+
+def sample(features, samples, rng):
+    """
+    Return a random sample of features, in their original order.
+
+    """
+    if len(features) <= samples:
+        return features
+
+    positions = sorted(rng.sample(range(len(features)), samples))
+
+    return [features[i] for i in positions]
+
+
+def sample_nearest(features, samples, rng):
+    """
+    Return the features nearest a randomly chosen feature, in their
+    original order, so co-located features are sampled together.
+
+    """
+    if len(features) <= samples:
+        return features
+
+    x, y = features[rng.randrange(len(features))]['geometry']['coordinates'][:2]
+
+    distances = [
+        math.hypot(f['geometry']['coordinates'][0] - x,
+            f['geometry']['coordinates'][1] - y)
+        for f in features
+    ]
+    positions = sorted(sorted(range(len(features)),
+        key=lambda i: distances[i])[:samples])
+
+    return [features[i] for i in positions]
+
+
+def sampled_lad_assignment(checkpoints, samples, rng, directory):
+    postcode_sectors = read_checkpoint(checkpoints, 'postcode_sectors')
+    lads = read_checkpoint(checkpoints, 'lads')
+    if postcode_sectors is None or lads is None:
+        return None
+    postcode_sectors = sample(postcode_sectors, samples, rng)
+    return {'records': len(postcode_sectors), 'args': (postcode_sectors, lads)}
+
+
+def sampled_asset_processing(checkpoints, samples, rng, directory):
+    sites = read_checkpoint(checkpoints, 'sitefinder')
+    if sites is None:
+        return None
+    sites = sample_nearest(sites, samples, rng)
+    return {'records': len(sites), 'args': (sites,)}
+
+
+def sampled_coverage_allocation(checkpoints, samples, rng, directory):
+    """
+    Sample whole LADs, as coverage is allocated within each LAD.
+
+    """
+    postcode_sectors = read_checkpoint(checkpoints, 'sectors_population')
+    if postcode_sectors is None or not os.path.exists(os.path.join(
+        DATA_RAW, 'ofcom_2018', '201809_mobile_laua_r02.csv')):
+        return None
+
+    columns, coverage = preprocess.load_coverage_table()
+
+    by_lad = defaultdict(list)
+    for sector in postcode_sectors:
+        if sector['properties']['lad'] in coverage:
+            by_lad[sector['properties']['lad']].append(sector)
+
+    lad_ids = list(by_lad)
+    rng.shuffle(lad_ids)
+
+    selected = []
+    count = 0
+    for lad_id in lad_ids:
+        if count >= samples:
+            break
+        selected.append(lad_id)
+        count += len(by_lad[lad_id])
+
+    selected = set(selected)
+    postcode_sectors = [
+        s for s in postcode_sectors if s['properties']['lad'] in selected]
+    lad_ids = [lad_id for lad_id in by_lad if lad_id in selected]
+
+    return {
+        'records': len(postcode_sectors),
+        'args': (postcode_sectors, lad_ids),
+        'data_raw': DATA_RAW,
+    }
+
+
+def sampled_connect(checkpoints, samples, rng, directory):
+    """
+    Sample the exchanges read as in core.py, keeping every island node so
+    each island can still be connected.
+
+    """
+    paths = [
+        os.path.join(BASE_PATH, 'telecoms_nodes.shp'),
+        os.path.join(BASE_PATH, 'core_bt_21cn.csv'),
+        os.path.join(DATA_INTERMEDIATE, 'islands', 'all_islands.csv'),
+    ]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+
+    exchanges = determine_nodes(read_existing_nodes(paths[0]),
+        read_lookup(paths[1]))
+    islands_lut = import_islands(paths[2])
+    exchanges, islands, island_edges = process_islands(exchanges, islands_lut)
+
+    exchanges = sample(exchanges, samples, rng)
+
+    return {'records': len(exchanges), 'args': (exchanges, islands, islands_lut)}
+
+
+def sampled_capacity(checkpoints, samples, rng, directory):
+    path = os.path.join(DATA_RAW, 'capacity_lut_by_frequency_10.csv')
+    if not os.path.exists(path):
+        return None
+
+    lookup_table = load_capacity_lookup_table(path)
+    highest = max(curve[-1][0] for curve in lookup_table.values())
+    densities = [rng.uniform(0, highest * 1.2) for i in range(samples)]
+
+    return {
+        'records': len(densities) * len(lookup_table),
+        'args': (lookup_table, densities),
+    }
+
+
+ENGINES = [
+    {
+        'name': 'add_lad_to_postcode_sector',
+        'reference': reference.add_lad_to_postcode_sector,
+        'fast': preprocess.add_lad_to_postcode_sector,
+        'key': ['id'],
+        'synthetic': synthetic_lad_assignment,
+        'sampled': sampled_lad_assignment,
+    },
+    {
+        'name': 'add_lad_to_postcode_sector_simplified',
+        'reference': reference.add_lad_to_postcode_sector,
+        'fast': simplified_lad_assignment,
+        'key': ['id'],
+        'synthetic': synthetic_lad_assignment,
+        'sampled': sampled_lad_assignment,
+    },
+    {
+        'name': 'process_asset_data',
+        'reference': reference.process_asset_data,
+        'fast': preprocess.process_asset_data,
+        'key': ['name'],
+        'synthetic': synthetic_asset_processing,
+        'sampled': sampled_asset_processing,
+    },
+    {
+        'name': 'allocate_4G_coverage',
+        'reference': reference.allocate_4G_coverage,
+        'fast': preprocess.allocate_4G_coverage,
+        'key': ['id'],
+        'synthetic': synthetic_coverage_allocation,
+        'sampled': sampled_coverage_allocation,
+    },
+    {
+        'name': 'connect',
+        'reference': reference.connect,
+        'fast': connect,
+        'key': ['source', 'sink', 'level'],
+        'synthetic': synthetic_connect,
+        'sampled': sampled_connect,
+    },
+    {
+        'name': 'lookup_capacity',
+        'reference': reference_capacities,
+        'fast': fast_capacities,
+        'key': None,
+        'synthetic': synthetic_capacity,
+        'sampled': sampled_capacity,
+    },
+]
+
+
+#####################################
+# comparison
+#####################################
+
+def values_match(a, b):
+    """
+    Compare two property values, returning whether they match within the
+    relative tolerance and whether they match exactly.
+
+    """
+    if a == b:
+        return True, True
+
+    numeric = (int, float)
+    if isinstance(a, numeric) and isinstance(b, numeric) and \
+        not isinstance(a, bool) and not isinstance(b, bool):
+        return math.isclose(a, b, rel_tol=RELATIVE_TOLERANCE, abs_tol=1e-12), False
+
+    return False, False
+
+
+def geometry_distance(a, b):
+    """
+    Return the Hausdorff distance between two GeoJSON geometries, or zero
+    if they are the same.
+
+    """
+    if json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True):
+        return 0
+
+    a = shape(a)
+    b = shape(b)
+
+    if a.geom_type != b.geom_type:
+        return math.inf
+
+    if a.equals_exact(b, 0):
+        return 0
+
+    return a.hausdorff_distance(b)
+
+
+def feature_sort_key(feature):
+    """
+    Order features sharing the same key properties by their coordinates
+    and remaining properties, so they are paired consistently.
+
+    """
+    return json.dumps([shape(feature['geometry']).bounds,
+        feature['properties']], sort_keys=True, default=str)
+
+
+def compare_features(expected, actual, key):
+    """
+    Compare two lists of features, matched on their key properties.
+
+    """
+    def feature_key(feature):
+        return tuple(feature['properties'].get(k) for k in key)
+
+    result = {
+        'expected': len(expected),
+        'actual': len(actual),
+        'missing': 0,
+        'extra': 0,
+        'geometries': 0,
+        'max_distance': 0,
+        'properties': defaultdict(int),
+        'same_order': [feature_key(f) for f in expected] == \
+            [feature_key(f) for f in actual],
+        'exact': True,
+    }
+
+    grouped = defaultdict(lambda: ([], []))
+    for feature in expected:
+        grouped[feature_key(feature)][0].append(feature)
+    for feature in actual:
+        grouped[feature_key(feature)][1].append(feature)
+
+    for group_key, (left, right) in grouped.items():
+
+        result['missing'] += max(len(left) - len(right), 0)
+        result['extra'] += max(len(right) - len(left), 0)
+
+        if len(left) > 1:
+            left = sorted(left, key=feature_sort_key)
+            right = sorted(right, key=feature_sort_key)
+
+        for a, b in zip(left, right):
+
+            distance = geometry_distance(a['geometry'], b['geometry'])
+            result['max_distance'] = max(result['max_distance'], distance)
+            if distance > 0:
+                result['exact'] = False
+            if distance > GEOMETRY_TOLERANCE:
+                result['geometries'] += 1
+
+            for name in set(a['properties']) | set(b['properties']):
+                within, exact = values_match(
+                    a['properties'].get(name, 'missing'),
+                    b['properties'].get(name, 'missing'))
+                if not exact:
+                    result['exact'] = False
+                if not within:
+                    result['properties'][name] += 1
+
+    result['properties'] = dict(result['properties'])
+
+    return result
+
+
+def compare_values(expected, actual):
+    """
+    Compare two lists of numbers, position by position.
+
+    """
+    result = {
+        'expected': len(expected),
+        'actual': len(actual),
+        'missing': max(len(expected) - len(actual), 0),
+        'extra': max(len(actual) - len(expected), 0),
+        'geometries': 0,
+        'max_distance': 0,
+        'properties': {},
+        'same_order': True,
+        'exact': True,
+    }
+
+    differing = 0
+    for a, b in zip(expected, actual):
+        within, exact = values_match(a, b)
+        if not exact:
+            result['exact'] = False
+        if not within:
+            differing += 1
+
+    if differing > 0:
+        result['properties']['value'] = differing
+
+    return result
+
+
+def known_differences(name, comparison):
+    """
+    Return the reasons for any of the differences found which are listed
+    in KNOWN_DIFFERENCES for this engine.
+
+    """
+    known = KNOWN_DIFFERENCES.get(name, {})
+
+    return {
+        field: known[field] for field in comparison['properties'] if field in known
+    }
+
+
+def classify(name, comparison):
+    """
+    Classify a comparison as identical, equivalent, known or differs.
+
+    """
+    unexplained = [
+        field for field in comparison['properties']
+        if field not in KNOWN_DIFFERENCES.get(name, {})
+    ]
+
+    if comparison['missing'] > 0 or comparison['extra'] > 0 or \
+        comparison['geometries'] > 0 or len(unexplained) > 0:
+        return 'differs'
+
+    if len(comparison['properties']) > 0:
+        return 'known'
+
+    if comparison['exact'] and comparison['same_order']:
+        return 'identical'
+
+    return 'equivalent'
+
+
+#####################################
+# running and timing
+#####################################
+
+@contextlib.contextmanager
+def raw_data(directory):
+    """
+    Point preprocess.py and reference.py at a raw data directory, such as
+    one holding synthetic coverage data.
+
+    """
+    previous = preprocess.DATA_RAW, reference.DATA_RAW
+    if directory is not None:
+        preprocess.DATA_RAW = reference.DATA_RAW = directory
+    try:
+        yield
+    finally:
+        preprocess.DATA_RAW, reference.DATA_RAW = previous
+
+
+def time_function(function, args, repeats):
+    """
+    Time a function on fresh copies of its arguments, returning its
+    output and the fastest of a number of repeats.
+
+    """
+    timings = []
+
+    for i in range(repeats):
+        copied = copy.deepcopy(args)
+        start = time.perf_counter()
+        output = function(*copied)
+        timings.append(time.perf_counter() - start)
+
+    return output, min(timings)
+
+
+def run_engine(engine, fixture_name, fixture, repeats):
+    """
+    Run an engine and its reference on a fixture, returning the timings
+    and comparison of their outputs.
+
+    """
+    with raw_data(fixture.get('data_raw')):
+        expected, reference_seconds = time_function(
+            engine['reference'], fixture['args'], repeats)
+        actual, fast_seconds = time_function(
+            engine['fast'], fixture['args'], repeats)
+
+    if engine['key'] is None:
+        comparison = compare_values(expected, actual)
+    else:
+        comparison = compare_features(expected, actual, engine['key'])
+
+    return {
+        'engine': engine['name'],
+        'fixture': fixture_name,
+        'records': fixture['records'],
+        'reference_seconds': reference_seconds,
+        'fast_seconds': fast_seconds,
+        'speedup': reference_seconds / fast_seconds if fast_seconds > 0 else None,
+        'result': classify(engine['name'], comparison),
+        'comparison': comparison,
+        'known_differences': known_differences(engine['name'], comparison),
+        'repeats': repeats,
+        'timestamp': time.time(),
+    }
+
+
+def print_result(result):
+    print('{:<38} {:<16} {:>9} {:>11.4f} {:>11.4f} {:>9} {}'.format(
+        result['engine'], result['fixture'], result['records'],
+        result['reference_seconds'], result['fast_seconds'],
+        'n/a' if result['speedup'] is None else '{:.1f}x'.format(result['speedup']),
+        result['result']))
+
+    comparison = result['comparison']
+    if result['result'] in ('differs', 'known'):
+        print('    expected {} actual {} missing {} extra {} geometries {} '
+            '(max distance {:.3g}) properties {}'.format(
+            comparison['expected'], comparison['actual'], comparison['missing'],
+            comparison['extra'], comparison['geometries'],
+            comparison['max_distance'], comparison['properties']))
+        for field, reason in result['known_differences'].items():
+            print('    {}: {}'.format(field, reason))
+
+
+def run_equivalence(engines, scales, seed, checkpoints, samples, repeats, path):
+    """
+    Run each engine against its reference on every fixture, writing the
+    results as JSON lines.
+
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    results = []
+
+    print('{:<38} {:<16} {:>9} {:>11} {:>11} {:>9} {}'.format(
+        'engine', 'fixture', 'records', 'reference s', 'fast s', 'speedup',
+        'result'))
+
+    with open(path, 'a') as sink:
+
+        for engine in engines:
+
+            with tempfile.TemporaryDirectory() as scratch:
+
+                fixtures = [
+                    ('synthetic_{}'.format(scale),
+                        engine['synthetic'](scale, seed, scratch))
+                    for scale in scales
+                ]
+
+                if checkpoints is not None:
+                    fixtures.append(('sampled', engine['sampled'](checkpoints,
+                        samples, random.Random(seed), scratch)))
+
+                for fixture_name, fixture in fixtures:
+                    if fixture is None:
+                        print('{:<38} {:<16} skipped (no real data)'.format(
+                            engine['name'], fixture_name))
+                        continue
+                    result = run_engine(engine, fixture_name, fixture, repeats)
+                    print_result(result)
+                    results.append(result)
+                    sink.write(json.dumps(result) + '\n')
+
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Check optimised functions against their references.')
+    parser.add_argument('--engines', nargs='+',
+        choices=[engine['name'] for engine in ENGINES],
+        help='only check these engines')
+    parser.add_argument('--scales', nargs='+', default=['1x'],
+        choices=list(synthetic.SCALES.keys()))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--checkpoints', default=CHECKPOINTS,
+        help='pipeline checkpoints to sample real fixtures from')
+    parser.add_argument('--no-sampled', action='store_true',
+        help='only use synthetic fixtures')
+    parser.add_argument('--samples', type=int, default=1000,
+        help='number of records in each sampled fixture')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=os.path.join(
+        DATA_INTERMEDIATE, 'benchmarks', 'equivalence_results.jsonl'))
+    args = parser.parse_args()
+
+    engines = [
+        engine for engine in ENGINES
+        if args.engines is None or engine['name'] in args.engines
+    ]
+
+    results = run_equivalence(engines, args.scales, args.seed,
+        None if args.no_sampled else args.checkpoints, args.samples,
+        args.repeats, args.output)
+
+    if any(result['result'] == 'differs' for result in results):
+        sys.exit(1)
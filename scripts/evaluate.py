@@ -0,0 +1,322 @@
+"""
+Capacity margin evaluation.
+
+Written by Ed Oughton
+
+This method brings together the capacity and demand estimation methods
+to compare the supply of mobile capacity with the demand for it in each
+postcode sector. The number of sites in each sector provides the site
+density, which is used to allocate capacity from the lookup table, while
+the sector population provides the busy hour demand. The margin is the
+difference between the two (Mbps per km^2), where a negative value
+indicates a capacity shortfall.
+
+Sectors are evaluated as arrays rather than one at a time, and LADs can
+be split into partitions and evaluated across several processes.
+
+"""
+import os
+import argparse
+import fiona
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from scripts.capacity import (load_capacity_lookup_table,
+    find_frequency_bandwidth, find_generation, lookup_capacity_array)
+from scripts.demand import calculate_user_demand, total_demand
+from scripts.overlay import piece_positions
+from scripts.config import BASE_PATH
+
+DATA_RAW = os.path.join(BASE_PATH, 'raw')
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
+
+#Population density thresholds (persons per km^2) for each clutter environment
+GEOTYPES = [
+    ('urban', 7959),
+    ('suburban', 782),
+    ('rural', 0),
+]
+
+#The low, baseline and high demand scenarios for each year
+SCENARIOS = [
+    {
+        'scenario': scenario,
+        'year': year,
+        'monthly_data_consumption_GB': monthly_data,
+        'busy_hour_traffic_percentage': 20,
+        'penetration_percentage': 80,
+        'market_share_percentage': 25,
+        'frequencies': ['800', '1800', '2600'],
+        'channel_bandwidth_800': '10',
+        'channel_bandwidth_1800': '10',
+        'channel_bandwidth_2600': '10',
+    }
+    for year in range(2020, 2031)
+    for scenario, monthly_data in [('low', 3), ('baseline', 5), ('high', 10)]
+]
+
+
+def sectors_to_frame(postcode_sectors, sites):
+    """
+    Convert the postcode sectors from preprocess.py into a table, adding
+    the number of unique sites in each sector.
+
+    Sectors split between LADs (see overlay.py) appear once per piece,
+    with the sites within that piece.
+
+    """
+    sites_per_sector = {}
+
+    for site, position in zip(sites, piece_positions(sites, postcode_sectors)):
+        if position is None:
+            continue
+        if position not in sites_per_sector:
+            sites_per_sector[position] = set()
+        sites_per_sector[position].add(site['properties']['name'])
+
+    output = []
+
+    for position, postcode_sector in enumerate(postcode_sectors):
+        output.append({
+            'lad': postcode_sector['properties']['lad'],
+            'id': postcode_sector['properties']['id'],
+            'area_km2': float(postcode_sector['properties']['area_km2']),
+            'population': float(postcode_sector['properties']['population']),
+            'sites': len(sites_per_sector.get(position, [])),
+        })
+
+    return pd.DataFrame(output, columns=[
+        'lad', 'id', 'area_km2', 'population', 'sites'])
+
+
+def define_geotype(population_density):
+    """
+    Allocate a clutter environment to an array of population densities.
+
+    """
+    population_density = np.asarray(population_density, dtype=float)
+
+    geotype = np.full(population_density.shape, GEOTYPES[-1][0], dtype=object)
+
+    for environment, threshold in reversed(GEOTYPES):
+        geotype[population_density >= threshold] = environment
+
+    return geotype
+
+
+def estimate_sector_capacity(site_density, environment, capacity_lookup_table,
+    simulation_parameters):
+    """
+    Find the macrocellular capacity (Mbps per km^2) for arrays of site
+    densities and clutter environments, summing over the frequency
+    bands deployed in the simulation parameters.
+
+    """
+    capacity = np.zeros(len(site_density))
+
+    for frequency in simulation_parameters['frequencies']:
+
+        bandwidth = find_frequency_bandwidth(frequency, simulation_parameters)
+        generation = find_generation(frequency)
+
+        for geotype in np.unique(environment):
+
+            mask = (environment == geotype) & (site_density > 0)
+
+            if not mask.any():
+                continue
+
+            capacity[mask] += lookup_capacity_array(
+                capacity_lookup_table,
+                geotype,
+                'macro',
+                str(frequency),
+                str(bandwidth),
+                generation,
+                site_density[mask],
+            )
+
+    return capacity
+
+
+def sector_index(frame):
+    """
+    Index the rows of a table by postcode sector id and LAD, which are
+    unique together even where a sector is split between LADs.
+
+    """
+    return pd.MultiIndex.from_arrays([frame['id'], frame['lad']])
+
+
+def evaluate_margins(sectors, capacity_lookup_table, scenarios,
+    population_forecast=None):
+    """
+    Estimate the capacity margin for each postcode sector, in each
+    scenario and year.
+
+    Each scenario is a dict containing the 'scenario' name, the 'year',
+    the demand parameters used by demand.py, the deployed 'frequencies'
+    and the channel bandwidth for each frequency.
+
+    A population forecast (with 'id', 'lad', 'year' and 'population'
+    columns, as produced by preprocess.disaggregate) can be provided,
+    otherwise the sector population is used for every year.
+
+    """
+    if population_forecast is not None:
+        population_forecast = pd.DataFrame(population_forecast)
+        population_forecast = population_forecast.set_index(
+            ['id', 'lad', 'year'])['population']
+
+    area = sectors['area_km2'].to_numpy(dtype=float)
+    site_density = sectors['sites'].to_numpy(dtype=float) / area
+
+    output = []
+
+    for scenario in scenarios:
+
+        population = sectors['population'].to_numpy(dtype=float)
+
+        if population_forecast is not None:
+            index = pd.MultiIndex.from_arrays([
+                sectors['id'], sectors['lad'], np.full(len(sectors), scenario['year'])
+            ])
+            forecast = population_forecast.reindex(index).to_numpy(dtype=float)
+            population = np.where(np.isnan(forecast), population, forecast)
+
+        environment = define_geotype(population / area)
+
+        capacity = estimate_sector_capacity(site_density, environment,
+            capacity_lookup_table, scenario)
+
+        user_demand = calculate_user_demand(scenario)
+        demand = total_demand(user_demand, population, area, scenario)
+
+        output.append(pd.DataFrame({
+            'scenario': scenario['scenario'],
+            'year': scenario['year'],
+            'lad': sectors['lad'].to_numpy(),
+            'id': sectors['id'].to_numpy(),
+            'area_km2': area,
+            'population': population,
+            'sites': sectors['sites'].to_numpy(),
+            'site_density_km2': site_density,
+            'environment': environment.astype(str),
+            'capacity_mbps_km2': capacity,
+            'demand_mbps_km2': demand,
+            'margin_mbps_km2': capacity - demand,
+        }))
+
+    return pd.concat(output, ignore_index=True)
+
+
+def partition_lads(sectors, partitions):
+    """
+    Split the sectors into a number of partitions by LAD, balancing the
+    number of sectors in each partition.
+
+    """
+    lad_sizes = sectors.groupby('lad', sort=True).size()
+    lad_sizes = lad_sizes.sort_values(ascending=False, kind='stable')
+
+    totals = [0] * partitions
+    groups = [[] for i in range(partitions)]
+
+    for lad_id, size in lad_sizes.items():
+        smallest = totals.index(min(totals))
+        groups[smallest].append(lad_id)
+        totals[smallest] += size
+
+    return [sectors[sectors['lad'].isin(group)] for group in groups if group]
+
+
+def evaluate_partitioned(sectors, capacity_lookup_table, scenarios,
+    population_forecast=None, workers=None):
+    """
+    Estimate capacity margins with LAD partitions evaluated in parallel.
+
+    Results are returned in the same order as a single-process run.
+
+    """
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1:
+        return evaluate_margins(sectors, capacity_lookup_table, scenarios,
+            population_forecast)
+
+    partitions = partition_lads(sectors, workers)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            evaluate_margins,
+            partitions,
+            [capacity_lookup_table] * len(partitions),
+            [scenarios] * len(partitions),
+            [population_forecast] * len(partitions),
+        ))
+
+    sector_order = pd.Series(np.arange(len(sectors)), index=sector_index(sectors))
+    scenario_order = {
+        (s['scenario'], s['year']): i for i, s in enumerate(scenarios)
+    }
+
+    output = pd.concat(results, ignore_index=True)
+    output['_scenario'] = [
+        scenario_order[key] for key in zip(output['scenario'], output['year'])
+    ]
+    output['_sector'] = sector_order.reindex(sector_index(output)).to_numpy()
+    output = output.sort_values(['_scenario', '_sector'], kind='stable')
+
+    return output.drop(columns=['_scenario', '_sector']).reset_index(drop=True)
+
+
+def write_margins(data, directory, filename):
+    """
+    Write capacity margins to a Parquet file.
+
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    data.to_parquet(os.path.join(directory, filename), index=False)
+
+
+def read_shapes(path):
+    """
+    Read all features from a shapefile.
+
+    """
+    with fiona.open(path, 'r') as source:
+        return [feature for feature in source]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Evaluate the capacity margin of each area.')
+    parser.add_argument('--capacity-lookup-table', default=os.path.join(
+        DATA_RAW, 'capacity_lut_by_frequency_10.csv'))
+    args = parser.parse_args()
+
+    print('Loading postcode sectors')
+    postcode_sectors = read_shapes(
+        os.path.join(DATA_PROCESSED, 'postcode_sectors.shp'))
+
+    print('Loading processed sites')
+    sites = read_shapes(os.path.join(DATA_PROCESSED, 'processed_sites.shp'))
+
+    sectors = sectors_to_frame(postcode_sectors, sites)
+
+    print('Loading capacity lookup table')
+    capacity_lookup_table = load_capacity_lookup_table(
+        args.capacity_lookup_table)
+
+    print('Evaluating capacity margins')
+    margins = evaluate_partitioned(sectors, capacity_lookup_table, SCENARIOS)
+
+    print('Writing capacity margins')
+    write_margins(margins, DATA_PROCESSED, 'capacity_margins.parquet')
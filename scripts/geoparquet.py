@@ -0,0 +1,307 @@
+"""
+Read and write GeoJSON-like data as (Geo)Parquet.
+
+Written by Ed Oughton
+
+The scripts pass data around as lists of GeoJSON-like features (or plain
+dicts for tabular data). These functions store either as a Parquet file,
+with feature properties as columns and geometry encoded as WKB, following
+the GeoParquet metadata convention. Plain dicts are stored as columns
+with no geometry.
+
+Outputs for downstream use can instead be written with one or more row
+groups for each partition (such as each LAD), with a bbox column of each
+feature's bounds and column statistics. Row groups can then be skipped
+when reading a single region or partition, and only the columns needed
+are read (see read_features).
+
+"""
+import os
+import json
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from shapely import wkb
+from shapely.geometry import shape, mapping
+
+#The largest number of rows in a row group of a partitioned file
+ROW_GROUP_SIZE = 65536
+
+BBOX_FIELDS = ['xmin', 'ymin', 'xmax', 'ymax']
+
+
+def is_features(data):
+    """
+    Check if data is a list of GeoJSON-like features.
+
+    """
+    if len(data) == 0:
+        return False
+
+    try:
+        data[0]['geometry'], data[0]['properties']
+    except (KeyError, TypeError):
+        return False
+
+    return True
+
+
+def geo_metadata(geometry_types, crs=None, bbox=False):
+    """
+    Create GeoParquet file metadata for a WKB geometry column, with a
+    bbox covering column if bbox is set.
+
+    """
+    column = {
+        'encoding': 'WKB',
+        'geometry_types': sorted(geometry_types),
+    }
+
+    if crs is not None:
+        authority, code = crs.upper().split(':')
+        column['crs'] = {'id': {'authority': authority, 'code': int(code)}}
+
+    if bbox:
+        column['covering'] = {
+            'bbox': {field: ['bbox', field] for field in BBOX_FIELDS}}
+
+    return {
+        'version': '1.1.0' if bbox else '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': column},
+    }
+
+
+def features_to_table(data, crs=None, bbox=False):
+    """
+    Convert a list of features or dicts to an arrow table, with a bbox
+    column of the bounds of each feature if bbox is set.
+
+    """
+    if not is_features(data):
+        table = pa.Table.from_pylist(list(data))
+        metadata = {b'kind': b'records'}
+        return table.replace_schema_metadata(metadata)
+
+    rows = []
+    geometry_types = set()
+
+    for feature in data:
+        row = dict(feature['properties'])
+        if feature['geometry'] is None:
+            row['geometry'] = None
+        else:
+            geometry_types.add(feature['geometry']['type'])
+            geometry = shape(feature['geometry'])
+            row['geometry'] = geometry.wkb
+            if bbox:
+                row['bbox'] = dict(zip(BBOX_FIELDS, geometry.bounds))
+        rows.append(row)
+
+    table = pa.Table.from_pylist(rows)
+
+    metadata = {
+        b'kind': b'features',
+        b'geo': json.dumps(
+            geo_metadata(geometry_types, crs, bbox)).encode('utf-8'),
+    }
+
+    return table.replace_schema_metadata(metadata)
+
+
+def table_to_features(table):
+    """
+    Convert an arrow table written by features_to_table back to a list
+    of features or dicts.
+
+    """
+    metadata = table.schema.metadata or {}
+    rows = table.to_pylist()
+
+    if metadata.get(b'kind') != b'features':
+        return rows
+
+    geo = json.loads(metadata.get(b'geo', b'{}').decode('utf-8'))
+    covering = 'covering' in geo.get('columns', {}).get('geometry', {})
+
+    output = []
+
+    for row in rows:
+        geometry = row.pop('geometry')
+        if covering:
+            row.pop('bbox', None)
+        output.append({
+            'type': 'Feature',
+            'geometry': None if geometry is None else mapping(wkb.loads(geometry)),
+            'properties': row,
+        })
+
+    return output
+
+
+def write_features(data, path, crs=None):
+    """
+    Write a list of features or dicts to a Parquet file.
+
+    The file is written to a temporary path and then moved into place, so
+    an interrupted write never leaves a partial file behind.
+
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    table = features_to_table(data, crs)
+
+    temp_path = path + '.tmp'
+    pq.write_table(table, temp_path)
+    os.replace(temp_path, path)
+
+
+def partition_key(feature, partition_by):
+    """
+    Return the sort key of a feature's partition, with missing values
+    last.
+
+    """
+    values = [feature['properties'].get(column) for column in partition_by]
+
+    return tuple((value is None, value) for value in values)
+
+
+def write_partitioned_features(data, path, partition_by, crs=None,
+    row_group_size=ROW_GROUP_SIZE):
+    """
+    Write a list of features to a GeoParquet file sorted by the
+    partition_by properties, with separate row groups for each partition
+    and a bbox column, so readers can skip the row groups of other
+    partitions or areas using the column statistics.
+
+    """
+    data = sorted(data, key=lambda feature: partition_key(feature, partition_by))
+
+    if not is_features(data):
+        return write_features(data, path, crs)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    table = features_to_table(data, crs, bbox=True)
+    metadata = dict(table.schema.metadata)
+    metadata[b'partition_by'] = json.dumps(partition_by).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    temp_path = path + '.tmp'
+
+    with pq.ParquetWriter(temp_path, table.schema) as writer:
+        start = 0
+        for end in range(1, len(data) + 1):
+            if end == len(data) or partition_key(data[end], partition_by) != \
+                partition_key(data[start], partition_by):
+                writer.write_table(table.slice(start, end - start),
+                    row_group_size=row_group_size)
+                start = end
+
+    os.replace(temp_path, path)
+
+
+def filter_values(value):
+    """
+    Return the values of a filter, which is either one value or a list.
+
+    """
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+
+    return [value]
+
+
+def row_group_matches(row_group, filters, bbox):
+    """
+    Check if a row group may hold rows matching the filters and bbox,
+    from its column statistics.
+
+    """
+    statistics = {}
+    for j in range(row_group.num_columns):
+        column = row_group.column(j)
+        if column.is_stats_set and column.statistics.has_min_max:
+            statistics[column.path_in_schema] = column.statistics
+
+    for column, value in filters.items():
+        if column not in statistics:
+            continue
+        minimum, maximum = statistics[column].min, statistics[column].max
+        if not any(minimum <= v <= maximum for v in filter_values(value)):
+            return False
+
+    if bbox is not None and all(
+        'bbox.{}'.format(field) in statistics for field in BBOX_FIELDS):
+        minx, miny, maxx, maxy = bbox
+        if statistics['bbox.xmin'].min > maxx or \
+            statistics['bbox.ymin'].min > maxy or \
+            statistics['bbox.xmax'].max < minx or \
+            statistics['bbox.ymax'].max < miny:
+            return False
+
+    return True
+
+
+def read_features(path, columns=None, filters=None, bbox=None):
+    """
+    Read a list of features or dicts from a Parquet file.
+
+    Only the given property columns are read if columns is set, only the
+    rows whose properties equal the filters (a dict of a value, or a list
+    of values, by column), and only the features whose bounds intersect
+    bbox (minx, miny, maxx, maxy). Row groups are skipped using their
+    statistics where possible.
+
+    """
+    if columns is None and filters is None and bbox is None:
+        return table_to_features(pq.read_table(path))
+
+    filters = filters or {}
+
+    parquet_file = pq.ParquetFile(path)
+    names = parquet_file.schema_arrow.names
+
+    row_groups = [
+        i for i in range(parquet_file.metadata.num_row_groups)
+        if row_group_matches(parquet_file.metadata.row_group(i), filters, bbox)
+    ]
+
+    selected = names if columns is None else [
+        name for name in names
+        if name in columns or name in ('geometry', 'bbox')
+    ]
+    read_columns = [
+        name for name in names if name in selected or name in filters]
+
+    table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+
+    for column, value in filters.items():
+        values = pa.array(filter_values(value), type=table.schema.field(column).type)
+        table = table.filter(pc.is_in(table[column], value_set=values))
+
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        if 'bbox' in table.column_names:
+            bounds = {field: pc.struct_field(table['bbox'], field)
+                for field in BBOX_FIELDS}
+        else:
+            extents = [wkb.loads(geometry).bounds
+                for geometry in table['geometry'].to_pylist()]
+            bounds = {field: pa.array([extent[i] for extent in extents],
+                type=pa.float64()) for i, field in enumerate(BBOX_FIELDS)}
+        table = table.filter(pc.and_(
+            pc.and_(pc.less_equal(bounds['xmin'], maxx),
+                pc.less_equal(bounds['ymin'], maxy)),
+            pc.and_(pc.greater_equal(bounds['xmax'], minx),
+                pc.greater_equal(bounds['ymax'], miny))))
+
+    return table_to_features(table.select(
+        [name for name in table.column_names if name in selected]))
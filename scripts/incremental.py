@@ -0,0 +1,521 @@
+"""
+Incremental reprocessing of new Sitefinder and Ofcom releases.
+
+Written by Ed Oughton
+
+Each Sitefinder or Ofcom Connected Nations release only changes some of
+the sites or LADs, but a change to either file invalidates the pipeline
+stages after it, so the pipeline would redo them all. This script instead
+diffs the new release against the last checkpoints, reprocesses only what
+the changes affect and patches the checkpoints.
+
+Sitefinder assets are compared by Opref (within each operator when sites
+are processed by operator). process_asset_data dissolves each asset with
+the assets whose buffers overlap it, in file order, so a change can only
+affect the assets connected to it by overlapping buffers (or a shared
+Opref). Only these neighbourhoods are reclustered, and the other sites
+are kept, renamed to the new names of their assets. Unchanged assets are
+assumed to keep their relative order in the file.
+
+Ofcom coverage is compared by LAD code, against a copy of the coverage
+table saved by the last incremental run along with the key of the
+coverage_4G checkpoint it patched. All LADs are reallocated if there is
+no copy, or if the checkpoint has since been replaced (e.g. by a full
+pipeline run). Otherwise coverage is reallocated for the changed LADs
+only.
+
+Sites are then rejoined to postcode sectors and linked to exchanges only
+where their cluster or the coverage of their sector changed, using the
+pipeline's own stage functions. Patched rows are added after the kept
+rows, so outputs match a full run up to the order of the rows. Finally the
+manifest is updated and any later stages (such as write) are run by the
+pipeline as usual.
+
+Usage:
+
+    python -m scripts.incremental
+    python -m scripts.incremental --operators
+
+"""
+import os
+import argparse
+
+from functools import partial
+
+from shapely.geometry import shape
+from rtree import index
+
+from scripts.cache import read_json, write_json
+from scripts.geoparquet import read_features, write_features
+from scripts.pipeline import (CHECKPOINTS, CRS, COVERAGE_PATH, build_stages,
+    stage_key, checkpoint_path, run_pipeline)
+from scripts.preprocess import SITE_BUFFER, MOBILE_OPERATORS, load_coverage_table
+
+#The stages patched in place, rather than rerun
+INCREMENTAL_STAGES = ['sitefinder', 'buffering', 'coverage_4G', 'site_coverage',
+    'links']
+
+COVERAGE_SNAPSHOT = 'coverage_release.json'
+
+
+def asset_key(asset, by_operator=False):
+    """
+    Return the key of a Sitefinder asset, its Opref, along with its
+    operator if sites are processed by operator.
+
+    """
+    operator = None
+    if by_operator:
+        operator = MOBILE_OPERATORS.get(asset['properties']['Operator'],
+            asset['properties']['Operator'])
+
+    return (operator, asset['properties']['Opref'])
+
+
+def asset_signature(asset):
+    """
+    Return everything about an asset except its name (which is its row
+    in the file, so changes whenever rows are added or removed).
+
+    """
+    properties = {k: v for k, v in asset['properties'].items() if k != 'name'}
+
+    return (tuple(asset['geometry']['coordinates']), sorted(properties.items()))
+
+
+def diff_assets(old_assets, new_assets, by_operator=False):
+    """
+    Return the keys of the assets added, removed or changed between two
+    Sitefinder releases.
+
+    """
+    old = {}
+    for asset in old_assets:
+        old.setdefault(asset_key(asset, by_operator), []).append(
+            asset_signature(asset))
+
+    new = {}
+    for asset in new_assets:
+        new.setdefault(asset_key(asset, by_operator), []).append(
+            asset_signature(asset))
+
+    return set(
+        key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+
+def buffer_bounds(asset):
+    """
+    Return the bounds of an asset's buffer.
+
+    """
+    x, y = asset['geometry']['coordinates'][:2]
+
+    return (x - SITE_BUFFER, y - SITE_BUFFER, x + SITE_BUFFER, y + SITE_BUFFER)
+
+
+def affected_assets(old_assets, new_assets, changed, by_operator=False):
+    """
+    Find the positions of the new assets connected to a change, by
+    overlapping buffers or a shared key, whether in the new release or to
+    the old position of a removed or moved asset.
+
+    """
+    idx = index.Index(
+        (i, buffer_bounds(asset), None) for i, asset in enumerate(new_assets))
+
+    keys = {}
+    for i, asset in enumerate(new_assets):
+        keys.setdefault(asset_key(asset, by_operator), []).append(i)
+
+    buffers = {}
+
+    def buffer(i):
+        if i not in buffers:
+            buffers[i] = shape(new_assets[i]['geometry']).buffer(SITE_BUFFER)
+        return buffers[i]
+
+    def neighbours(geometry, key):
+        output = list(keys.get(key, []))
+        for j in idx.intersection(geometry.bounds):
+            if by_operator and asset_key(new_assets[j], by_operator)[0] != key[0]:
+                continue
+            if geometry.intersects(buffer(j)):
+                output.append(j)
+        return output
+
+    frontier = []
+    for asset in old_assets:
+        key = asset_key(asset, by_operator)
+        if key in changed:
+            frontier.extend(neighbours(
+                shape(asset['geometry']).buffer(SITE_BUFFER), key))
+    for key in changed:
+        frontier.extend(keys.get(key, []))
+
+    affected = set()
+
+    while frontier:
+        i = frontier.pop()
+        if i in affected:
+            continue
+        affected.add(i)
+        frontier.extend(neighbours(buffer(i),
+            asset_key(new_assets[i], by_operator)))
+
+    return affected
+
+
+def recluster(old_assets, old_sites, new_assets, cluster, by_operator=False):
+    """
+    Recluster the sites affected by a new Sitefinder release with cluster
+    (the buffering stage function), keeping all other sites.
+
+    Returns the sites, in new release order, and the new name of each
+    kept site by its old name.
+
+    """
+    changed = diff_assets(old_assets, new_assets, by_operator)
+    affected = affected_assets(old_assets, new_assets, changed, by_operator)
+
+    affected_keys = set(changed)
+    affected_keys.update(
+        asset_key(new_assets[i], by_operator) for i in affected)
+
+    old_by_name = {asset['properties']['name']: asset for asset in old_assets}
+
+    new_positions = {}
+    for i, asset in enumerate(new_assets):
+        new_positions.setdefault(asset_key(asset, by_operator), i)
+
+    output = []
+    renamed = {}
+
+    for site in old_sites:
+        key = asset_key(old_by_name[site['properties']['name']], by_operator)
+        if key in affected_keys:
+            continue
+        position = new_positions[key]
+        properties = dict(site['properties'])
+        properties['name'] = new_assets[position]['properties']['name']
+        renamed[site['properties']['name']] = properties['name']
+        output.append((position, {
+            'type': site['type'],
+            'geometry': site['geometry'],
+            'properties': properties,
+        }))
+
+    positions = sorted(affected)
+    new_by_name = {
+        new_assets[i]['properties']['name']: i for i in positions}
+
+    for site in cluster([new_assets[i] for i in positions]):
+        output.append((new_by_name[site['properties']['name']], site))
+
+    output.sort(key=lambda item: item[0])
+
+    print('Reclustered {} of {} assets ({} changed), kept {} sites'.format(
+        len(positions), len(new_assets), len(changed), len(renamed)))
+
+    return [site for position, site in output], renamed
+
+
+def diff_coverage(old_coverage, new_coverage):
+    """
+    Return the LADs whose coverage differs between two Ofcom releases.
+
+    """
+    return set(
+        lad for lad in set(old_coverage) | set(new_coverage)
+        if old_coverage.get(lad) != new_coverage.get(lad)
+    )
+
+
+def read_coverage_snapshot(path, key):
+    """
+    Return the coverage table saved with the coverage_4G checkpoint key,
+    or None if there is none, or it was saved for another checkpoint.
+
+    """
+    snapshot = read_json(path)
+
+    if snapshot.get('key') != key:
+        return None
+
+    return snapshot['coverage']
+
+
+def reallocate(sectors, postcode_sectors, lads, changed_lads, allocate):
+    """
+    Reallocate coverage to the postcode sectors of the changed LADs with
+    allocate (the coverage stage function), replacing their blocks of the
+    allocated sectors, which are in LAD then density order.
+
+    Returns the sectors, and the ids of those whose coverage changed.
+
+    """
+    lads = [lad for lad in lads if lad['properties']['name'] in changed_lads]
+    selected = [
+        s for s in postcode_sectors if s['properties']['lad'] in changed_lads]
+
+    reallocated = {}
+    for sector in allocate(selected, lads):
+        reallocated.setdefault(sector['properties']['lad'], []).append(sector)
+    reallocated = {lad: iter(block) for lad, block in reallocated.items()}
+
+    output = []
+    changed_ids = set()
+
+    for sector in sectors:
+        lad = sector['properties']['lad']
+        if lad not in changed_lads:
+            output.append(sector)
+            continue
+        new_sector = next(reallocated[lad])
+        if new_sector['properties']['lte'] != sector['properties']['lte']:
+            changed_ids.add(sector['properties']['id'])
+        output.append(new_sector)
+
+    print('Reallocated coverage in {} LADs, changing {} sectors'.format(
+        len(lads), len(changed_ids)))
+
+    return output, changed_ids
+
+
+def patch_site_coverage(site_coverage, sites, sectors, renamed, changed_ids,
+    join):
+    """
+    Rejoin the sites whose cluster, or whose sector's coverage, changed
+    with join (the site coverage stage function).
+
+    Returns the site coverage, and the (name, sector id) of each kept row.
+
+    """
+    kept = []
+    for row in site_coverage:
+        name = row['properties']['name']
+        if name not in renamed or row['properties']['id'] in changed_ids:
+            continue
+        properties = dict(row['properties'], name=renamed[name])
+        kept.append({
+            'type': row['type'],
+            'geometry': row['geometry'],
+            'properties': properties,
+        })
+
+    kept_names = set(renamed.values())
+    new_sites = [s for s in sites if s['properties']['name'] not in kept_names]
+    kept_sites = [s for s in sites if s['properties']['name'] in kept_names]
+    changed_sectors = [s for s in sectors if s['properties']['id'] in changed_ids]
+
+    rows = []
+    if new_sites:
+        rows.extend(join(new_sites, sectors))
+    if kept_sites and changed_sectors:
+        rows.extend(join(kept_sites, changed_sectors))
+
+    print('Rejoined {} site coverage rows, kept {}'.format(len(rows), len(kept)))
+
+    kept_rows = set(
+        (row['properties']['name'], row['properties']['id']) for row in kept)
+
+    return kept + rows, kept_rows
+
+
+def patch_links(processed_sites, backhaul_links, site_coverage, kept_rows,
+    renamed, link, other_inputs):
+    """
+    Link the new site coverage rows to exchanges with link (the links
+    stage function), keeping the links of all other rows.
+
+    """
+    sites = []
+    links = []
+
+    for site, backhaul_link in zip(processed_sites, backhaul_links):
+        name = renamed.get(site['properties']['name'])
+        if (name, site['properties']['id']) not in kept_rows:
+            continue
+        sites.append({
+            'type': site['type'],
+            'geometry': site['geometry'],
+            'properties': dict(site['properties'], name=name),
+        })
+        links.append({
+            'type': backhaul_link['type'],
+            'geometry': backhaul_link['geometry'],
+            'properties': dict(backhaul_link['properties'], origin_id=name),
+        })
+
+    new_rows = [
+        row for row in site_coverage
+        if (row['properties']['name'], row['properties']['id']) not in kept_rows
+    ]
+
+    if new_rows:
+        new_sites, new_links = link(new_rows, *other_inputs)
+        sites.extend(new_sites)
+        links.extend(new_links)
+
+    print('Linked {} sites, kept {}'.format(len(new_rows), len(kept_rows)))
+
+    return sites, links
+
+
+def stage_keys(stages, hash_cache):
+    """
+    Return the key of every stage for the current inputs, and the names
+    of the stages downstream of the incremental stages.
+
+    """
+    dataset_keys = {}
+    patched = set()
+    keys = {}
+    downstream = set()
+
+    for stage in stages:
+        keys[stage['name']] = stage_key(stage, dataset_keys, hash_cache)
+        for dataset in stage['outputs']:
+            dataset_keys[dataset] = keys[stage['name']]
+        if stage['name'] in INCREMENTAL_STAGES or patched.intersection(
+            stage['inputs']):
+            patched.update(stage['outputs'])
+            if stage['name'] not in INCREMENTAL_STAGES:
+                downstream.add(stage['name'])
+
+    return keys, downstream
+
+
+def incremental_update(stages, directory):
+    """
+    Patch the checkpoints in directory for new Sitefinder and Ofcom
+    releases, updating the manifest for the patched stages.
+
+    Every stage not downstream of the patched stages must be up to date,
+    and the stages downstream are left to run_pipeline.
+
+    """
+    stages_by_name = {stage['name']: stage for stage in stages}
+    names = [stage['name'] for stage in stages]
+
+    missing = [name for name in INCREMENTAL_STAGES if name not in names]
+    if missing:
+        raise KeyError('Incremental updates need the stages: {}'.format(
+            ', '.join(missing)))
+
+    manifest_path = os.path.join(directory, 'manifest.json')
+    hash_cache_path = os.path.join(directory, 'file_hashes.json')
+    snapshot_path = os.path.join(directory, COVERAGE_SNAPSHOT)
+
+    manifest = read_json(manifest_path)
+    hash_cache = read_json(hash_cache_path)
+
+    missing = [name for name in INCREMENTAL_STAGES if name not in manifest]
+    if missing:
+        raise FileNotFoundError('No checkpoint for stages {}, run the pipeline '
+            'first'.format(', '.join(missing)))
+
+    keys, downstream = stage_keys(stages, hash_cache)
+    write_json(hash_cache, hash_cache_path)
+
+    for name in names:
+        if name not in INCREMENTAL_STAGES and name not in downstream and \
+            manifest.get(name) != keys[name]:
+            raise ValueError('Stage {} is out of date, run the pipeline '
+                'first'.format(name))
+
+    def load(dataset):
+        return list(read_features(checkpoint_path(directory, dataset)))
+
+    def write(dataset, data):
+        write_features(data, checkpoint_path(directory, dataset), CRS)
+
+    old_coverage = read_coverage_snapshot(snapshot_path, manifest['coverage_4G'])
+
+    sites_changed = manifest.get('sitefinder') != keys['sitefinder']
+    coverage_changed = manifest.get('coverage_4G') != keys['coverage_4G']
+
+    if not sites_changed and not coverage_changed:
+        print('No new Sitefinder or Ofcom release')
+        return
+
+    sites = load('sites')
+    renamed = {site['properties']['name']: site['properties']['name']
+        for site in sites}
+
+    if sites_changed:
+        print('Diffing Sitefinder release')
+        stage = stages_by_name['sitefinder']
+        new_assets = list(stage['function'](**stage.get('parameters', {})))
+
+        stage = stages_by_name['buffering']
+        parameters = stage.get('parameters', {})
+        sites, renamed = recluster(load('sitefinder'), sites, new_assets,
+            partial(stage['function'], **parameters),
+            parameters.get('by_operator', False))
+
+        write('sitefinder', new_assets)
+        write('sites', sites)
+
+    sectors = load('sectors_coverage')
+    changed_ids = set()
+
+    columns, coverage = load_coverage_table(COVERAGE_PATH)
+
+    if coverage_changed:
+        print('Diffing Ofcom release')
+        if old_coverage is not None:
+            changed_lads = diff_coverage(old_coverage, coverage)
+        else:
+            print('No coverage table saved for the coverage_4G checkpoint, '
+                'reallocating all LADs')
+            changed_lads = set(s['properties']['lad'] for s in sectors)
+
+        stage = stages_by_name['coverage_4G']
+        postcode_sectors, lads = [load(dataset) for dataset in stage['inputs']]
+        sectors, changed_ids = reallocate(sectors, postcode_sectors, lads,
+            changed_lads, partial(stage['function'], **stage.get('parameters', {})))
+
+        write('sectors_coverage', sectors)
+
+    stage = stages_by_name['site_coverage']
+    site_coverage, kept_rows = patch_site_coverage(load('sites_coverage'), sites,
+        sectors, renamed, changed_ids,
+        partial(stage['function'], **stage.get('parameters', {})))
+    write('sites_coverage', site_coverage)
+
+    stage = stages_by_name['links']
+    processed_sites, backhaul_links = patch_links(
+        load('processed_sites'), load('backhaul_links'), site_coverage, kept_rows,
+        renamed, partial(stage['function'], **stage.get('parameters', {})),
+        [load(dataset) for dataset in stage['inputs'][1:]])
+    write('processed_sites', processed_sites)
+    write('backhaul_links', backhaul_links)
+
+    for name in INCREMENTAL_STAGES:
+        manifest[name] = keys[name]
+    write_json(manifest, manifest_path)
+    write_json({'key': keys['coverage_4G'], 'coverage': coverage}, snapshot_path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Patch the pipeline checkpoints for new Sitefinder and '
+        'Ofcom releases.')
+    parser.add_argument('--operators', action='store_true',
+        help='sites of every mobile operator are processed (as pipeline '
+        '--operators)')
+    parser.add_argument('--exchange-areas', action='store_true',
+        help='sites are linked within exchange areas (as pipeline '
+        '--exchange-areas)')
+    parser.add_argument('--checkpoints', default=CHECKPOINTS,
+        help='checkpoint directory')
+    args = parser.parse_args()
+
+    stages = build_stages(exchange_areas=args.exchange_areas,
+        operators=args.operators)
+
+    incremental_update(stages, args.checkpoints)
+
+    print('Running any later stages')
+    run_pipeline(stages, args.checkpoints)
@@ -0,0 +1,200 @@
+"""
+Stage timing, memory and profiling instrumentation.
+
+Written by Ed Oughton
+
+Wrap each named step of a script in stage_timer to record its wall time,
+CPU time, memory and the number of records in and out.
+
+Memory is recorded as the resident set size at the start and end of the
+stage (and the change between them), where /proc is available, and as
+the lifetime maximum resident set size of the process and its finished
+children. The lifetime maximum is a high-water mark for the whole run so
+far, not the peak of the stage, so it only shows the stages which raised
+it.
+Each stage is emitted as one JSON line, so runs can be compared and
+loaded into pandas with read_json(path, lines=True).
+
+Optionally each stage can be profiled with cProfile (written as a .prof
+file for snakeviz or pstats) or pyinstrument (written as .html), if
+installed.
+
+"""
+import os
+import sys
+import json
+import time
+import socket
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def current_rss_mb():
+    """
+    Return the current resident set size (MB) of this process, or None
+    where /proc is not available.
+
+    """
+    try:
+        with open('/proc/self/statm') as source:
+            pages = int(source.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+
+def lifetime_max_rss_mb(who='self'):
+    """
+    Return the maximum resident set size (MB) reached so far in the life
+    of this process, or of all finished child processes, or None where
+    this is not available.
+
+    """
+    if resource is None:
+        return None
+
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+
+    #ru_maxrss is in bytes on macOS and kilobytes on Linux
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss / 1024 / 1024
+
+    return usage.ru_maxrss / 1024
+
+
+def count_records(data):
+    """
+    Count the records in a stage input or output, returning a list of
+    counts for tuples of datasets, or None if the data has no length.
+
+    """
+    if isinstance(data, tuple):
+        return [count_records(item) for item in data]
+
+    try:
+        return len(data)
+    except TypeError:
+        return None
+
+
+def emit(record, log_path=None):
+    """
+    Write a record as a JSON line to a log file, or stdout if no log file
+    is given.
+
+    """
+    line = json.dumps(record, default=str)
+
+    if log_path is None:
+        print(line)
+        return
+
+    directory = os.path.dirname(log_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(log_path, 'a') as sink:
+        sink.write(line + '\n')
+
+
+def start_profiler(profile):
+    """
+    Start a cProfile or pyinstrument profiler.
+
+    """
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    if profile == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError('pyinstrument profiling requires pyinstrument '
+                'to be installed (pip install pyinstrument)')
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+
+    raise ValueError('Unknown profiler {}, use cprofile or pyinstrument'.format(
+        profile))
+
+
+def stop_profiler(profiler, profile, name, directory):
+    """
+    Stop a profiler and write its results, returning the output path.
+
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    if profile == 'cprofile':
+        profiler.disable()
+        path = os.path.join(directory, '{}.prof'.format(name))
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        path = os.path.join(directory, '{}.html'.format(name))
+        with open(path, 'w') as sink:
+            sink.write(profiler.output_html())
+
+    return path
+
+
+@contextmanager
+def stage_timer(name, records_in=None, log_path=None, profile=None,
+    profile_directory='profiles'):
+    """
+    Time a named stage, emitting a JSON line record when it finishes.
+
+    The record is yielded so the stage can add the number of output
+    records (or anything else) before it is written, e.g.:
+
+        with stage_timer('buffering', len(sites), log_path) as record:
+            sites = process_asset_data(sites)
+            record['records_out'] = len(sites)
+
+    """
+    record = {
+        'stage': name,
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'records_in': records_in,
+        'records_out': None,
+    }
+
+    profiler = start_profiler(profile) if profile else None
+
+    start_rss = current_rss_mb()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    record['started'] = time.time()
+    record['status'] = 'error'
+
+    try:
+        yield record
+        record['status'] = 'ok'
+    finally:
+        record['wall_seconds'] = time.perf_counter() - start_wall
+        record['cpu_seconds'] = time.process_time() - start_cpu
+        record['rss_start_mb'] = start_rss
+        record['rss_end_mb'] = current_rss_mb()
+        record['rss_delta_mb'] = None if start_rss is None or \
+            record['rss_end_mb'] is None else record['rss_end_mb'] - start_rss
+        record['max_rss_lifetime_mb'] = lifetime_max_rss_mb('self')
+        record['max_rss_children_lifetime_mb'] = lifetime_max_rss_mb('children')
+
+        if profiler is not None:
+            record['profile'] = stop_profiler(
+                profiler, profile, name, profile_directory)
+
+        emit(record, log_path)
@@ -0,0 +1,409 @@
+"""
+Monte Carlo scenarios of capacity margins.
+
+Written by Ed Oughton
+
+evaluate.py estimates capacity margins for a handful of hand-written
+scenarios. These functions instead sample the demand parameters (monthly
+data, busy hour share, penetration and market share) and the channel
+bandwidth of each frequency from distributions, and evaluate the demand,
+capacity and margin of every postcode sector for thousands of draws.
+
+Draws are evaluated in batches, as arrays of shape (draws, sectors), and
+batches are spread over a pool of processes. The capacity of each sector
+only depends on the bandwidth drawn for each frequency, so it is looked up
+once for each possible bandwidth, rather than once per draw.
+
+Results are streamed to a Parquet file as each batch finishes, so the
+draws are never all held in memory. Exact percentiles of each sector are
+then read back from this file for blocks of sectors at a time, with the
+block size chosen so that no more than PERCENTILE_MEMORY bytes of results
+are held at once (one pass over the file per block).
+
+Draws are sampled with a fixed seed unless another is given, so runs are
+repeatable.
+
+Usage:
+
+    python -m scripts.montecarlo --draws 10000 --workers 8
+    python -m scripts.montecarlo --draws 10000 --seed 7
+
+"""
+import os
+import argparse
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from scripts.capacity import load_capacity_lookup_table
+from scripts.demand import calculate_user_demand, total_demand
+from scripts.evaluate import (sectors_to_frame, define_geotype,
+    estimate_sector_capacity, read_shapes)
+from scripts.config import BASE_PATH
+
+DATA_RAW = os.path.join(BASE_PATH, 'raw')
+DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
+
+FREQUENCIES = ['800', '1800', '2600']
+
+#Each distribution is one of:
+#   {'distribution': 'fixed', 'value': x}
+#   {'distribution': 'uniform', 'low': a, 'high': b}
+#   {'distribution': 'triangular', 'low': a, 'mode': c, 'high': b}
+#   {'distribution': 'normal', 'mean': m, 'sd': s, 'low': a, 'high': b}
+#   {'distribution': 'choice', 'values': [...], 'weights': [...]}
+#where normal draws are clipped to the optional low and high bounds.
+#Channel bandwidths must be fixed or a choice of bandwidths in the
+#capacity lookup table.
+DISTRIBUTIONS = {
+    'monthly_data_consumption_GB': {
+        'distribution': 'triangular', 'low': 2, 'mode': 5, 'high': 15},
+    'busy_hour_traffic_percentage': {
+        'distribution': 'uniform', 'low': 15, 'high': 25},
+    'penetration_percentage': {
+        'distribution': 'uniform', 'low': 70, 'high': 90},
+    'market_share_percentage': {
+        'distribution': 'uniform', 'low': 20, 'high': 30},
+    'channel_bandwidth_800': {'distribution': 'fixed', 'value': '10'},
+    'channel_bandwidth_1800': {'distribution': 'fixed', 'value': '10'},
+    'channel_bandwidth_2600': {'distribution': 'fixed', 'value': '10'},
+}
+
+METRICS = ['demand_mbps_km2', 'capacity_mbps_km2', 'margin_mbps_km2']
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+BATCH_SIZE = 100
+
+SEED = 42
+
+#Largest size (bytes) of the results held at once when finding percentiles
+PERCENTILE_MEMORY = 256 * 2**20
+
+STATE = {}
+
+
+def sample_distribution(distribution, draws, rng):
+    """
+    Draw samples from a distribution, as described in DISTRIBUTIONS.
+
+    """
+    kind = distribution['distribution']
+
+    if kind == 'fixed':
+        return np.full(draws, distribution['value'],
+            dtype=object if isinstance(distribution['value'], str) else float)
+
+    if kind == 'uniform':
+        return rng.uniform(distribution['low'], distribution['high'], draws)
+
+    if kind == 'triangular':
+        return rng.triangular(distribution['low'], distribution['mode'],
+            distribution['high'], draws)
+
+    if kind == 'normal':
+        values = rng.normal(distribution['mean'], distribution['sd'], draws)
+        return np.clip(values, distribution.get('low', -np.inf),
+            distribution.get('high', np.inf))
+
+    if kind == 'choice':
+        weights = distribution.get('weights')
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float) / np.sum(weights)
+        values = np.array(distribution['values'], dtype=object)
+        return values[rng.choice(len(values), draws, p=weights)]
+
+    raise ValueError('Unknown distribution: {}'.format(kind))
+
+
+def sample_parameters(distributions, draws, seed=None):
+    """
+    Sample every parameter for a number of draws, returning a DataFrame
+    with one row per draw.
+
+    """
+    rng = np.random.default_rng(seed)
+
+    output = {'draw': np.arange(draws)}
+
+    for parameter in sorted(distributions):
+        output[parameter] = sample_distribution(
+            distributions[parameter], draws, rng)
+
+    return pd.DataFrame(output)
+
+
+def bandwidth_choices(distributions, frequencies):
+    """
+    Return the possible channel bandwidths of each frequency.
+
+    """
+    output = {}
+
+    for frequency in frequencies:
+        distribution = distributions['channel_bandwidth_{}'.format(frequency)]
+        if distribution['distribution'] == 'fixed':
+            output[frequency] = [str(distribution['value'])]
+        elif distribution['distribution'] == 'choice':
+            output[frequency] = [str(value) for value in distribution['values']]
+        else:
+            raise ValueError('Channel bandwidth for {} must be fixed or a '
+                'choice'.format(frequency))
+
+    return output
+
+
+def sector_capacities(sectors, capacity_lookup_table, bandwidths):
+    """
+    Find the capacity (Mbps per km^2) of every sector from each frequency,
+    for each possible bandwidth of that frequency, as an array of shape
+    (bandwidths, sectors).
+
+    """
+    area = sectors['area_km2'].to_numpy(dtype=float)
+    site_density = sectors['sites'].to_numpy(dtype=float) / area
+    population = sectors['population'].to_numpy(dtype=float)
+
+    environment = define_geotype(population / area)
+
+    output = {}
+
+    for frequency, choices in bandwidths.items():
+        output[frequency] = np.array([
+            estimate_sector_capacity(site_density, environment,
+                capacity_lookup_table, {
+                    'frequencies': [frequency],
+                    'channel_bandwidth_{}'.format(frequency): bandwidth,
+                })
+            for bandwidth in choices
+        ])
+
+    return output
+
+
+def init_worker(sectors, capacity_lookup_table, bandwidths):
+    """
+    Look up the capacity of each sector for every possible bandwidth once
+    for each worker process.
+
+    """
+    STATE.clear()
+    STATE.update({
+        'area': sectors['area_km2'].to_numpy(dtype=float),
+        'population': sectors['population'].to_numpy(dtype=float),
+        'bandwidths': bandwidths,
+        'capacities': sector_capacities(
+            sectors, capacity_lookup_table, bandwidths),
+    })
+
+
+def evaluate_draws(draws):
+    """
+    Evaluate the demand, capacity and margin of every sector for a batch
+    of draws, returning arrays of shape (draws, sectors).
+
+    """
+    parameters = {
+        column: draws[column].to_numpy()[:, None]
+        for column in draws.columns if column != 'draw'
+    }
+    for column in ['monthly_data_consumption_GB', 'busy_hour_traffic_percentage',
+        'penetration_percentage', 'market_share_percentage']:
+        parameters[column] = parameters[column].astype(float)
+
+    user_demand = calculate_user_demand(parameters)
+    demand = total_demand(user_demand, STATE['population'], STATE['area'],
+        parameters)
+
+    capacity = np.zeros(demand.shape)
+
+    for frequency, choices in STATE['bandwidths'].items():
+        drawn = draws['channel_bandwidth_{}'.format(frequency)].astype(str)
+        codes = np.array([choices.index(bandwidth) for bandwidth in drawn])
+        capacity += STATE['capacities'][frequency][codes]
+
+    return {
+        'demand_mbps_km2': demand,
+        'capacity_mbps_km2': capacity,
+        'margin_mbps_km2': capacity - demand,
+    }
+
+
+def summarise_results(path, sectors, draws, percentiles=PERCENTILES,
+    memory=PERCENTILE_MEMORY):
+    """
+    Return the mean, minimum, maximum and exact percentiles of each metric
+    for every sector, from the results written by run_monte_carlo.
+
+    Sectors are summarised in blocks, reading the results once for each
+    block, so that at most memory bytes of results are held at once.
+
+    """
+    count = len(sectors)
+    block = max(1, int(memory // (draws * len(METRICS) * 8)))
+
+    summaries = {metric: [] for metric in METRICS}
+
+    for start in range(0, count, block):
+
+        end = min(start + block, count)
+        values = {metric: np.empty((draws, end - start)) for metric in METRICS}
+
+        offset = 0
+        for batch in pq.ParquetFile(path).iter_batches(columns=METRICS):
+            rows = np.arange(offset, offset + batch.num_rows)
+            offset += batch.num_rows
+            selected = (rows % count >= start) & (rows % count < end)
+            rows = rows[selected]
+            for metric in METRICS:
+                column = batch.column(metric).to_numpy(zero_copy_only=False)
+                values[metric][rows // count, rows % count - start] = (
+                    column[selected])
+
+        for metric in METRICS:
+            summaries[metric].append(np.vstack([
+                values[metric].mean(axis=0),
+                values[metric].min(axis=0),
+                values[metric].max(axis=0),
+                np.percentile(values[metric], percentiles, axis=0),
+            ]))
+
+    output = []
+
+    for metric in METRICS:
+
+        summary = np.hstack(summaries[metric])
+
+        frame = pd.DataFrame({
+            'lad': sectors['lad'].to_numpy(),
+            'id': sectors['id'].to_numpy(),
+            'metric': metric,
+            'draws': draws,
+            'mean': summary[0],
+            'min': summary[1],
+            'max': summary[2],
+        })
+        for i, percentile in enumerate(percentiles):
+            frame['p{}'.format(percentile)] = summary[3 + i]
+
+        output.append(frame)
+
+    return pd.concat(output, ignore_index=True)
+
+
+def results_to_table(sectors, draws, results):
+    """
+    Convert a batch of results to an Arrow table, with one row per draw
+    and sector.
+
+    """
+    count = len(draws)
+
+    columns = {
+        'draw': np.repeat(draws['draw'].to_numpy(), len(sectors)),
+        'lad': np.tile(sectors['lad'].to_numpy(dtype=str), count),
+        'id': np.tile(sectors['id'].to_numpy(dtype=str), count),
+    }
+    for metric in METRICS:
+        columns[metric] = results[metric].ravel()
+
+    return pa.table(columns)
+
+
+def run_monte_carlo(sectors, capacity_lookup_table, draws, directory,
+    distributions=DISTRIBUTIONS, frequencies=FREQUENCIES, batch_size=BATCH_SIZE,
+    workers=None, seed=SEED, percentiles=PERCENTILES):
+    """
+    Evaluate sampled scenarios for every sector, writing the parameters of
+    each draw (draws.parquet), the results of every draw and sector
+    (results.parquet) and the percentiles of each sector
+    (percentiles.parquet) to directory.
+
+    At most two batches per worker are held in memory at once. Returns
+    the percentiles.
+
+    """
+    workers = workers or os.cpu_count() or 1
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    parameters = sample_parameters(distributions, draws, seed)
+    parameters.to_parquet(os.path.join(directory, 'draws.parquet'), index=False)
+
+    bandwidths = bandwidth_choices(distributions, frequencies)
+    batches = [
+        parameters.iloc[start:start + batch_size]
+        for start in range(0, draws, batch_size)
+    ]
+
+    path = os.path.join(directory, 'results.parquet')
+    writer = None
+
+    def collect(batch, results):
+        nonlocal writer
+        table = results_to_table(sectors, batch, results)
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+
+    try:
+        if workers == 1:
+            init_worker(sectors, capacity_lookup_table, bandwidths)
+            for batch in batches:
+                collect(batch, evaluate_draws(batch))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                initargs=(sectors, capacity_lookup_table, bandwidths)) as executor:
+                pending = deque()
+                for batch in batches:
+                    pending.append((batch, executor.submit(evaluate_draws, batch)))
+                    if len(pending) >= 2 * workers:
+                        batch, future = pending.popleft()
+                        collect(batch, future.result())
+                while pending:
+                    batch, future = pending.popleft()
+                    collect(batch, future.result())
+    finally:
+        if writer is not None:
+            writer.close()
+
+    summary = summarise_results(path, sectors, draws, percentiles)
+    summary.to_parquet(os.path.join(directory, 'percentiles.parquet'), index=False)
+
+    return summary
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Monte Carlo scenarios of capacity margins.')
+    parser.add_argument('--draws', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--output', default=os.path.join(
+        DATA_PROCESSED, 'montecarlo'))
+    args = parser.parse_args()
+
+    print('Loading postcode sectors')
+    postcode_sectors = read_shapes(
+        os.path.join(DATA_PROCESSED, 'postcode_sectors.shp'))
+
+    print('Loading processed sites')
+    sites = read_shapes(os.path.join(DATA_PROCESSED, 'processed_sites.shp'))
+
+    sectors = sectors_to_frame(postcode_sectors, sites)
+
+    print('Loading capacity lookup table')
+    path = os.path.join(DATA_RAW, 'capacity_lut_by_frequency_10.csv')
+    capacity_lookup_table = load_capacity_lookup_table(path)
+
+    print('Running {} draws'.format(args.draws))
+    run_monte_carlo(sectors, capacity_lookup_table, args.draws, args.output,
+        batch_size=args.batch_size, workers=args.workers, seed=args.seed)
@@ -0,0 +1,266 @@
+"""
+Area-weighted overlay of postcode sectors and LADs.
+
+Written by Ed Oughton
+
+add_lad_to_postcode_sector assigns each postcode sector to the LAD
+containing its centroid, so the population of sectors spanning a LAD
+boundary all goes to one LAD, and coastal sectors whose centroid falls
+outside every LAD are dropped.
+
+The overlay instead splits each sector into its pieces within each LAD,
+with the share of the sector's area in each piece. Population weights are
+then apportioned by this share (see add_weights_to_postcode_sector).
+Sectors which miss every LAD are assigned whole to the nearest LAD.
+
+The same overlay gives the population of other areas, such as exchange
+catchments, from the postcode sector populations.
+
+Intersections are found in bulk with an rtree index and prepared
+geometries, in chunks which can be processed across a pool of processes,
+with geometries passed to the workers as WKB.
+
+"""
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from shapely import wkb
+from shapely.geometry import shape, mapping, MultiPolygon
+from shapely.prepared import prep
+
+from rtree import index
+
+CHUNK_SIZE = 1000
+
+#The number of LADs (by bounding box distance) checked for the nearest LAD
+NEAREST_CANDIDATES = 10
+
+
+def polygonal(geometry):
+    """
+    Return only the polygonal parts of an intersection, dropping any lines
+    or points where two polygons just touch.
+
+    """
+    if geometry.geom_type in ('Polygon', 'MultiPolygon'):
+        return geometry
+
+    polygons = []
+    for part in getattr(geometry, 'geoms', []):
+        if part.geom_type == 'Polygon':
+            polygons.append(part)
+        elif part.geom_type == 'MultiPolygon':
+            polygons.extend(part.geoms)
+
+    return MultiPolygon(polygons)
+
+
+def intersect_chunk(chunk):
+    """
+    Intersect a chunk of left geometries with their candidate right
+    geometries, returning (left id, right id, piece WKB, piece area) for
+    each piece with a non-zero area.
+
+    Pieces wholly within a right geometry are not intersected, and are
+    returned as the left geometry itself.
+
+    """
+    right = {j: wkb.loads(geometry) for j, geometry in chunk['right'].items()}
+    prepared = {j: prep(geometry) for j, geometry in right.items()}
+
+    output = []
+
+    for i, geometry, candidates in chunk['left']:
+
+        left = wkb.loads(geometry)
+
+        for j in candidates:
+            if prepared[j].contains(left):
+                output.append((i, j, geometry, left.area))
+            elif prepared[j].intersects(left):
+                piece = polygonal(left.intersection(right[j]))
+                if piece.area > 0:
+                    output.append((i, j, piece.wkb, piece.area))
+
+    return output
+
+
+def intersect_features(left, right, workers=1, chunk_size=CHUNK_SIZE):
+    """
+    Intersect two lists of polygon features, returning
+    (left position, right position, piece geometry, piece area) for each
+    overlapping pair, in left then right order.
+
+    """
+    left_shapes = [shape(feature['geometry']) for feature in left]
+    right_wkb = [shape(feature['geometry']).wkb for feature in right]
+
+    idx = index.Index(
+        (j, shape(feature['geometry']).bounds, None)
+        for j, feature in enumerate(right)
+    )
+
+    chunks = []
+
+    for start in range(0, len(left_shapes), chunk_size):
+        items = []
+        candidates_in_chunk = set()
+        for i in range(start, min(start + chunk_size, len(left_shapes))):
+            candidates = sorted(idx.intersection(left_shapes[i].bounds))
+            candidates_in_chunk.update(candidates)
+            items.append((i, left_shapes[i].wkb, candidates))
+        chunks.append({
+            'left': items,
+            'right': {j: right_wkb[j] for j in candidates_in_chunk},
+        })
+
+    if workers == 1:
+        results = [intersect_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(intersect_chunk, chunks))
+
+    return [
+        (i, j, wkb.loads(geometry), area)
+        for result in results for i, j, geometry, area in result
+    ]
+
+
+def nearest_feature(geometry, features, idx):
+    """
+    Return the position of the feature nearest to a geometry, checking
+    the features with the nearest bounding boxes.
+
+    """
+    candidates = list(idx.nearest(geometry.bounds, NEAREST_CANDIDATES))
+
+    return min(candidates,
+        key=lambda j: (shape(features[j]['geometry']).distance(geometry), j))
+
+
+def overlay_postcode_sectors(postcode_sectors, lads, workers=None,
+    chunk_size=CHUNK_SIZE, min_share=0):
+    """
+    Split postcode sectors into their pieces within each LAD, returning
+    features in the same form as add_lad_to_postcode_sector with the
+    share of the sector's area in each piece as 'area_share'.
+
+    Shares are normalised over the LADs each sector overlaps, so the part
+    of a sector outside every LAD (e.g. in the sea) is apportioned to the
+    LADs it does overlap. Pieces with a share below min_share (slivers
+    from boundary mismatches) are dropped before normalising.
+
+    """
+    workers = workers or os.cpu_count() or 1
+
+    pieces = {}
+    for i, j, geometry, area in intersect_features(
+        postcode_sectors, lads, workers, chunk_size):
+        pieces.setdefault(i, []).append((j, geometry, area))
+
+    idx = None
+    output = []
+
+    for i, postcode_sector in enumerate(postcode_sectors):
+
+        sector_shape = shape(postcode_sector['geometry'])
+        sector_pieces = pieces.get(i, [])
+
+        if len(sector_pieces) > 0:
+            total = sum(area for j, geometry, area in sector_pieces)
+            sector_pieces = [
+                (j, geometry, area) for j, geometry, area in sector_pieces
+                if area / total >= min_share
+            ]
+
+        if len(sector_pieces) == 0:
+            if idx is None:
+                idx = index.Index(
+                    (j, shape(lad['geometry']).bounds, None)
+                    for j, lad in enumerate(lads)
+                )
+            j = nearest_feature(sector_shape, lads, idx)
+            sector_pieces = [(j, sector_shape, sector_shape.area)]
+
+        total = sum(area for j, geometry, area in sector_pieces)
+
+        for j, geometry, area in sector_pieces:
+            output.append({
+                'type': 'Feature',
+                'geometry': mapping(geometry),
+                'properties': {
+                    'id': postcode_sector['properties']['RMSect'],
+                    'lad': lads[j]['properties']['name'],
+                    'area': area,
+                    'area_share': area / total,
+                },
+            })
+
+    return output
+
+
+def piece_positions(sites, postcode_sectors):
+    """
+    Return the position of the postcode sector containing each site (which
+    has the sector 'id' from add_coverage_to_sites), or None if the
+    sector is missing.
+
+    Where a sector is split into pieces between LADs, the site is given
+    the first piece it intersects. Geometries are only read for sectors
+    with several pieces.
+
+    """
+    pieces = {}
+    for position, postcode_sector in enumerate(postcode_sectors):
+        pieces.setdefault(postcode_sector['properties']['id'], []).append(position)
+
+    prepared = {}
+    output = []
+
+    for site in sites:
+        candidates = pieces.get(site['properties']['id'], [None])
+
+        position = candidates[0]
+        if len(candidates) > 1:
+            point = shape(site['geometry'])
+            for candidate in candidates:
+                if candidate not in prepared:
+                    prepared[candidate] = prep(
+                        shape(postcode_sectors[candidate]['geometry']))
+                if prepared[candidate].intersects(point):
+                    position = candidate
+                    break
+
+        output.append(position)
+
+    return output
+
+
+def catchment_population(postcode_sectors, areas, key, workers=None,
+    chunk_size=CHUNK_SIZE):
+    """
+    Sum the population of the postcode sectors within each area (such as
+    exchange areas), apportioning sectors split between areas by area.
+
+    As in overlay_postcode_sectors, shares are normalised over the areas
+    each sector overlaps, so no population is lost at the coast. Returns
+    a dict of population by key(area).
+
+    """
+    workers = workers or os.cpu_count() or 1
+
+    pieces = {}
+    for i, j, geometry, area in intersect_features(
+        postcode_sectors, areas, workers, chunk_size):
+        pieces.setdefault(i, []).append((j, area))
+
+    output = {key(area): 0 for area in areas}
+
+    for i, sector_pieces in pieces.items():
+        population = postcode_sectors[i]['properties']['population']
+        total = sum(area for j, area in sector_pieces)
+        for j, area in sector_pieces:
+            output[key(areas[j])] += population * area / total
+
+    return output
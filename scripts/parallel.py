@@ -0,0 +1,155 @@
+"""
+Partitioned preprocessing by Local Authority District (LAD).
+
+Written by Ed Oughton
+
+After postcode sectors have been assigned to LADs, the weights, population
+shares, 4G coverage allocation and site coverage stages only depend on
+the sectors and sites within each LAD. These functions shard the data by
+LAD and process the shards across a pool of processes.
+
+Geometries are passed to and from the workers as WKB, which is much
+cheaper to pickle than nested coordinate lists. Each shard holds one LAD,
+and results are merged in LAD order, so the output does not depend on
+the number of workers.
+
+"""
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from shapely import wkb
+from shapely.geometry import shape, mapping
+
+from rtree import index
+
+from scripts.preprocess import (add_weights_to_postcode_sector,
+    calculate_lad_population, allocate_4G_coverage, add_coverage_to_sites)
+
+
+def features_to_wkb(features):
+    """
+    Encode the geometry of each feature as WKB.
+
+    """
+    return [
+        (shape(feature['geometry']).wkb, dict(feature['properties']))
+        for feature in features
+    ]
+
+
+def wkb_to_features(records):
+    """
+    Decode WKB encoded features back to GeoJSON-like features.
+
+    """
+    return [
+        {
+            'type': 'Feature',
+            'geometry': mapping(wkb.loads(geometry)),
+            'properties': properties,
+        }
+        for geometry, properties in records
+    ]
+
+
+def shard_by_lad(postcode_sectors, weights, sites, lad_ids):
+    """
+    Split postcode sectors, weights and sites into one shard per LAD.
+
+    Sites are added to each shard whose sectors' bounding box they fall
+    within, so sites on a LAD boundary may be in more than one shard.
+
+    """
+    sectors_by_lad = {lad_id: [] for lad_id in lad_ids}
+    for postcode_sector in postcode_sectors:
+        lad_id = postcode_sector['properties']['lad']
+        if lad_id in sectors_by_lad:
+            sectors_by_lad[lad_id].append(postcode_sector)
+
+    weights_by_id = {}
+    for weight in weights:
+        weights_by_id.setdefault(weight['id'].replace(' ', ''), []).append(weight)
+
+    idx = index.Index()
+    for i, site in enumerate(sites):
+        idx.insert(i, shape(site['geometry']).bounds)
+
+    shards = []
+
+    for lad_id in lad_ids:
+
+        sectors = sectors_by_lad[lad_id]
+        if len(sectors) == 0:
+            continue
+
+        lad_weights = []
+        site_ids = set()
+
+        for postcode_sector in sectors:
+            pcd_id = postcode_sector['properties']['id'].replace(' ', '')
+            lad_weights.extend(weights_by_id.get(pcd_id, []))
+            site_ids.update(
+                idx.intersection(shape(postcode_sector['geometry']).bounds))
+
+        shards.append({
+            'lad': lad_id,
+            'postcode_sectors': features_to_wkb(sectors),
+            'weights': lad_weights,
+            'sites': features_to_wkb([sites[i] for i in sorted(site_ids)]),
+        })
+
+    return shards
+
+
+def process_lad_shard(shard):
+    """
+    Run the per-LAD preprocessing stages for a single shard.
+
+    """
+    postcode_sectors = wkb_to_features(shard['postcode_sectors'])
+    sites = wkb_to_features(shard['sites'])
+
+    postcode_sectors = add_weights_to_postcode_sector(
+        postcode_sectors, shard['weights'])
+
+    postcode_sectors = calculate_lad_population(postcode_sectors)
+
+    postcode_sectors = allocate_4G_coverage(postcode_sectors, [shard['lad']])
+
+    if len(sites) > 0 and len(postcode_sectors) > 0:
+        processed_sites = add_coverage_to_sites(sites, postcode_sectors)
+    else:
+        processed_sites = []
+
+    return features_to_wkb(postcode_sectors), features_to_wkb(processed_sites)
+
+
+def process_by_lad(postcode_sectors, weights, sites, lad_ids, workers=None):
+    """
+    Add weights, population and 4G coverage to postcode sectors, and
+    coverage to sites, processing each LAD in parallel.
+
+    Returns the postcode sectors and sites in the same form as
+    allocate_4G_coverage and add_coverage_to_sites.
+
+    """
+    workers = workers or os.cpu_count() or 1
+
+    shards = shard_by_lad(postcode_sectors, weights, sites, list(lad_ids))
+
+    if workers == 1:
+        results = [process_lad_shard(shard) for shard in shards]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(process_lad_shard, shards,
+                chunksize=max(1, len(shards) // (workers * 4))))
+
+    output_sectors = []
+    output_sites = []
+
+    for sectors, processed_sites in results:
+        output_sectors.extend(wkb_to_features(sectors))
+        output_sites.extend(wkb_to_features(processed_sites))
+
+    return output_sectors, output_sites
@@ -0,0 +1,902 @@
+"""
+Staged pipeline runner for preprocess.py.
+
+Written by Ed Oughton
+
+Each step of the preprocessing is defined as a named stage, along with
+the datasets it reads from earlier stages and the raw files it depends
+on. After a stage has run, its outputs are checkpointed to (Geo)Parquet.
+
+Each stage is given a key by hashing the contents of its raw files, the
+keys of its input datasets and the source code of the stage function and
+of every function of this package it calls.
+When the pipeline is rerun, stages with an unchanged key are skipped and
+their outputs are only read back from the checkpoint if a later stage
+needs them.
+
+Usage:
+
+    python -m scripts.pipeline
+    python -m scripts.pipeline --from-stage links
+    python -m scripts.pipeline --only-stage coverage_4G
+    python -m scripts.pipeline --workers 8
+    python -m scripts.pipeline --lads E06000001 E06000002
+    python -m scripts.pipeline --bbox 420000 420000 470000 480000
+    python -m scripts.pipeline --simplify 10
+    python -m scripts.pipeline --overlay --workers 8
+    python -m scripts.pipeline --exchange-areas
+    python -m scripts.pipeline --road-network data/raw/roads/great-britain-latest.osm.pbf
+    python -m scripts.pipeline --road-network roads.osm.pbf --route-paths
+    python -m scripts.pipeline --operators
+
+With more than one worker, the per-LAD stages (weights, population, 4G
+coverage and site coverage) are replaced by a single lad_partitions stage,
+which processes each LAD in parallel (see parallel.py).
+
+A run can be limited to a region, given as a list of LAD ids or a bbox
+in British National Grid coordinates. Only the LADs selected, and the
+postcode sectors within their extent, are read from the raw shapefiles.
+Region filters are part of the stage keys, so a regional run does not
+reuse the checkpoints of a national run (use a separate --checkpoints
+directory to keep both).
+
+With --operators, the sites of all four mobile operators are read and
+clustered per operator in the same pass, and a coverage_table stage
+allocates every 2G, 3G and 4G coverage column of the Ofcom data to the
+postcode sectors, with the number of sites of each operator in each.
+
+The raw files (LADs, postcode sectors, weights, Sitefinder, exchanges)
+do not depend on each other, so by default they are all read
+concurrently at the start of a run (see run_pipeline), and --prefetch 0
+reads each when its stage is reached.
+
+"""
+import os
+import argparse
+import hashlib
+import inspect
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from scripts.cache import (read_json, write_json, file_hash, cached_file_hash,
+    combine_hashes)
+from scripts.geoparquet import (read_features, write_features,
+    write_partitioned_features)
+from scripts.instrument import stage_timer, count_records
+from scripts.overlay import overlay_postcode_sectors, piece_positions
+from scripts.parallel import process_by_lad
+from scripts.routing import read_road_network, build_road_network, generate_link_routed
+from scripts.simplify import cached_boundaries
+from scripts.spatial_index import INDEX_DIRECTORY, cached_feature_index
+from scripts.preprocess import (read_lads, lad_lut, features_bbox,
+    read_postcode_sectors,
+    add_lad_to_postcode_sector, load_in_weights, add_weights_to_postcode_sector,
+    calculate_lad_population, allocate_4G_coverage, import_sitefinder_data,
+    process_asset_data, add_coverage_to_sites, load_coverage_table,
+    allocate_coverage_table, count_sites_by_operator, read_exchanges,
+    read_exchange_areas, assign_exchange_areas, generate_link_straight_line,
+    write_shapefile, SITE_BUFFER)
+from scripts.config import BASE_PATH
+
+DATA_RAW = os.path.join(BASE_PATH, 'raw')
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
+
+CHECKPOINTS = os.path.join(DATA_INTERMEDIATE, 'checkpoints')
+
+CRS = 'epsg:27700'
+
+LAD_PATH = os.path.join(DATA_RAW, 'shapes', 'lad_uk_2016-12.shp')
+POSTCODE_SECTOR_PATH = os.path.join(DATA_RAW, 'shapes', 'PostalSector.shp')
+SITEFINDER_PATH = os.path.join(DATA_RAW, 'sitefinder', 'sitefinder.csv')
+COVERAGE_PATH = os.path.join(DATA_RAW, 'ofcom_2018', '201809_mobile_laua_r02.csv')
+EXCHANGES_PATH = os.path.join(DATA_RAW, 'exchanges', 'final_exchange_pcds.csv')
+EXCHANGE_AREAS_PATH = os.path.join(
+    DATA_RAW, 'exchanges', '_exchange_areas_fixed.shp')
+
+
+#####################################
+# stage functions
+#####################################
+
+def load_lads(lad_ids=None, bbox=None):
+    """
+    Load the LAD shapes, optionally only those in a region.
+
+    """
+    return read_lads(lad_ids=lad_ids, bbox=bbox, properties=['name'])
+
+
+def load_postcode_sectors(lads=None):
+    """
+    Load the postcode sector shapes, only those within the extent of the
+    LADs if given.
+
+    """
+    bbox = None if lads is None else features_bbox(lads)
+
+    return read_postcode_sectors(POSTCODE_SECTOR_PATH, bbox=bbox,
+        properties=['RMSect'])
+
+
+def source_key(path, features, properties):
+    """
+    Key features read from a source file on the hash of the file and the
+    given properties of each feature, in order, which identify the
+    features selected by any filters applied when reading it without
+    decoding their geometries.
+
+    """
+    return combine_hashes(cached_file_hash(path, INDEX_DIRECTORY), *[
+        repr([feature['properties'].get(p) for p in properties])
+        for feature in features
+    ])
+
+
+def assign_lads(postcode_sectors, lads, tolerance=None):
+    """
+    Add the LAD to each postcode sector, using a cached LAD index keyed
+    on the LAD file and the LADs selected from it, and cached simplified
+    LAD boundaries if a tolerance is given.
+
+    """
+    source_hash = source_key(LAD_PATH, lads, ['name'])
+    idx = cached_feature_index('lads', lads, source_hash)
+
+    simplified = None
+    if tolerance is not None:
+        simplified = cached_boundaries('lads', lads, tolerance, source_hash)
+
+    return add_lad_to_postcode_sector(postcode_sectors, lads, idx, simplified)
+
+
+def overlay_lads(postcode_sectors, lads, workers=None):
+    """
+    Split each postcode sector between the LADs it overlaps, by area.
+
+    """
+    return overlay_postcode_sectors(postcode_sectors, lads, workers=workers)
+
+
+def allocate_coverage(postcode_sectors, lads):
+    """
+    Disaggregate 4G coverage to the postcode sectors in each LAD.
+
+    """
+    return allocate_4G_coverage(postcode_sectors, lad_lut(lads))
+
+
+def load_sitefinder(operators=('O2', 'Vodafone')):
+    """
+    Import the sitefinder data, for all mobile operators if operators is
+    None.
+
+    """
+    return import_sitefinder_data(SITEFINDER_PATH, operators)
+
+
+def add_site_coverage(sites, postcode_sectors, tolerance=None):
+    """
+    Add 4G coverage to each processed site, using a cached site index
+    keyed on the sitefinder file, buffer and the sites clustered from it,
+    and cached simplified postcode sector boundaries if a tolerance is
+    given.
+
+    """
+    source_hash = combine_hashes(SITE_BUFFER,
+        source_key(SITEFINDER_PATH, sites, ['name', 'operator']))
+    idx = cached_feature_index('sites', sites, source_hash)
+
+    simplified = None
+    if tolerance is not None:
+        source_hash = source_key(POSTCODE_SECTOR_PATH, postcode_sectors,
+            ['id', 'lad', 'area_km2'])
+        simplified = cached_boundaries(
+            'postcode_sectors', postcode_sectors, tolerance, source_hash)
+
+    return add_coverage_to_sites(sites, postcode_sectors, idx, simplified)
+
+
+def coverage_table(postcode_sectors, lads, sites):
+    """
+    Allocate every coverage column of the Ofcom data to the postcode
+    sectors, with the number of sites of each operator in each sector.
+
+    """
+    columns, coverage = load_coverage_table(COVERAGE_PATH)
+
+    site_counts = count_sites_by_operator(sites, postcode_sectors)
+
+    return allocate_coverage_table(postcode_sectors, lad_lut(lads), columns,
+        coverage, site_counts)
+
+
+def process_lads(postcode_sectors, weights, sites, lads, workers=None):
+    """
+    Add weights, population and 4G coverage to postcode sectors, and
+    coverage to sites, processing each LAD in parallel.
+
+    """
+    return process_by_lad(postcode_sectors, weights, sites, lad_lut(lads),
+        workers=workers)
+
+
+def load_exchanges():
+    """
+    Read in all exchanges.
+
+    """
+    return list(read_exchanges())
+
+
+def load_exchange_areas():
+    """
+    Read in all exchange area polygons.
+
+    """
+    return list(read_exchange_areas(properties=['id']))
+
+
+def generate_links(sites, exchanges, exchange_areas=None):
+    """
+    Link each site to the exchange whose area it falls within if exchange
+    areas are given, or else the nearest exchange, using a cached
+    exchange index.
+
+    """
+    idx = cached_feature_index('exchanges', exchanges,
+        cached_file_hash(EXCHANGES_PATH, INDEX_DIRECTORY))
+
+    assigned = None
+    if exchange_areas is not None:
+        assigned = assign_exchange_areas(sites, exchange_areas, exchanges)
+
+    return generate_link_straight_line(sites, exchanges, idx, assigned)
+
+
+def route_links(sites, exchanges, path=None, paths=False):
+    """
+    Link each site to the nearest exchange by road, using the road
+    network at path, with straight line links for sites with no route.
+    Links follow the road path with paths, or else are drawn straight.
+
+    """
+    network = build_road_network(read_road_network(path))
+
+    idx = cached_feature_index('exchanges', exchanges,
+        cached_file_hash(EXCHANGES_PATH, INDEX_DIRECTORY))
+
+    return generate_link_routed(sites, exchanges, network, idx, paths)
+
+
+def write_outputs(postcode_sectors, processed_sites, backhaul_links):
+    """
+    Write the final outputs to shapefile.
+
+    """
+    write_shapefile(postcode_sectors, DATA_PROCESSED, 'postcode_sectors.shp', CRS)
+    write_shapefile(processed_sites, DATA_PROCESSED, 'processed_sites.shp', CRS)
+    write_shapefile(backhaul_links, DATA_PROCESSED, 'backhaul_links.shp', CRS)
+
+
+def write_partitioned_outputs(postcode_sectors, processed_sites, backhaul_links):
+    """
+    Write the final outputs to GeoParquet, with row groups for each LAD.
+
+    Sites are given the LAD of their postcode sector (or of the piece of
+    the sector containing them, where a sector is split between LADs),
+    and links that of their site.
+
+    """
+    processed_sites = [
+        dict(site, properties=dict(site['properties'],
+            lad=None if position is None else
+                postcode_sectors[position]['properties']['lad']))
+        for site, position in zip(processed_sites,
+            piece_positions(processed_sites, postcode_sectors))
+    ]
+
+    site_lads = {
+        site['properties']['name']: site['properties']['lad']
+        for site in processed_sites
+    }
+
+    backhaul_links = [
+        dict(link, properties=dict(link['properties'],
+            lad=site_lads.get(link['properties']['origin_id'])))
+        for link in backhaul_links
+    ]
+
+    for name, data in [
+        ('postcode_sectors', postcode_sectors),
+        ('processed_sites', processed_sites),
+        ('backhaul_links', backhaul_links)]:
+        write_partitioned_features(data,
+            os.path.join(DATA_PROCESSED, '{}.parquet'.format(name)), ['lad'], CRS)
+
+
+STAGES = [
+    {
+        'name': 'lads',
+        'function': load_lads,
+        'inputs': [],
+        'files': [LAD_PATH],
+        'outputs': ['lads'],
+    },
+    {
+        'name': 'postcode_sectors',
+        'function': load_postcode_sectors,
+        'inputs': [],
+        'files': [POSTCODE_SECTOR_PATH],
+        'outputs': ['postcode_sectors'],
+    },
+    {
+        'name': 'lad_assignment',
+        'function': assign_lads,
+        'inputs': ['postcode_sectors', 'lads'],
+        'files': [],
+        'outputs': ['sectors_lad'],
+    },
+    {
+        'name': 'weights',
+        'function': load_in_weights,
+        'inputs': [],
+        'files': [os.path.join(
+            DATA_RAW, 'pcd_sector_weights', 'population_weights.csv')],
+        'outputs': ['weights'],
+    },
+    {
+        'name': 'sector_weights',
+        'function': add_weights_to_postcode_sector,
+        'inputs': ['sectors_lad', 'weights'],
+        'files': [],
+        'outputs': ['sectors_weighted'],
+    },
+    {
+        'name': 'population',
+        'function': calculate_lad_population,
+        'inputs': ['sectors_weighted'],
+        'files': [],
+        'outputs': ['sectors_population'],
+    },
+    {
+        'name': 'coverage_4G',
+        'function': allocate_coverage,
+        'inputs': ['sectors_population', 'lads'],
+        'files': [COVERAGE_PATH],
+        'outputs': ['sectors_coverage'],
+    },
+    {
+        'name': 'sitefinder',
+        'function': load_sitefinder,
+        'inputs': [],
+        'files': [SITEFINDER_PATH],
+        'outputs': ['sitefinder'],
+    },
+    {
+        'name': 'buffering',
+        'function': process_asset_data,
+        'inputs': ['sitefinder'],
+        'files': [],
+        'outputs': ['sites'],
+    },
+    {
+        'name': 'site_coverage',
+        'function': add_site_coverage,
+        'inputs': ['sites', 'sectors_coverage'],
+        'files': [],
+        'outputs': ['sites_coverage'],
+    },
+    {
+        'name': 'exchanges',
+        'function': load_exchanges,
+        'inputs': [],
+        'files': [EXCHANGES_PATH],
+        'outputs': ['exchanges'],
+    },
+    {
+        'name': 'links',
+        'function': generate_links,
+        'inputs': ['sites_coverage', 'exchanges'],
+        'files': [],
+        'outputs': ['processed_sites', 'backhaul_links'],
+    },
+    {
+        'name': 'write',
+        'function': write_outputs,
+        'inputs': ['sectors_coverage', 'processed_sites', 'backhaul_links'],
+        'files': [],
+        'outputs': [],
+    },
+]
+
+
+PARTITIONED_STAGES = ['sector_weights', 'population', 'coverage_4G', 'site_coverage']
+
+
+def regional_stages(stages, lad_ids=None, bbox=None):
+    """
+    Return the stages limited to a region, by passing the region filters
+    to the lads stage and reading postcode sectors within the LADs.
+
+    """
+    output = []
+
+    for stage in stages:
+        if stage['name'] == 'lads':
+            stage = dict(stage, parameters={
+                'lad_ids': None if lad_ids is None else sorted(lad_ids),
+                'bbox': None if bbox is None else list(bbox),
+            })
+        elif stage['name'] == 'postcode_sectors':
+            stage = dict(stage, inputs=['lads'])
+        output.append(stage)
+
+    return output
+
+
+SIMPLIFIED_STAGES = ['lad_assignment', 'site_coverage']
+
+
+def exchange_area_stages(stages):
+    """
+    Return the stages with sites linked to the exchange whose area they
+    fall within, rather than the nearest exchange.
+
+    """
+    output = []
+
+    for stage in stages:
+        if stage['name'] == 'links':
+            stage = dict(stage, inputs=stage['inputs'] + ['exchange_areas'])
+        output.append(stage)
+        if stage['name'] == 'exchanges':
+            output.append({
+                'name': 'exchange_areas',
+                'function': load_exchange_areas,
+                'inputs': [],
+                'files': [EXCHANGE_AREAS_PATH],
+                'outputs': ['exchange_areas'],
+            })
+
+    return output
+
+
+def operator_stages(stages):
+    """
+    Return the stages with the sites of every mobile operator, clustered
+    per operator, and a coverage table of every generation.
+
+    """
+    output = []
+
+    for stage in stages:
+        if stage['name'] == 'sitefinder':
+            stage = dict(stage, parameters={'operators': None})
+        elif stage['name'] == 'buffering':
+            stage = dict(stage, parameters={'by_operator': True})
+        output.append(stage)
+        if stage['name'] == 'site_coverage':
+            output.append({
+                'name': 'coverage_table',
+                'function': coverage_table,
+                'inputs': ['sectors_coverage', 'lads', 'sites_coverage'],
+                'files': [COVERAGE_PATH],
+                'outputs': ['sector_coverage_table'],
+            })
+
+    return output
+
+
+def build_stages(workers=1, lad_ids=None, bbox=None, tolerance=None,
+    overlay=False, exchange_areas=False, road_network=None, operators=False,
+    output_format='shapefile', route_paths=False):
+    """
+    Return the pipeline stages, limited to a region if LAD ids or a bbox
+    are given, using simplified boundaries if a tolerance is given, and
+    replacing the per-LAD stages with a single parallel stage when more
+    than one worker is used.
+
+    With overlay, postcode sectors are split between LADs by area rather
+    than assigned to the LAD containing their centroid. With
+    exchange_areas, sites are linked to the exchange whose area they fall
+    within, or with the path to a road_network file, to the nearest
+    exchange by road (drawing each link along its road path with
+    route_paths). With operators, the sites of every mobile operator
+    are processed, and a table of every coverage column is added. With
+    an output_format of 'geoparquet', the outputs are written with
+    write_partitioned_outputs rather than to shapefile.
+
+    """
+    stages = STAGES
+
+    if lad_ids is not None or bbox is not None:
+        stages = regional_stages(stages, lad_ids, bbox)
+
+    if tolerance is not None:
+        stages = [
+            dict(stage, function=partial(stage['function'], tolerance=tolerance))
+            if stage['name'] in SIMPLIFIED_STAGES else stage
+            for stage in stages
+        ]
+
+    if exchange_areas:
+        stages = exchange_area_stages(stages)
+
+    if operators:
+        stages = operator_stages(stages)
+
+    if road_network is not None:
+        stages = [
+            dict(stage, function=partial(route_links, path=road_network),
+                files=stage['files'] + [road_network],
+                parameters={'paths': True} if route_paths else {})
+            if stage['name'] == 'links' else stage
+            for stage in stages
+        ]
+
+    if output_format == 'geoparquet':
+        stages = [
+            dict(stage, function=write_partitioned_outputs)
+            if stage['name'] == 'write' else stage
+            for stage in stages
+        ]
+
+    if overlay:
+        stages = [
+            dict(stage, function=partial(overlay_lads, workers=workers))
+            if stage['name'] == 'lad_assignment' else stage
+            for stage in stages
+        ]
+
+    if workers == 1:
+        return stages
+
+    output = []
+
+    for stage in stages:
+        if stage['name'] in PARTITIONED_STAGES:
+            continue
+        output.append(stage)
+        if stage['name'] == 'buffering':
+            output.append({
+                'name': 'lad_partitions',
+                'function': partial(process_lads, workers=workers),
+                'inputs': ['sectors_lad', 'weights', 'sites', 'lads'],
+                'files': [COVERAGE_PATH],
+                'outputs': ['sectors_coverage', 'sites_coverage'],
+            })
+
+    return output
+
+
+#####################################
+# hashing and checkpoints
+#####################################
+
+def code_names(code):
+    """
+    Return the global and attribute names used by a code object, and by
+    the code objects nested in it (such as comprehensions and lambdas).
+
+    """
+    names = set(code.co_names)
+
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            names |= code_names(constant)
+
+    return names
+
+
+def code_dependencies(function, package='scripts'):
+    """
+    Return the source of a function and of the functions of the package
+    it calls, directly or through the functions they call, along with the
+    constants they use (other than strings, such as paths, and values
+    which cannot be written as json), found from the global names in
+    their code.
+
+    Returns a dict of source code or constant values by qualified name.
+
+    """
+    output = {}
+    pending = [function]
+
+    while pending:
+
+        function = pending.pop()
+        function = getattr(function, 'func', function)
+        name = '{}.{}'.format(function.__module__, function.__qualname__)
+
+        if name in output:
+            continue
+
+        try:
+            output[name] = inspect.getsource(function)
+        except (OSError, TypeError):
+            output[name] = function.__qualname__
+
+        code = getattr(function, '__code__', None)
+        if code is None:
+            continue
+
+        names = code_names(code)
+        values = [function.__globals__[n] for n in names if n in function.__globals__]
+        #functions used as module attributes, e.g. preprocess.read_lads
+        values += [
+            getattr(value, n) for value in values if inspect.ismodule(value)
+            for n in names if hasattr(value, n)
+        ]
+
+        for value in values:
+            value = getattr(value, 'func', value)
+            if inspect.isfunction(value) and \
+                value.__module__.split('.')[0] == package:
+                pending.append(value)
+
+        for n in names:
+            value = function.__globals__.get(n)
+            if isinstance(value, (bool, int, float, tuple, list, dict)):
+                try:
+                    output['{}.{}'.format(function.__module__, n)] = json.dumps(
+                        value, sort_keys=True)
+                except TypeError:
+                    pass
+
+    return output
+
+
+def stage_key(stage, dataset_keys, hash_cache=None):
+    """
+    Generate the content key for a stage from its raw files, the keys of
+    its input datasets and the source code of the stage function and of
+    the functions of this package it calls (see code_dependencies), so
+    that a change to any of them reruns the stage.
+
+    Arguments bound with functools.partial (such as the number of
+    workers) do not change the outputs, so are not part of the key.
+    Arguments which do, such as region filters, are given as the stage's
+    'parameters' and are hashed.
+
+    """
+    hasher = hashlib.sha256()
+    hasher.update(stage['name'].encode('utf-8'))
+
+    for name, source in sorted(code_dependencies(stage['function']).items()):
+        hasher.update(name.encode('utf-8'))
+        hasher.update(source.encode('utf-8'))
+
+    for name in stage['inputs']:
+        hasher.update(dataset_keys[name].encode('utf-8'))
+
+    if stage.get('parameters'):
+        hasher.update(json.dumps(stage['parameters'], sort_keys=True).encode('utf-8'))
+
+    for path in stage['files']:
+        hasher.update(file_hash(path, hash_cache).encode('utf-8'))
+
+    return hasher.hexdigest()
+
+
+def checkpoint_path(directory, dataset):
+    """
+    Return the checkpoint path for a dataset.
+
+    """
+    return os.path.join(directory, '{}.parquet'.format(dataset))
+
+
+#####################################
+# pipeline runner
+#####################################
+
+def run_source_stage(stage):
+    """
+    Run a stage with no inputs, such as reading a raw file, returning its
+    outputs as lists so they can be handed back from a prefetch thread.
+
+    """
+    result = stage['function'](**stage.get('parameters', {}))
+
+    if len(stage['outputs']) == 1:
+        return list(result)
+
+    return tuple(list(data) for data in result)
+
+
+def run_pipeline(stages, directory, from_stage=None, only_stage=None,
+    log_path=None, profile=None, prefetch=0):
+    """
+    Run the pipeline stages in order, checkpointing outputs to directory.
+
+    By default, stages whose key matches the last run are skipped. With
+    from_stage, earlier stages are read from their checkpoints and that
+    stage and all later stages are rerun. With only_stage, just that stage
+    is rerun, reading its inputs from checkpoints.
+
+    With prefetch workers, the stages with no inputs (which read the raw
+    files) are all started at once in a pool of threads. Each stage picks
+    up its prefetched outputs when it is reached, while later reads
+    continue in the background.
+
+    Each stage that runs is timed with instrument.stage_timer, and its
+    record written to log_path, optionally profiled with profile. The
+    record of a prefetched stage times the wait for its outputs.
+
+    """
+    names = [stage['name'] for stage in stages]
+
+    for name in [from_stage, only_stage]:
+        if name is not None and name not in names:
+            raise KeyError('Unknown stage {}, choose from: {}'.format(
+                name, ', '.join(names)))
+
+    manifest_path = os.path.join(directory, 'manifest.json')
+    hash_cache_path = os.path.join(directory, 'file_hashes.json')
+
+    manifest = read_json(manifest_path)
+    hash_cache = read_json(hash_cache_path)
+
+    dataset_keys = {}
+    datasets = {}
+
+    def load(dataset):
+        if dataset not in datasets:
+            path = checkpoint_path(directory, dataset)
+            if not os.path.exists(path):
+                raise FileNotFoundError(
+                    'No checkpoint for {}, run the earlier stages first'.format(
+                    dataset))
+            print('Reading checkpoint {}'.format(dataset))
+            datasets[dataset] = read_features(path)
+        return datasets[dataset]
+
+    def selected(position, stage):
+        if only_stage is not None:
+            return stage['name'] == only_stage
+        if from_stage is not None:
+            return position >= names.index(from_stage)
+        return True
+
+    def up_to_date(stage, key):
+        complete = all(os.path.exists(checkpoint_path(directory, output))
+            for output in stage['outputs'])
+        return only_stage is None and from_stage is None and \
+            manifest.get(stage['name']) == key and complete
+
+    futures = {}
+    executor = None
+
+    if prefetch > 0:
+        for position, stage in enumerate(stages):
+            if stage['inputs'] or not selected(position, stage):
+                continue
+            if up_to_date(stage, stage_key(stage, {}, hash_cache)):
+                continue
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=prefetch)
+            print('Prefetching {}'.format(stage['name']))
+            futures[stage['name']] = executor.submit(run_source_stage, stage)
+
+    try:
+        for position, stage in enumerate(stages):
+
+            if not selected(position, stage):
+                if stage['name'] not in manifest:
+                    raise FileNotFoundError(
+                        'No checkpoint for stage {}, run it first'.format(
+                        stage['name']))
+                for output in stage['outputs']:
+                    dataset_keys[output] = manifest[stage['name']]
+                continue
+
+            key = stage_key(stage, dataset_keys, hash_cache)
+            write_json(hash_cache, hash_cache_path)
+
+            for output in stage['outputs']:
+                dataset_keys[output] = key
+
+            if up_to_date(stage, key):
+                print('Skipping {} (unchanged)'.format(stage['name']))
+                continue
+
+            print('Running {}'.format(stage['name']))
+            inputs = [load(dataset) for dataset in stage['inputs']]
+
+            with stage_timer(stage['name'], count_records(tuple(inputs)),
+                log_path, profile, os.path.join(directory, 'profiles')) as record:
+                if stage['name'] in futures:
+                    result = futures.pop(stage['name']).result()
+                    record['prefetched'] = True
+                else:
+                    result = stage['function'](*inputs,
+                        **stage.get('parameters', {}))
+                record['records_out'] = count_records(
+                    result if isinstance(result, tuple) else (result,))
+
+            if len(stage['outputs']) == 1:
+                result = [result]
+
+            for output, data in zip(stage['outputs'], result or []):
+                data = list(data)
+                datasets[output] = data
+                write_features(data, checkpoint_path(directory, output), CRS)
+
+            manifest[stage['name']] = key
+            write_json(manifest, manifest_path)
+
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    return datasets
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Run the preprocessing pipeline with checkpoints.')
+    parser.add_argument('--from-stage',
+        help='rerun this stage and all later stages')
+    parser.add_argument('--only-stage',
+        help='rerun only this stage')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of processes used for the per-LAD stages')
+    parser.add_argument('--lads', nargs='+',
+        help='only process these LADs')
+    parser.add_argument('--bbox', nargs=4, type=float,
+        metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+        help='only process LADs intersecting this bounding box')
+    parser.add_argument('--simplify', type=float, metavar='TOLERANCE',
+        help='use boundaries simplified at this tolerance (metres) for the '
+        'LAD and site coverage joins, with exact checks near boundaries')
+    parser.add_argument('--overlay', action='store_true',
+        help='split postcode sectors between LADs by area')
+    parser.add_argument('--exchange-areas', action='store_true',
+        help='link sites to the exchange whose area they fall within')
+    parser.add_argument('--road-network', metavar='PATH',
+        help='route backhaul links along the roads in this OSM extract '
+        '(.osm.pbf) or GeoPackage')
+    parser.add_argument('--route-paths', action='store_true',
+        help='with --road-network, draw each backhaul link along its road '
+        'path rather than as a straight line with the road length')
+    parser.add_argument('--operators', action='store_true',
+        help='process the sites of every mobile operator, and allocate every '
+        'coverage column to postcode sectors')
+    parser.add_argument('--output-format', choices=['shapefile', 'geoparquet'],
+        default='shapefile',
+        help='write the outputs to shapefile, or GeoParquet with row groups '
+        'for each LAD')
+    parser.add_argument('--prefetch', type=int, default=4,
+        help='number of threads (or processes) reading the raw files '
+        'concurrently at the start of the run, or 0 to read each when its '
+        'stage is reached')
+    parser.add_argument('--checkpoints', default=CHECKPOINTS,
+        help='checkpoint directory')
+    parser.add_argument('--log', default=os.path.join(CHECKPOINTS, 'stages.jsonl'),
+        help='JSON lines file recording the time and memory of each stage')
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'],
+        help='profile each stage that runs')
+    args = parser.parse_args()
+
+    if args.from_stage and args.only_stage:
+        parser.error('--from-stage and --only-stage cannot be used together')
+
+    if args.road_network and args.exchange_areas:
+        parser.error('--road-network and --exchange-areas cannot be used together')
+
+    if args.route_paths and not args.road_network:
+        parser.error('--route-paths needs --road-network')
+
+    print('Checkpoint directory will be {}'.format(args.checkpoints))
+
+    stages = build_stages(args.workers, args.lads, args.bbox, args.simplify,
+        args.overlay, args.exchange_areas, args.road_network, args.operators,
+        args.output_format, args.route_paths)
+
+    run_pipeline(stages, args.checkpoints,
+        from_stage=args.from_stage, only_stage=args.only_stage,
+        log_path=args.log, profile=args.profile, prefetch=args.prefetch)
@@ -1,20 +1,24 @@
 import os
 import sys
-import configparser
+import argparse
 import csv
 import fiona
 import time
 
+import numpy as np
+
 from shapely.geometry import shape, Point, LineString, mapping
 from shapely.ops import  cascaded_union
+from shapely.prepared import prep
 
 from rtree import index
 
 from collections import OrderedDict
 
-CONFIG = configparser.ConfigParser()
-CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
-BASE_PATH = CONFIG['file_locations']['base_path']
+from scripts.instrument import stage_timer
+from scripts.overlay import piece_positions
+from scripts.simplify import boundary_intersects
+from scripts.config import BASE_PATH
 
 #####################################
 # setup file locations and data files
@@ -23,36 +27,126 @@ BASE_PATH = CONFIG['file_locations']['base_path']
 DATA_RAW = os.path.join(BASE_PATH, 'raw')
 DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 
+#Sites whose buffers (in metres) overlap are dissolved into one site
+SITE_BUFFER = 50
+
+#Sitefinder operators, by the mobile network operator they are now part of
+MOBILE_OPERATORS = {
+    'O2': 'O2',
+    'Vodafone': 'Vodafone',
+    'Orange': 'EE',
+    'T-Mobile': 'EE',
+    'EE': 'EE',
+    'Three': 'Three',
+    'Hutchison': 'Three',
+}
+
 #####################################
 # READ MAIN DATA
 #####################################
 
-def read_lads():
+LAD_EXCLUSIONS = (
+    'E06000053',
+    'S12000027',
+    'N09000001',
+    'N09000002',
+    'N09000003',
+    'N09000004',
+    'N09000005',
+    'N09000006',
+    'N09000007',
+    'N09000008',
+    'N09000009',
+    'N09000010',
+    'N09000011',
+    )
+
+
+def ignored_fields(source, properties):
     """
-    Read in all lad shapes.
+    Return the fields of a source which are not in a property whitelist,
+    or None to read all fields.
+
+    """
+    if properties is None:
+        return None
+
+    return [
+        field for field in source.schema['properties'].keys()
+        if field not in properties
+    ]
+
+
+def read_shapefile(path, bbox=None, properties=None):
+    """
+    Read features from a shapefile, only decoding those which intersect
+    bbox (minx, miny, maxx, maxy) and the attributes in properties.
+
+    Both filters are passed to fiona/GDAL, so skipped features and fields
+    are never parsed.
+
+    """
+    with fiona.open(path, 'r') as source:
+        ignore_fields = ignored_fields(source, properties)
+
+    with fiona.open(path, 'r', ignore_fields=ignore_fields) as source:
+        if bbox is not None:
+            return [feature for feature in source.filter(bbox=tuple(bbox))]
+        return [feature for feature in source]
+
+
+def features_bbox(features):
+    """
+    Return the bounding box (minx, miny, maxx, maxy) of a set of features,
+    e.g. to read only the postcode sectors of a region's LADs.
+
+    """
+    bounds = [shape(feature['geometry']).bounds for feature in features]
+
+    return (
+        min(b[0] for b in bounds),
+        min(b[1] for b in bounds),
+        max(b[2] for b in bounds),
+        max(b[3] for b in bounds),
+    )
+
+
+def read_lads(lad_ids=None, bbox=None, properties=None):
+    """
+    Read in lad shapes, optionally only those in a list of LAD ids or
+    intersecting a bbox, and only the attributes in properties.
+
+    LADs are first selected on their attributes alone, so the geometry of
+    LADs which are not needed is never decoded.
 
     """
     lad_shapes = os.path.join(
         DATA_RAW, 'shapes', 'lad_uk_2016-12.shp'
         )
 
+    if properties is not None:
+        properties = set(properties) | {'name'}
+
     with fiona.open(lad_shapes, 'r') as lad_shape:
-        return [lad for lad in lad_shape if
-        not lad['properties']['name'].startswith((
-            'E06000053',
-            'S12000027',
-            'N09000001',
-            'N09000002',
-            'N09000003',
-            'N09000004',
-            'N09000005',
-            'N09000006',
-            'N09000007',
-            'N09000008',
-            'N09000009',
-            'N09000010',
-            'N09000011',
-            ))]
+        ignore_fields = ignored_fields(lad_shape, properties)
+
+    lad_ids = None if lad_ids is None else set(lad_ids)
+
+    with fiona.open(lad_shapes, 'r', ignore_fields=ignore_fields,
+        ignore_geometry=True) as lad_shape:
+        selected = set(
+            fid for fid, lad in enumerate(lad_shape)
+            if not lad['properties']['name'].startswith(LAD_EXCLUSIONS)
+            and (lad_ids is None or lad['properties']['name'] in lad_ids)
+        )
+
+    with fiona.open(lad_shapes, 'r', ignore_fields=ignore_fields) as lad_shape:
+        if bbox is not None:
+            return [
+                lad for lad in lad_shape.filter(bbox=tuple(bbox))
+                if int(lad['id']) in selected
+            ]
+        return [lad_shape[fid] for fid in sorted(selected)]
 
 
 def lad_lut(lads):
@@ -64,40 +158,52 @@ def lad_lut(lads):
         yield lad['properties']['name']
 
 
-def read_postcode_sectors(path):
+def read_postcode_sectors(path, bbox=None, properties=None):
     """
-    Read all postcode sector shapes.
+    Read postcode sector shapes, optionally only those intersecting a bbox
+    and only the attributes in properties.
 
     """
-    with fiona.open(path, 'r') as pcd_sector_shapes:
-        return [pcd for pcd in pcd_sector_shapes]
+    return read_shapefile(path, bbox, properties)
 
 
-def add_lad_to_postcode_sector(postcode_sectors, lads):
+def add_lad_to_postcode_sector(postcode_sectors, lads, idx=None,
+    simplified=None):
     """
     Add the LAD indicator(s) to the relevant postcode sector.
 
+    An rtree index of the LAD bounds (with each LAD's position as its id)
+    can be provided, such as a cached index from spatial_index.py, as can
+    simplified LAD boundaries from simplify.py, in which case the full
+    resolution LAD is only used for sectors near its boundary.
+
     """
     final_postcode_sectors = []
 
-    idx = index.Index(
-        (i, shape(lad['geometry']).bounds, lad)
-        for i, lad in enumerate(lads)
-    )
+    if idx is None:
+        idx = index.Index(
+            (i, shape(lad['geometry']).bounds, None)
+            for i, lad in enumerate(lads)
+        )
 
     for postcode_sector in postcode_sectors:
         for n in idx.intersection(
-            (shape(postcode_sector['geometry']).bounds), objects=True):
+            (shape(postcode_sector['geometry']).bounds)):
+            lad = lads[n]
             postcode_sector_centroid = shape(postcode_sector['geometry']).centroid
             postcode_sector_shape = shape(postcode_sector['geometry'])
-            lad_shape = shape(n.object['geometry'])
-            if postcode_sector_centroid.intersects(lad_shape):
+            if simplified is not None:
+                found = boundary_intersects(simplified[n],
+                    postcode_sector_centroid, lambda: shape(lad['geometry']))
+            else:
+                found = postcode_sector_centroid.intersects(shape(lad['geometry']))
+            if found:
                 final_postcode_sectors.append({
                     'type': postcode_sector['type'],
                     'geometry': postcode_sector['geometry'],
                     'properties':{
                         'id': postcode_sector['properties']['RMSect'],
-                        'lad': n.object['properties']['name'],
+                        'lad': lad['properties']['name'],
                         'area': postcode_sector_shape.area,
                         },
                     })
@@ -129,6 +235,31 @@ def load_coverage_data(lad_id):
                     '4G_geo_out_4': line['4G_geo_out_4'],
                 }
 
+def load_coverage_table(path=None):
+    """
+    Import the geographic outdoor coverage (%) of every generation and
+    number of operators (the '*_geo_out_*' columns) for every LAD, reading
+    the Ofcom Connected Nations file once.
+
+    Returns the coverage columns, and a dict of coverage by LAD id.
+
+    """
+    if path is None:
+        path = os.path.join(
+            DATA_RAW, 'ofcom_2018', '201809_mobile_laua_r02.csv'
+            )
+
+    with open(path, 'r') as source:
+        reader = csv.DictReader(source)
+        columns = [c for c in reader.fieldnames if '_geo_out_' in c]
+        coverage = {
+            line['laua']: {c: float(line[c]) for c in columns}
+            for line in reader
+        }
+
+    return columns, coverage
+
+
 def load_in_weights():
     """
     Load in postcode sector weights.
@@ -155,6 +286,9 @@ def add_weights_to_postcode_sector(postcode_sectors, weights):
     """
     Add weights to postcode sector
 
+    Where postcode sectors have been split between LADs (see overlay.py),
+    each piece gets its area share of the sector's weight.
+
     """
     output = []
 
@@ -169,7 +303,8 @@ def add_weights_to_postcode_sector(postcode_sectors, weights):
                     'properties': {
                         'id': pcd_id,
                         'lad': postcode_sector['properties']['lad'],
-                        'population_weight': weight['population'],
+                        'population_weight': weight['population'] *
+                            postcode_sector['properties'].get('area_share', 1),
                         'area_km2': (postcode_sector['properties']['area'] / 1e6),
                     }
                 })
@@ -258,48 +393,104 @@ def disaggregate(forecast, postcode_sectors):
     return output
 
 
-def allocate_4G_coverage(postcode_sectors, lad_lut):
-
-    output = []
-
-    for lad_id in lad_lut:
-
-        sectors_in_lad = get_postcode_sectors_in_lad(postcode_sectors, lad_id)
-
-        total_area = sum([s['properties']['area_km2'] for s in \
-            get_postcode_sectors_in_lad(postcode_sectors, lad_id)])
+def allocate_4G_coverage(postcode_sectors, lad_lut, coverage=None):
+    """
+    Disaggregate the 4G coverage of each LAD ('4G_geo_out_4' in the Ofcom
+    data) to its postcode sectors, covering the densest sectors first
+    (see greedy_allocation).
 
-        coverage_data = load_coverage_data(lad_id)
+    All LADs are ranked and allocated together (see rank_sectors), and
+    the sectors are returned in LAD then density order, as copies with
+    'lte' added, leaving the input unchanged. The coverage table from
+    load_coverage_table can be provided.
 
-        coverage_amount = float(coverage_data['4G_geo_out_4'])
+    """
+    lad_ids = list(lad_lut)
 
-        covered_area = total_area * (coverage_amount/100)
+    if coverage is None:
+        columns, coverage = load_coverage_table()
 
-        ranked_postcode_sectors = sorted(
-            sectors_in_lad, key=lambda x: x['properties']['pop_density_km2'], reverse=True
-            )
+    sectors, order, targets = rank_sectors(postcode_sectors, lad_ids, coverage,
+        ['4G_geo_out_4'])
 
-        area_allocated = 0
+    covered = greedy_allocation(order['areas'], targets[:, 0])
 
-        for sector in ranked_postcode_sectors:
+    output = []
 
-            area = sector['properties']['area_km2']
-            total = area + area_allocated
+    for group, rank, position in zip(
+        order['groups'], order['ranks'], order['positions']):
+        sector = sectors[position]
+        properties = dict(sector['properties'])
+        properties['lte'] = int(covered[group, rank])
+        output.append({
+            'type': sector['type'],
+            'geometry': sector['geometry'],
+            'properties': properties,
+        })
 
-            if total < covered_area:
+    return output
 
-                sector['properties']['lte'] = 1
-                output.append(sector)
-                area_allocated += area
 
-            else:
+def rank_sectors(postcode_sectors, lad_ids, coverage, columns):
+    """
+    Rank the postcode sectors of every LAD by population density, in a
+    single grouped sort.
 
-                sector['properties']['lte'] = 0
-                output.append(sector)
+    Sectors are sorted by LAD (in lad_ids order), then by density (largest
+    first), then by their input order, so ties are broken as in a stable
+    sort. Returns the sectors with a float density in the LADs, the
+    order (the group, rank in group and position of each sorted sector,
+    and a (LADs, sectors) array of the areas in rank order, padded with
+    NaN), and the covered area target of each LAD and column.
 
-                continue
+    """
+    groups = {}
+    for lad_id in lad_ids:
+        groups.setdefault(lad_id, len(groups))
+
+    sectors = [
+        s for s in postcode_sectors if s['properties']['lad'] in groups and
+        isinstance(s['properties']['pop_density_km2'], float)
+    ]
+    sectors.sort(key=lambda s: groups[s['properties']['lad']])
+
+    group = np.array([groups[s['properties']['lad']] for s in sectors], dtype=int)
+    areas = np.array([s['properties']['area_km2'] for s in sectors], dtype=float)
+    densities = np.array(
+        [s['properties']['pop_density_km2'] for s in sectors], dtype=float)
+
+    counts = np.bincount(group, minlength=len(groups))
+    width = counts.max() if len(counts) > 0 else 0
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+
+    #total areas are summed in input order, as in the original loop
+    input_ranks = np.arange(len(sectors)) - starts[group]
+    input_areas = np.zeros((len(groups), width))
+    input_areas[group, input_ranks] = areas
+    total_area = np.cumsum(input_areas, axis=1)[:, -1] if width > 0 else \
+        np.zeros(len(groups))
+
+    positions = np.lexsort((np.arange(len(sectors)), -densities, group))
+    ranks = np.arange(len(sectors)) - starts[group[positions]]
+
+    ranked_areas = np.full((len(groups), width), np.nan)
+    ranked_areas[group[positions], ranks] = areas[positions]
+
+    targets = np.zeros((len(groups), len(columns)))
+    for lad_id, g in groups.items():
+        if lad_id not in coverage:
+            raise KeyError('No coverage data for {}'.format(lad_id))
+        for c, column in enumerate(columns):
+            targets[g, c] = total_area[g] * (coverage[lad_id][column]/100)
+
+    order = {
+        'groups': group[positions],
+        'ranks': ranks,
+        'positions': positions,
+        'areas': ranked_areas,
+    }
 
-    return output
+    return sectors, order, targets
 
 
 def get_postcode_sectors_in_lad(postcode_sectors, lad_id):
@@ -310,7 +501,112 @@ def get_postcode_sectors_in_lad(postcode_sectors, lad_id):
                 yield postcode_sector
 
 
-def import_sitefinder_data(path):
+def greedy_allocation(areas, targets):
+    """
+    Cover sectors in rank order, as allocate_4G_coverage does, where each
+    sector is covered if its area fits within the covered area left, and
+    otherwise skipped.
+
+    areas is an array of shape (rows, sectors) of the sector areas in each
+    row in rank order, padded at the end with NaN, and targets the covered
+    area of each row. Returns an array of covered flags for each sector.
+
+    Each round finds the next sector which fits in every row, and covers
+    it and the sectors after it until the running total (a cumulative sum,
+    added in the same order as the loop) reaches the target.
+
+    """
+    areas = np.asarray(areas, dtype=float)
+    targets = np.asarray(targets, dtype=float)
+
+    rows, width = areas.shape
+    columns = np.arange(width)
+    valid = ~np.isnan(areas)
+    values = np.where(valid, areas, 0)
+
+    covered = np.zeros(areas.shape, dtype=bool)
+    allocated = np.zeros(rows)
+    start = np.zeros(rows, dtype=int)
+    active = np.ones(rows, dtype=bool)
+
+    while active.any():
+
+        r = np.where(active)[0]
+
+        fits = (columns >= start[r, None]) & valid[r] & \
+            (values[r] + allocated[r, None] < targets[r, None])
+        found = fits.any(axis=1)
+        active[r[~found]] = False
+
+        r = r[found]
+        if len(r) == 0:
+            break
+        first = fits[found].argmax(axis=1)
+        after = columns >= first[:, None]
+
+        run = np.where(after, values[r], 0)
+        run[np.arange(len(r)), first] += allocated[r]
+        totals = np.cumsum(run, axis=1)
+
+        stop = after & ((totals >= targets[r, None]) | ~valid[r])
+        stopped = stop.any(axis=1)
+        end = np.where(stopped, stop.argmax(axis=1), width)
+
+        covered[r] |= after & (columns < end[:, None])
+        allocated[r] = totals[np.arange(len(r)), end - 1]
+        start[r] = end + 1
+        active[r[~stopped]] = False
+
+    return covered
+
+
+def allocate_coverage_table(postcode_sectors, lad_lut, columns, coverage,
+    site_counts=None):
+    """
+    Disaggregate the coverage of every column of the Ofcom data (from
+    load_coverage_table) to postcode sectors, as allocate_4G_coverage
+    does for '4G_geo_out_4', ranking the sectors once for all columns.
+
+    Returns one row per sector with a covered flag (0 or 1) for each
+    column, along with the number of sites of each operator if
+    site_counts (from count_sites_by_operator) are given.
+
+    """
+    operators = sorted(set(
+        operator for counts in (site_counts or {}).values() for operator in counts))
+
+    sectors, order, targets = rank_sectors(postcode_sectors, list(lad_lut),
+        coverage, columns)
+
+    #one row of areas for each LAD and column
+    lads = len(targets)
+    covered = greedy_allocation(
+        np.tile(order['areas'], (len(columns), 1)), targets.T.ravel())
+    covered = covered.reshape(len(columns), lads, -1)
+
+    output = []
+
+    for group, rank, position in zip(
+        order['groups'], order['ranks'], order['positions']):
+        sector = sectors[position]
+        row = {
+            'id': sector['properties']['id'],
+            'lad': sector['properties']['lad'],
+            'area_km2': sector['properties']['area_km2'],
+            'pop_density_km2': sector['properties']['pop_density_km2'],
+        }
+        for c, column in enumerate(columns):
+            row[column] = int(covered[c, group, rank])
+        counts = (site_counts or {}).get(
+            (sector['properties']['id'], sector['properties']['lad']), {})
+        for operator in operators:
+            row['sites_{}'.format(operator)] = counts.get(operator, 0)
+        output.append(row)
+
+    return output
+
+
+def import_sitefinder_data(path, operators=('O2', 'Vodafone')):
     """
     Import sitefinder data, selecting desired asset types.
         - Select sites belonging to main operators:
@@ -320,7 +616,13 @@ def import_sitefinder_data(path):
             - Includes 'Macro', 'SECTOR', 'Sectored' and 'Directional'
             - Excludes 'micro', 'microcell', 'omni' or 'pico' antenna types.
 
+    By default only O2 and Vodafone sites are kept, or with operators set
+    to None, the sites of every mobile operator in MOBILE_OPERATORS.
+
     """
+    if operators is None:
+        operators = MOBILE_OPERATORS
+
     asset_data = []
 
     site_id = 0
@@ -330,7 +632,7 @@ def import_sitefinder_data(path):
         next(reader, None)
         for line in reader:
             # if line['Operator'] != 'Airwave' and line['Operator'] != 'Network Rail':
-            if line['Operator'] == 'O2' or line['Operator'] == 'Vodafone':
+            if line['Operator'] in operators:
                 # if line['Anttype'] == 'MACRO' or \
                 #     line['Anttype'] == 'SECTOR' or \
                 #     line['Anttype'] == 'Sectored' or \
@@ -366,77 +668,143 @@ def import_sitefinder_data(path):
     return asset_data
 
 
-def process_asset_data(data):
+def process_asset_data(data, by_operator=False):
     """
     Add buffer to each site, dissolve overlaps and take centroid.
 
-    """
-    buffered_assets = []
+    Overlapping buffers are found with an rtree index of the buffers. With
+    by_operator, only the sites of the same mobile operator are dissolved
+    together, so every operator is processed in one pass over one index,
+    and each site is given its 'operator'.
 
-    for asset in data:
-        asset_geom = shape(asset['geometry'])
-        buffered_geom = asset_geom.buffer(50)
+    """
+    buffers = [shape(asset['geometry']).buffer(SITE_BUFFER) for asset in data]
+
+    if by_operator:
+        groups = [
+            MOBILE_OPERATORS.get(asset['properties']['Operator'],
+                asset['properties']['Operator'])
+            for asset in data
+        ]
+    else:
+        groups = [None] * len(data)
 
-        asset['buffer'] = buffered_geom
-        buffered_assets.append(asset)
+    idx = index.Index(
+        (i, buffer.bounds, None) for i, buffer in enumerate(buffers))
 
     output = []
     assets_seen = set()
 
-    for asset in buffered_assets:
-        if asset['properties']['Opref'] in assets_seen:
+    for i, asset in enumerate(data):
+        if (groups[i], asset['properties']['Opref']) in assets_seen:
             continue
-        assets_seen.add(asset['properties']['Opref'])
+        assets_seen.add((groups[i], asset['properties']['Opref']))
         touching_assets = []
-        for other_asset in buffered_assets:
-            if asset['buffer'].intersects(other_asset['buffer']):
-                touching_assets.append(other_asset)
-                assets_seen.add(other_asset['properties']['Opref'])
+        for j in sorted(idx.intersection(buffers[i].bounds)):
+            if groups[j] == groups[i] and buffers[i].intersects(buffers[j]):
+                touching_assets.append(buffers[j])
+                assets_seen.add((groups[j], data[j]['properties']['Opref']))
 
-        dissolved_shape = cascaded_union([a['buffer'] for a in touching_assets])
+        dissolved_shape = cascaded_union(touching_assets)
         final_centroid = dissolved_shape.centroid
+
+        properties = {'name': asset['properties']['name']}
+        if by_operator:
+            properties['operator'] = groups[i]
+
         output.append({
             'type': "Feature",
             'geometry': {
                 "type": "Point",
                 "coordinates": [final_centroid.coords[0][0], final_centroid.coords[0][1]],
             },
-            'properties':{
-                'name': asset['properties']['name'],
-            }
+            'properties': properties,
         })
 
     return output
 
 
-def add_coverage_to_sites(sitefinder_data, postcode_sectors):
+def add_coverage_to_sites(sitefinder_data, postcode_sectors, idx=None,
+    simplified=None):
+    """
+    Add the 4G coverage of the containing postcode sector to each site,
+    keeping its 'operator' if it has one.
+
+    An rtree index of the site bounds (with each site's position as its
+    id) can be provided, such as a cached index from spatial_index.py, as
+    can simplified postcode sector boundaries from simplify.py, in which
+    case full resolution sectors are only used for sites near their edge.
 
+    """
     final_sites = []
 
-    idx = index.Index(
-        (i, shape(site['geometry']).bounds, site)
-        for i, site in enumerate(sitefinder_data)
-    )
+    if idx is None:
+        idx = index.Index(
+            (i, shape(site['geometry']).bounds, None)
+            for i, site in enumerate(sitefinder_data)
+        )
 
-    for postcode_sector in postcode_sectors:
-        for n in idx.intersection(
-            (shape(postcode_sector['geometry']).bounds), objects=True):
-            postcode_sector_shape = shape(postcode_sector['geometry'])
-            site_shape = shape(n.object['geometry'])
-            if postcode_sector_shape.intersects(site_shape):
+    for position, postcode_sector in enumerate(postcode_sectors):
+        if simplified is not None:
+            bounds = simplified[position]['bounds']
+        else:
+            bounds = shape(postcode_sector['geometry']).bounds
+        for n in idx.intersection(bounds):
+            site = sitefinder_data[n]
+            site_shape = shape(site['geometry'])
+            if simplified is not None:
+                found = boundary_intersects(simplified[position], site_shape,
+                    lambda: shape(postcode_sector['geometry']))
+            else:
+                found = shape(postcode_sector['geometry']).intersects(site_shape)
+            if found:
+                properties = {
+                    'id': postcode_sector['properties']['id'],
+                    'name': site['properties']['name'],
+                    'lte_4G': postcode_sector['properties']['lte']
+                    }
+                if 'operator' in site['properties']:
+                    properties['operator'] = site['properties']['operator']
                 final_sites.append({
                     'type': 'Feature',
-                    'geometry': n.object['geometry'],
-                    'properties':{
-                        'id': postcode_sector['properties']['id'],
-                        'name': n.object['properties']['name'],
-                        'lte_4G': postcode_sector['properties']['lte']
-                        }
+                    'geometry': site['geometry'],
+                    'properties': properties,
                     })
 
     return final_sites
 
 
+def count_sites_by_operator(sites, postcode_sectors):
+    """
+    Count the sites of each operator in each postcode sector, from the
+    sites with coverage (add_coverage_to_sites, of sites processed with
+    by_operator).
+
+    Sectors split between LADs (see overlay.py) are counted per piece,
+    with the sites within that piece. Returns a dict of counts by
+    operator, for each sector (id, lad).
+
+    """
+    names = {}
+
+    for site, position in zip(sites, piece_positions(sites, postcode_sectors)):
+        if position is None:
+            continue
+        names.setdefault(position, set()).add(
+            (site['properties']['operator'], site['properties']['name']))
+
+    output = {}
+
+    for position, postcode_sector in enumerate(postcode_sectors):
+        counts = {}
+        for operator, name in names.get(position, []):
+            counts[operator] = counts.get(operator, 0) + 1
+        output[(postcode_sector['properties']['id'],
+            postcode_sector['properties']['lad'])] = counts
+
+    return output
+
+
 def read_exchanges():
     """
     Reads in exchanges from 'final_exchange_pcds.csv'.
@@ -463,9 +831,10 @@ def read_exchanges():
             }
 
 
-def read_exchange_areas():
+def read_exchange_areas(bbox=None, properties=None):
     """
-    Read exchange polygons
+    Read exchange polygons, optionally only those intersecting a bbox and
+    only the attributes in properties.
 
     """
     path = os.path.join(
@@ -473,10 +842,73 @@ def read_exchange_areas():
         )
 
     with fiona.open(path, 'r') as source:
-        for area in source:
+        ignore_fields = ignored_fields(source, properties)
+
+    with fiona.open(path, 'r', ignore_fields=ignore_fields) as source:
+        areas = source if bbox is None else source.filter(bbox=tuple(bbox))
+        for area in areas:
             yield area
 
 
+def exchange_area_key(value):
+    """
+    Return the exchange_id (as given by read_exchanges) for the exchange
+    code held by an exchange area.
+
+    """
+    value = str(value)
+
+    if value.startswith('exchange_'):
+        return value
+
+    return 'exchange_' + value
+
+
+def assign_exchange_areas(sites, exchange_areas, exchanges, field='id'):
+    """
+    Find the exchange serving each site from the exchange area polygon
+    containing it, using an rtree index of the areas and prepared
+    geometries.
+
+    Returns the position of each site's exchange in exchanges, or None
+    for sites outside every exchange area (or in an area with no matching
+    exchange), which generate_link_straight_line links to the nearest
+    exchange instead.
+
+    """
+    exchange_positions = {
+        exchange['properties']['exchange_id']: i
+        for i, exchange in reversed(list(enumerate(exchanges)))
+    }
+
+    exchange_areas = list(exchange_areas)
+
+    idx = index.Index(
+        (i, shape(area['geometry']).bounds, None)
+        for i, area in enumerate(exchange_areas)
+    )
+
+    prepared = {}
+    output = []
+
+    for site in sites:
+
+        site_shape = shape(site['geometry'])
+        assigned = None
+
+        for n in sorted(idx.intersection(site_shape.bounds)):
+            if n not in prepared:
+                prepared[n] = prep(shape(exchange_areas[n]['geometry']))
+            if prepared[n].intersects(site_shape):
+                assigned = exchange_positions.get(exchange_area_key(
+                    exchange_areas[n]['properties'][field]))
+                break
+
+        output.append(assigned)
+
+    return output
+
+
 def return_object_coordinates(object):
     """
     Function for returning the coordinates of a type of object.
@@ -495,27 +927,43 @@ def return_object_coordinates(object):
     return x, y
 
 
-def generate_link_straight_line(origin_points, dest_points):
+def generate_link_straight_line(origin_points, dest_points, idx=None,
+    assigned=None):
     """
     Calculate distance between two points.
 
+    An rtree index of the destination point bounds (with each point's
+    position as its id) can be provided, such as a cached index from
+    spatial_index.py.
+
+    Each origin point is linked to its nearest destination, unless its
+    destination has been assigned (e.g. by assign_exchange_areas), as a
+    list with the position of each origin's destination or None. The
+    'operator' of an origin point, if it has one, is kept on its site
+    and link.
+
     """
-    idx = index.Index(
-        (i, Point(dest_point['geometry']['coordinates']).bounds, dest_point)
-        for i, dest_point in enumerate(dest_points)
-        )
+    dest_points = list(dest_points)
+
+    if idx is None:
+        idx = index.Index(
+            (i, Point(dest_point['geometry']['coordinates']).bounds, None)
+            for i, dest_point in enumerate(dest_points)
+            )
 
     processed_sites = []
     links = []
 
-    for origin_point in origin_points:
+    for position, origin_point in enumerate(origin_points):
 
         try:
             origin_x, origin_y = return_object_coordinates(origin_point)
 
-            exchange = list(idx.nearest(
-                Point(origin_point['geometry']['coordinates']).bounds,
-                1, objects='raw'))[0]
+            if assigned is not None and assigned[position] is not None:
+                exchange = dest_points[assigned[position]]
+            else:
+                exchange = dest_points[list(idx.nearest(
+                    Point(origin_point['geometry']['coordinates']).bounds, 1))[0]]
 
             dest_x, dest_y = return_object_coordinates(exchange)
 
@@ -525,26 +973,32 @@ def generate_link_straight_line(origin_points, dest_points):
                 (origin_x, origin_y), (dest_x, dest_y)
                 ])
 
+            site_properties = {
+                'id': origin_point['properties']['id'],
+                'name': origin_point['properties']['name'],
+                'lte_4G': origin_point['properties']['lte_4G'],
+                'exchange_id': exchange['properties']['exchange_id'],
+                'backhaul_length_m': geom.length * 1.60934
+                }
+            link_properties = {
+                "origin_id": origin_point['properties']['name'],
+                "dest_id": exchange['properties']['exchange_id'],
+                "length": geom.length * 1.60934
+            }
+            if 'operator' in origin_point['properties']:
+                site_properties['operator'] = origin_point['properties']['operator']
+                link_properties['operator'] = origin_point['properties']['operator']
+
             processed_sites.append({
                 'type': 'Feature',
                 'geometry': origin_point['geometry'],
-                'properties':{
-                    'id': origin_point['properties']['id'],
-                    'name': origin_point['properties']['name'],
-                    'lte_4G': origin_point['properties']['lte_4G'],
-                    'exchange_id': exchange['properties']['exchange_id'],
-                    'backhaul_length_m': geom.length * 1.60934
-                    }
+                'properties': site_properties,
                 })
 
             links.append({
                 'type': "Feature",
                 'geometry': mapping(geom),
-                'properties': {
-                    "origin_id": origin_point['properties']['name'],
-                    "dest_id": exchange['properties']['exchange_id'],
-                    "length": geom.length * 1.60934
-                }
+                'properties': link_properties,
             })
 
         except:
@@ -607,61 +1061,104 @@ def csv_writer(data, directory, filename):
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(
+        description='Preprocess the cellular network inputs.')
+    parser.add_argument('--exchange-areas', action='store_true',
+        help='link sites to the exchange whose area they fall within')
+    args = parser.parse_args()
+
     start = time.time()
 
     crs = 'epsg:27700'
     directory = os.path.join(BASE_PATH, 'processed')
     print('Output directory will be {}'.format(directory))
 
+    log_path = os.path.join(DATA_INTERMEDIATE, 'logs', 'preprocess_stages.jsonl')
+
     print('Loading local authority district shapes')
-    lads = read_lads()[:20]
+    with stage_timer('read_lads', None, log_path) as record:
+        lads = read_lads()[:20]
+        record['records_out'] = len(lads)
 
     print('Loading lad lookup')
     lad_lut = lad_lut(lads)
 
     print('Loading postcode sector shapes')
-    path = os.path.join(DATA_RAW, 'shapes', 'PostalSector.shp')
-    postcode_sectors = read_postcode_sectors(path)
+    with stage_timer('read_postcode_sectors', None, log_path) as record:
+        path = os.path.join(DATA_RAW, 'shapes', 'PostalSector.shp')
+        postcode_sectors = read_postcode_sectors(
+            path, bbox=features_bbox(lads), properties=['RMSect'])
+        record['records_out'] = len(postcode_sectors)
 
     print('Adding lad IDs to postcode sectors... might take a few minutes...')
-    postcode_sectors = add_lad_to_postcode_sector(postcode_sectors, lads)
+    with stage_timer('lad_assignment', len(postcode_sectors), log_path) as record:
+        postcode_sectors = add_lad_to_postcode_sector(postcode_sectors, lads)
+        record['records_out'] = len(postcode_sectors)
 
     print('Loading in population weights' )
-    weights = load_in_weights()
+    with stage_timer('weights', None, log_path) as record:
+        weights = load_in_weights()
+        record['records_out'] = len(weights)
 
     print('Adding weights to postcode sectors')
-    postcode_sectors = add_weights_to_postcode_sector(postcode_sectors, weights)
+    with stage_timer('sector_weights', len(postcode_sectors), log_path) as record:
+        postcode_sectors = add_weights_to_postcode_sector(postcode_sectors, weights)
+        record['records_out'] = len(postcode_sectors)
 
     print('Calculating lad population weight for each postcode sector')
-    postcode_sectors = calculate_lad_population(postcode_sectors)
+    with stage_timer('population', len(postcode_sectors), log_path) as record:
+        postcode_sectors = calculate_lad_population(postcode_sectors)
+        record['records_out'] = len(postcode_sectors)
 
     print('Disaggregate 4G coverage to postcode sectors')
-    postcode_sectors = allocate_4G_coverage(postcode_sectors, lad_lut)
+    with stage_timer('coverage_4G', len(postcode_sectors), log_path) as record:
+        postcode_sectors = allocate_4G_coverage(postcode_sectors, lad_lut)
+        record['records_out'] = len(postcode_sectors)
 
     print('Importing sitefinder data')
-    folder = os.path.join(DATA_RAW, 'sitefinder')
-    sitefinder_data = import_sitefinder_data(os.path.join(folder, 'sitefinder.csv'))[:500]
+    with stage_timer('sitefinder', None, log_path) as record:
+        folder = os.path.join(DATA_RAW, 'sitefinder')
+        sitefinder_data = import_sitefinder_data(os.path.join(folder, 'sitefinder.csv'))[:500]
+        record['records_out'] = len(sitefinder_data)
 
     print('Preprocessing sitefinder data with 50m buffer')
-    sitefinder_data = process_asset_data(sitefinder_data)
+    with stage_timer('buffering', len(sitefinder_data), log_path) as record:
+        sitefinder_data = process_asset_data(sitefinder_data)
+        record['records_out'] = len(sitefinder_data)
 
     print('Allocate 4G coverage to sites from postcode sectors')
-    processed_sites = add_coverage_to_sites(sitefinder_data, postcode_sectors)
+    with stage_timer('site_coverage', len(sitefinder_data), log_path) as record:
+        processed_sites = add_coverage_to_sites(sitefinder_data, postcode_sectors)
+        record['records_out'] = len(processed_sites)
 
     print('Reading exchanges')
-    exchanges = read_exchanges()
+    exchanges = list(read_exchanges())
+
+    assigned = None
+    if args.exchange_areas:
+        print('Reading exchange areas')
+        exchange_areas = read_exchange_areas(properties=['id'])
+
+        print('Assigning sites to the exchange area they fall within')
+        with stage_timer('exchange_assignment', len(processed_sites), log_path) as record:
+            assigned = assign_exchange_areas(processed_sites, exchange_areas, exchanges)
+            record['records_out'] = len(assigned) - assigned.count(None)
 
-    print('Reading exchange areas')
-    exchange_areas = read_exchange_areas()
+    print('Generating straight line distance from each site to its exchange')
+    with stage_timer('links', len(processed_sites), log_path) as record:
+        processed_sites, backhaul_links = generate_link_straight_line(
+            processed_sites, exchanges, assigned=assigned)
+        record['records_out'] = [len(processed_sites), len(backhaul_links)]
 
-    print('Generating straight line distance from each site to the nearest exchange')
-    processed_sites, backhaul_links = generate_link_straight_line(processed_sites, exchanges)
+    with stage_timer('write', len(processed_sites), log_path):
+        print('Writing postcode sectors to shapefile')
+        write_shapefile(postcode_sectors, directory, 'postcode_sectors.shp', crs)
 
-    print('Writing processed sites to shapefile')
-    write_shapefile(processed_sites, directory, 'processed_sites.shp', crs)
+        print('Writing processed sites to shapefile')
+        write_shapefile(processed_sites, directory, 'processed_sites.shp', crs)
 
-    print('Writing backhaul links to shapefile')
-    write_shapefile(backhaul_links, directory, 'backhaul_links.shp', crs)
+        print('Writing backhaul links to shapefile')
+        write_shapefile(backhaul_links, directory, 'backhaul_links.shp', crs)
 
     end = time.time()
     print('time taken: {} minutes'.format(round((end - start) / 60,2)))
@@ -0,0 +1,337 @@
+"""
+Point lookups of postcode sector, LAD, 4G coverage and nearest exchange.
+
+Written by Ed Oughton
+
+Loads the pipeline checkpoints once and answers which postcode sector and
+LAD a point falls in, whether the sector has 4G coverage, and which
+exchange is nearest, for single points or batches.
+
+Checkpoints are memory-mapped, with only the lookup properties read into
+memory. Geometries are left as WKB in the mapped file and decoded (and
+prepared) the first time a point falls in their bounds. Each layer's
+rtree index is file-backed and cached in spatial_index.INDEX_DIRECTORY,
+keyed on the hash of its checkpoint, so later starts reopen it rather
+than rebuilding it.
+
+The same lookups are served over HTTP on localhost by a small asyncio
+server:
+
+    GET  /health
+    GET  /lookup?x=530000&y=180000
+    GET  /lookup?x=-0.12&y=51.5&crs=epsg:4326
+    POST /lookup    {"points": [[530000, 180000], ...], "crs": "epsg:27700"}
+
+Usage:
+
+    python -m scripts.query --port 8050
+
+or in Python:
+
+    data = load_query_data()
+    lookup_point(data, 530000, 180000)
+    lookup_points(data, [(-0.12, 51.5), (-1.25, 51.75)], crs='epsg:4326')
+
+"""
+import os
+import asyncio
+import argparse
+import json
+import time
+
+from urllib.parse import urlsplit, parse_qs
+
+import pyarrow.parquet as pq
+
+from fiona.transform import transform
+from shapely import wkb
+from shapely.geometry import Point
+from shapely.prepared import prep
+
+from scripts.cache import cached_file_hash
+from scripts.pipeline import CHECKPOINTS, CRS, checkpoint_path
+from scripts.spatial_index import INDEX_DIRECTORY, cached_index, open_cached_index
+
+#The checkpoint and properties read for each layer
+LAYERS = {
+    'sectors': ('sectors_coverage', ['id', 'lad', 'lte']),
+    'lads': ('lads', ['name']),
+    'exchanges': ('exchanges', ['exchange_id', 'exchange_name']),
+}
+
+HOST = '127.0.0.1'
+PORT = 8050
+
+#The largest number of points in one batch request
+MAX_BATCH = 100000
+
+STATUS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+}
+
+
+def open_layer(path, columns, index_directory=INDEX_DIRECTORY):
+    """
+    Memory-map a checkpoint, reading the given property columns and
+    opening (or building) its cached rtree index.
+
+    """
+    table = pq.read_table(path, columns=columns + ['geometry'], memory_map=True)
+    geometry = table.column('geometry')
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    source_hash = cached_file_hash(path, index_directory)
+
+    #bounds are only needed (and geometries decoded) to build a new index
+    idx = open_cached_index(name, source_hash, len(geometry), index_directory)
+    if idx is None:
+        bounds = [wkb.loads(g.as_py()).bounds for g in geometry]
+        idx = cached_index(name, bounds, source_hash, index_directory)
+
+    return {
+        'geometry': geometry,
+        'properties': {column: table.column(column).to_pylist() for column in columns},
+        'index': idx,
+        'prepared': {},
+    }
+
+
+def load_query_data(directory=CHECKPOINTS, index_directory=INDEX_DIRECTORY):
+    """
+    Open every lookup layer from the checkpoints in directory.
+
+    """
+    return {
+        name: open_layer(checkpoint_path(directory, dataset), columns,
+            index_directory)
+        for name, (dataset, columns) in LAYERS.items()
+    }
+
+
+def prepared_geometry(layer, position):
+    """
+    Return the prepared geometry of a feature, decoding it from the mapped
+    checkpoint the first time it is needed.
+
+    """
+    if position not in layer['prepared']:
+        layer['prepared'][position] = prep(
+            wkb.loads(layer['geometry'][position].as_py()))
+
+    return layer['prepared'][position]
+
+
+def containing(layer, point):
+    """
+    Return the position of the first feature intersecting a point, or
+    None if it falls outside every feature.
+
+    """
+    for position in sorted(layer['index'].intersection(point.bounds)):
+        if prepared_geometry(layer, position).intersects(point):
+            return position
+
+    return None
+
+
+def nearest(layer, point):
+    """
+    Return the position of the feature nearest a point, as for
+    preprocess.generate_link_straight_line.
+
+    """
+    for position in layer['index'].nearest(point.bounds, 1):
+        return position
+
+    return None
+
+
+def layer_property(layer, column, position):
+    """
+    Return a property of a feature, or None if there is no feature.
+
+    """
+    if position is None:
+        return None
+
+    return layer['properties'][column][position]
+
+
+def lookup_point(data, x, y):
+    """
+    Look up the postcode sector, LAD, 4G coverage and nearest exchange of
+    a point in British National Grid coordinates.
+
+    """
+    point = Point(x, y)
+
+    sectors = data['sectors']
+    lads = data['lads']
+    exchanges = data['exchanges']
+
+    sector = containing(sectors, point)
+    lad = containing(lads, point)
+    exchange = nearest(exchanges, point)
+
+    distance = None
+    if exchange is not None:
+        distance = prepared_geometry(exchanges, exchange).context.distance(point)
+
+    return {
+        'x': x,
+        'y': y,
+        'postcode_sector': layer_property(sectors, 'id', sector),
+        'lad': layer_property(lads, 'name', lad),
+        'lte': layer_property(sectors, 'lte', sector),
+        'exchange_id': layer_property(exchanges, 'exchange_id', exchange),
+        'exchange_name': layer_property(exchanges, 'exchange_name', exchange),
+        'exchange_distance_m': distance,
+    }
+
+
+def lookup_points(data, points, crs=CRS):
+    """
+    Look up a batch of (x, y) points, given in crs, transforming them to
+    British National Grid first if needed.
+
+    """
+    points = list(points)
+
+    xs = [float(x) for x, y in points]
+    ys = [float(y) for x, y in points]
+
+    if crs.lower() != CRS and len(points) > 0:
+        xs, ys = transform(crs.upper(), CRS.upper(), xs, ys)
+
+    return [lookup_point(data, x, y) for x, y in zip(xs, ys)]
+
+
+#####################################
+# http front-end
+#####################################
+
+def handle_request(data, method, target, body=b''):
+    """
+    Answer an HTTP request, returning the status and a json-serialisable
+    payload.
+
+    """
+    url = urlsplit(target)
+    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+    if url.path == '/health':
+        return 200, {'status': 'ok'}
+
+    if url.path != '/lookup':
+        return 404, {'error': 'Unknown path {}'.format(url.path)}
+
+    try:
+        if method == 'GET':
+            crs = query.get('crs', CRS)
+            return 200, lookup_points(data, [(query['x'], query['y'])], crs)[0]
+
+        if method == 'POST':
+            request = json.loads(body.decode('utf-8') or '{}')
+            if not isinstance(request, dict):
+                return 400, {'error': 'Invalid request: body must be a '
+                    'json object'}
+            points = request.get('points', [])
+            if len(points) > MAX_BATCH:
+                return 413, {'error': 'At most {} points per request'.format(
+                    MAX_BATCH)}
+            return 200, {'results': lookup_points(data, points,
+                request.get('crs', query.get('crs', CRS)))}
+
+    except (KeyError, ValueError, TypeError) as error:
+        return 400, {'error': 'Invalid request: {}'.format(error)}
+
+    return 405, {'error': 'Use GET or POST'}
+
+
+async def serve_connection(data, reader, writer):
+    """
+    Serve the requests on one connection, keeping it open between
+    requests unless the client closes it.
+
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            method, target, version = request_line.decode('latin-1').split()
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            start = time.perf_counter()
+            status, payload = handle_request(data, method, target, body)
+            content = json.dumps(payload).encode('utf-8')
+
+            keep_alive = version == 'HTTP/1.1' and \
+                headers.get('connection', '').lower() != 'close'
+
+            writer.write((
+                'HTTP/1.1 {} {}\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: {}\r\n'
+                'X-Lookup-Ms: {:.3f}\r\n'
+                'Connection: {}\r\n\r\n'
+            ).format(status, STATUS[status], len(content),
+                (time.perf_counter() - start) * 1e3,
+                'keep-alive' if keep_alive else 'close').encode('latin-1') + content)
+            await writer.drain()
+
+            if not keep_alive:
+                break
+
+    except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+    finally:
+        writer.close()
+
+
+async def run_server(data, host=HOST, port=PORT):
+    """
+    Serve lookups over HTTP until cancelled.
+
+    """
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_connection(data, reader, writer), host, port)
+
+    print('Serving lookups on http://{}:{}'.format(host, port))
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Serve postcode sector, LAD and exchange lookups.')
+    parser.add_argument('--checkpoints', default=CHECKPOINTS,
+        help='checkpoint directory')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    print('Loading lookup layers')
+    data = load_query_data(args.checkpoints)
+
+    try:
+        asyncio.run(run_server(data, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,575 @@
+"""
+Reference implementations of the optimised preprocessing, core network
+and capacity functions.
+
+Written by Ed Oughton
+
+These are the functions as they were before any of them were optimised,
+kept unchanged (apart from a diagnostic print of the layer sizes removed
+from connect) so equivalence.py can check the current implementations
+still reproduce their outputs. They should not be edited or used by the
+models themselves.
+
+"""
+import os
+import csv
+
+from itertools import tee
+
+from shapely.geometry import shape, LineString, mapping
+from shapely.ops import  cascaded_union
+
+from rtree import index
+
+from scripts.config import BASE_PATH
+
+DATA_RAW = os.path.join(BASE_PATH, 'raw')
+
+
+#####################################
+# preprocess.py
+#####################################
+
+def add_lad_to_postcode_sector(postcode_sectors, lads):
+    """
+    Add the LAD indicator(s) to the relevant postcode sector.
+
+    """
+    final_postcode_sectors = []
+
+    idx = index.Index(
+        (i, shape(lad['geometry']).bounds, lad)
+        for i, lad in enumerate(lads)
+    )
+
+    for postcode_sector in postcode_sectors:
+        for n in idx.intersection(
+            (shape(postcode_sector['geometry']).bounds), objects=True):
+            postcode_sector_centroid = shape(postcode_sector['geometry']).centroid
+            postcode_sector_shape = shape(postcode_sector['geometry'])
+            lad_shape = shape(n.object['geometry'])
+            if postcode_sector_centroid.intersects(lad_shape):
+                final_postcode_sectors.append({
+                    'type': postcode_sector['type'],
+                    'geometry': postcode_sector['geometry'],
+                    'properties':{
+                        'id': postcode_sector['properties']['RMSect'],
+                        'lad': n.object['properties']['name'],
+                        'area': postcode_sector_shape.area,
+                        },
+                    })
+                break
+
+    return final_postcode_sectors
+
+
+def load_coverage_data(lad_id):
+    """
+    Import Ofcom Connected Nations coverage data (2018).
+
+    """
+    path = os.path.join(
+        DATA_RAW, 'ofcom_2018', '201809_mobile_laua_r02.csv'
+        )
+
+    with open(path, 'r') as source:
+        reader = csv.DictReader(source)
+        for line in reader:
+            if line['laua'] == lad_id:
+                return {
+                    'lad_id': line['laua'],
+                    'lad_name': line['laua_name'],
+                    '4G_geo_out_0': line['4G_geo_out_0'],
+                    '4G_geo_out_1': line['4G_geo_out_1'],
+                    '4G_geo_out_2': line['4G_geo_out_2'],
+                    '4G_geo_out_3': line['4G_geo_out_3'],
+                    '4G_geo_out_4': line['4G_geo_out_4'],
+                }
+
+
+def allocate_4G_coverage(postcode_sectors, lad_lut):
+
+    output = []
+
+    for lad_id in lad_lut:
+
+        sectors_in_lad = get_postcode_sectors_in_lad(postcode_sectors, lad_id)
+
+        total_area = sum([s['properties']['area_km2'] for s in \
+            get_postcode_sectors_in_lad(postcode_sectors, lad_id)])
+
+        coverage_data = load_coverage_data(lad_id)
+
+        coverage_amount = float(coverage_data['4G_geo_out_4'])
+
+        covered_area = total_area * (coverage_amount/100)
+
+        ranked_postcode_sectors = sorted(
+            sectors_in_lad, key=lambda x: x['properties']['pop_density_km2'], reverse=True
+            )
+
+        area_allocated = 0
+
+        for sector in ranked_postcode_sectors:
+
+            area = sector['properties']['area_km2']
+            total = area + area_allocated
+
+            if total < covered_area:
+
+                sector['properties']['lte'] = 1
+                output.append(sector)
+                area_allocated += area
+
+            else:
+
+                sector['properties']['lte'] = 0
+                output.append(sector)
+
+                continue
+
+    return output
+
+
+def get_postcode_sectors_in_lad(postcode_sectors, lad_id):
+
+    for postcode_sector in postcode_sectors:
+        if postcode_sector['properties']['lad'] == lad_id:
+            if isinstance(postcode_sector['properties']['pop_density_km2'], float):
+                yield postcode_sector
+
+
+def process_asset_data(data):
+    """
+    Add buffer to each site, dissolve overlaps and take centroid.
+
+    """
+    buffered_assets = []
+
+    for asset in data:
+        asset_geom = shape(asset['geometry'])
+        buffered_geom = asset_geom.buffer(50)
+
+        asset['buffer'] = buffered_geom
+        buffered_assets.append(asset)
+
+    output = []
+    assets_seen = set()
+
+    for asset in buffered_assets:
+        if asset['properties']['Opref'] in assets_seen:
+            continue
+        assets_seen.add(asset['properties']['Opref'])
+        touching_assets = []
+        for other_asset in buffered_assets:
+            if asset['buffer'].intersects(other_asset['buffer']):
+                touching_assets.append(other_asset)
+                assets_seen.add(other_asset['properties']['Opref'])
+
+        dissolved_shape = cascaded_union([a['buffer'] for a in touching_assets])
+        final_centroid = dissolved_shape.centroid
+        output.append({
+            'type': "Feature",
+            'geometry': {
+                "type": "Point",
+                "coordinates": [final_centroid.coords[0][0], final_centroid.coords[0][1]],
+            },
+            'properties':{
+                'name': asset['properties']['name'],
+            }
+        })
+
+    return output
+
+
+#####################################
+# core.py
+#####################################
+
+def connect(exchanges, islands, islands_lut):
+    """
+
+    """
+    output = []
+
+    inner = []
+    outer = []
+    metro = []
+    tier_1 = []
+    msan = []
+    lower = []
+
+    for exchange in exchanges:
+
+        coords = shape(exchange['geometry'])
+
+        if int(exchange['properties']['inner']) > 0:
+            inner.append(exchange)
+
+        if (int(exchange['properties']['outer']) > 0 or int(exchange['properties']['inner']) > 0):
+            outer.append(exchange)
+
+        if int(exchange['properties']['metro']) > 0:
+            metro.append(exchange)
+
+        if int(exchange['properties']['lower']) > 0:
+            lower.append(exchange)
+
+    ranked = sorted(lower, reverse = True, key=lambda x: x['properties']['population'])[:1000]
+
+    tier_1_ids = [e['properties']['OLO'] for e in ranked]
+
+    for exchange in lower:
+        if exchange['properties']['OLO'] in tier_1_ids:
+            tier_1.append({
+                'type': exchange['type'],
+                'geometry': exchange['geometry'],
+                'properties': {
+                    'OLO': exchange['properties']['OLO'],
+                    'population': exchange['properties']['population'],
+                    'inner': exchange['properties']['inner'],
+                    'outer': exchange['properties']['outer'],
+                    'metro': exchange['properties']['metro'],
+                    'tier_1': 1,
+                    'msan': exchange['properties']['msan'],
+                    'lower': exchange['properties']['lower'],
+                }
+            })
+        if not exchange['properties']['OLO'] in tier_1_ids:
+            msan.append({
+                'type': exchange['type'],
+                'geometry': exchange['geometry'],
+                'properties': {
+                    'OLO': exchange['properties']['OLO'],
+                    'population': exchange['properties']['population'],
+                    'inner': exchange['properties']['inner'],
+                    'outer': exchange['properties']['outer'],
+                    'metro': exchange['properties']['metro'],
+                    'tier_1': exchange['properties']['tier_1'],
+                    'msan': 1,
+                    'lower': exchange['properties']['lower'],
+                }
+            })
+
+    idx_inner_core = index.Index()
+    for exchange in inner:
+        coords = shape(exchange['geometry'])
+        idx_inner_core.insert(0, coords.bounds, exchange)
+
+    idx_all_core = index.Index()
+    for exchange in outer:
+        coords = shape(exchange['geometry'])
+        idx_all_core.insert(0, coords.bounds, exchange)
+
+    idx_metro = index.Index()
+    for exchange in metro:
+        coords = shape(exchange['geometry'])
+        idx_metro.insert(0, coords.bounds, exchange)
+
+    idx_tier_1 = index.Index()
+    for exchange in tier_1:
+        coords = shape(exchange['geometry'])
+        idx_tier_1.insert(0, coords.bounds, exchange)
+
+    idx_all = index.Index()
+    for exchange in exchanges:
+        coords = shape(exchange['geometry'])
+        idx_all.insert(0, coords.bounds, exchange)
+
+    exchanges = metro + msan + tier_1
+
+    for exchange in exchanges:
+
+        geom = shape(exchange['geometry'])
+
+        if int(exchange['properties']['inner']) > 0:
+
+            closest_nodes =  list(
+                idx_inner_core.nearest(
+                    coords.bounds,
+                    len(inner)+1,
+                    objects='raw')
+                    )
+
+            for node_1 in closest_nodes:
+
+                coords_node_1 = shape(node_1['geometry'])
+
+                for node_2 in closest_nodes:
+
+                    coords_node_2 = shape(node_2['geometry'])
+
+                    output.append({
+                        'type': exchange['type'],
+                        'geometry': {
+                            'type': 'LineString',
+                            'coordinates': [
+                                list(coords_node_1.coords)[0],
+                                list(coords_node_2.coords)[0]]
+                        },
+                        'properties': {
+                            'source': node_1['properties']['OLO'],
+                            'sink': node_2['properties']['OLO'],
+                            'population': exchange['properties']['population'],
+                            'level': 'core',
+                            'inner': exchange['properties']['inner'],
+                            'outer': exchange['properties']['outer'],
+                            'metro': exchange['properties']['metro'],
+                            'tier_1': exchange['properties']['tier_1'],
+                            'msan': exchange['properties']['msan'],
+                        }
+                    })
+
+        if int(exchange['properties']['outer']) > 0:
+
+            closest_nodes =  list(
+                idx_all_core.nearest(
+                    coords.bounds,
+                    4, objects='raw')
+                    )
+
+            for node_1 in closest_nodes:
+
+                coords_node_1 = shape(node_1['geometry'])
+
+                output.append({
+                    'type': exchange['type'],
+                    'geometry': {
+                        'type': 'LineString',
+                        'coordinates': [
+                            list(geom.coords)[0],
+                            list(coords_node_1.coords)[0],
+                        ]
+                    },
+                    'properties': {
+                        'source': exchange['properties']['OLO'],
+                        'sink': node_1['properties']['OLO'],
+                        'population': exchange['properties']['population'],
+                        'level': 'core',
+                        'inner': exchange['properties']['inner'],
+                        'outer': exchange['properties']['outer'],
+                        'metro': exchange['properties']['metro'],
+                        'tier_1': exchange['properties']['tier_1'],
+                        'msan': exchange['properties']['msan'],
+                    }
+                })
+
+        if int(exchange['properties']['metro']) > 0:
+
+            closest_nodes =  list(
+                idx_all_core.nearest(
+                    geom.bounds,
+                    3, objects='raw')
+                    )
+
+            for node_1 in closest_nodes:
+
+                coords_node_1 = shape(node_1['geometry'])
+
+                output.append({
+                    'type': exchange['type'],
+                    'geometry': {
+                        'type': 'LineString',
+                        'coordinates': [
+                            list(geom.coords)[0],
+                            list(coords_node_1.coords)[0]]
+                    },
+                    'properties': {
+                        'source': exchange['properties']['OLO'],
+                        'sink': node_1['properties']['OLO'],
+                        'population': exchange['properties']['population'],
+                        'level': 'metro',
+                        'inner': exchange['properties']['inner'],
+                        'outer': exchange['properties']['outer'],
+                        'metro': exchange['properties']['metro'],
+                        'tier_1': exchange['properties']['tier_1'],
+                        'msan': exchange['properties']['msan'],
+                    }
+                })
+
+        if int(exchange['properties']['tier_1']) > 0:
+
+            closest_nodes =  list(
+                idx_metro.nearest(
+                    geom.bounds,
+                    3, objects='raw')
+                    )
+
+            for node_1 in closest_nodes:
+
+                coords_node_1 = shape(node_1['geometry'])
+
+                output.append({
+                    'type': exchange['type'],
+                    'geometry': {
+                        'type': 'LineString',
+                        'coordinates': [
+                            list(geom.coords)[0],
+                            list(coords_node_1.coords)[0]]
+                    },
+                    'properties': {
+                        'source': exchange['properties']['OLO'],
+                        'sink': node_1['properties']['OLO'],
+                        'population': exchange['properties']['population'],
+                        'level': 'tier_1',
+                        'inner': exchange['properties']['inner'],
+                        'outer': exchange['properties']['outer'],
+                        'metro': exchange['properties']['metro'],
+                        'tier_1': exchange['properties']['tier_1'],
+                        'msan': exchange['properties']['msan'],
+                    }
+                })
+
+        if int(exchange['properties']['msan']) > 0:
+
+            closest_nodes =  list(
+                idx_tier_1.nearest(
+                    geom.bounds,
+                    3, objects='raw')
+                    )
+
+            for node in closest_nodes:
+
+                coords_nearest = shape(node['geometry'])
+
+                output.append({
+                    'type': exchange['type'],
+                    'geometry': {
+                        'type': 'LineString',
+                        'coordinates': [
+                            list(coords_nearest.coords)[0],
+                            list(geom.coords)[0]]
+                    },
+                    'properties': {
+                        'source': exchange['properties']['OLO'],
+                        'sink': node['properties']['OLO'],
+                        'population': exchange['properties']['population'],
+                        'level': 'msan',
+                        'inner': exchange['properties']['inner'],
+                        'outer': exchange['properties']['outer'],
+                        'metro': exchange['properties']['metro'],
+                        'tier_1': exchange['properties']['tier_1'],
+                        'msan': exchange['properties']['msan'],
+                    }
+                })
+
+    island_names = set()
+    for exchange in islands_lut:
+        island_names.add(exchange['island'])
+
+    island_edges = []
+
+    for island_name in list(island_names):
+        node_lut = []
+        for exchange in islands:
+            if exchange['properties']['island'] == island_name:
+                geom1 = shape(exchange['geometry'])
+
+                closest_node =  list(
+                    idx_tier_1.nearest(
+                        geom1.bounds,
+                        1, objects='raw')
+                        )[0]
+
+                geom2 = shape(closest_node['geometry'])
+
+                line = LineString([geom1, geom2])
+
+                node_lut.append({
+                    'OLO_island': exchange['properties']['OLO'],
+                    'OLO_island_geom': mapping(geom1),
+                    'OLO_mainland': closest_node['properties']['OLO'],
+                    'OLO_mainland_geom': mapping(geom2),
+                    'line': mapping(line),
+                    'length': line.length,
+                    'population': exchange['properties']['OLO'],
+                    'inner': exchange['properties']['inner'],
+                    'outer': exchange['properties']['outer'],
+                    'metro': exchange['properties']['metro'],
+                    'tier_1': exchange['properties']['tier_1'],
+                    'msan': exchange['properties']['msan'],
+                })
+
+        ranked = sorted(node_lut, reverse=False, key=lambda x: x['length'])[0]
+
+        island_edges.append({
+            'type': 'Feature',
+            'geometry': ranked['line'],
+            'properties': {
+                'source': ranked['OLO_island'],
+                'sink': ranked['OLO_mainland'],
+                'population': ranked['population'],
+                'level': 'island',
+                'inner': ranked['inner'],
+                'outer': ranked['outer'],
+                'metro': ranked['metro'],
+                'tier_1': ranked['tier_1'],
+                'msan': ranked['msan'],
+            }
+        })
+
+    return output + island_edges
+
+
+#####################################
+# capacity.py
+#####################################
+
+def pairwise(iterable):
+    """
+    Return iterable of 2-tuples in a sliding window.
+    >>> list(pairwise([1,2,3,4]))
+    [(1,2),(2,3),(3,4)]
+    """
+    a, b = tee(iterable)
+    next(b, None)
+    return zip(a, b)
+
+
+def lookup_capacity(lookup_table, environment, cell_type, frequency, bandwidth,
+    generation, site_density):
+    """
+    Use lookup table to find capacity by clutter environment geotype,
+    frequency, bandwidth, technology generation and site density.
+
+    """
+    # print(lookup_table)
+    if (environment, cell_type, frequency, bandwidth, generation) not in lookup_table:
+        raise KeyError("Combination %s not found in lookup table",
+                       (environment, cell_type, frequency, bandwidth, generation))
+
+    density_capacities = lookup_table[
+        (environment, cell_type, frequency, bandwidth, generation)
+    ]
+
+    lowest_density, lowest_capacity = density_capacities[0]
+    if site_density < lowest_density:
+        return 0
+
+    for a, b in pairwise(density_capacities):
+
+        lower_density, lower_capacity = a
+        upper_density, upper_capacity = b
+
+        if lower_density <= site_density and site_density < upper_density:
+
+            result = interpolate(
+                lower_density, lower_capacity,
+                upper_density, upper_capacity,
+                site_density
+            )
+            return result
+
+    # If not caught between bounds return highest capacity
+    highest_density, highest_capacity = density_capacities[-1]
+
+    return highest_capacity
+
+
+def interpolate(x0, y0, x1, y1, x):
+    """
+    Linear interpolation between two values.
+    """
+    y = (y0 * (x1 - x) + y1 * (x - x0)) / (x1 - x0)
+
+    return y
@@ -0,0 +1,305 @@
+"""
+Backhaul routing along the road network.
+
+Written by Ed Oughton
+
+generate_link_straight_line estimates each backhaul link as a straight
+line to the nearest exchange, but fibre follows the roads. These
+functions route each site to its nearest exchange by road instead.
+
+The road network is read from a local OSM extract (.osm.pbf, using the
+'lines' layer of the GDAL OSM driver) or GeoPackage, and built into a
+compact sparse (CSR) graph, with one node per distinct road vertex. Sites
+and exchanges are snapped to their nearest road node with a KD-tree, and
+a single multi-source Dijkstra search from all exchanges at once gives
+every node its nearest exchange and the distance to it.
+
+Links are drawn as straight lines to the exchange, with the road
+distance as their length. The road path of each link is only built
+from the search predecessors when asked for (see route_path), as
+walking every path in Python dominates the run time at national scale.
+
+Sites which cannot be routed (e.g. on an island with no roads in the
+extract) fall back to a straight line link.
+
+Usage:
+
+    network = build_road_network(read_road_network(path))
+    processed_sites, links = generate_link_routed(sites, exchanges, network)
+    processed_sites, links = generate_link_routed(sites, exchanges, network,
+        paths=True)
+
+"""
+import fiona
+import fiona.transform
+
+import numpy as np
+
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from shapely.geometry import shape, LineString, mapping
+
+from scripts.preprocess import generate_link_straight_line
+
+CRS = 'epsg:27700'
+
+#Road vertices closer than this (in metres) are treated as the same node
+PRECISION = 0.1
+
+
+def read_road_network(path, layer=None, crs=CRS):
+    """
+    Read the road lines from an OSM extract or GeoPackage, returning the
+    coordinates of each line projected to crs.
+
+    Lines in OSM extracts are only kept if they have a 'highway' tag.
+
+    """
+    if layer is None and path.endswith('.pbf'):
+        layer = 'lines'
+
+    lines = []
+
+    with fiona.open(path, 'r', layer=layer) as source:
+
+        source_crs = source.crs_wkt
+        highway = 'highway' in source.schema['properties']
+
+        for feature in source:
+            if feature['geometry'] is None:
+                continue
+            if highway and feature['properties']['highway'] is None:
+                continue
+            geometry = shape(feature['geometry'])
+            parts = getattr(geometry, 'geoms', [geometry])
+            for part in parts:
+                lines.append(list(part.coords))
+
+    if len(lines) == 0 or not source_crs:
+        return lines
+
+    xs = [x for line in lines for x, y in line]
+    ys = [y for line in lines for x, y in line]
+    xs, ys = fiona.transform.transform(source_crs, crs, xs, ys)
+
+    output = []
+    start = 0
+    for line in lines:
+        end = start + len(line)
+        output.append(list(zip(xs[start:end], ys[start:end])))
+        start = end
+
+    return output
+
+
+def build_road_network(lines, precision=PRECISION):
+    """
+    Build an undirected graph of the road network, as a CSR matrix of
+    segment lengths between road nodes, with the node coordinates and a
+    KD-tree of them for snapping.
+
+    Where two segments join the same nodes, the shorter is kept.
+
+    """
+    coords = np.array([point for line in lines for point in line], dtype=float)
+    line_ids = np.repeat(np.arange(len(lines)), [len(line) for line in lines])
+
+    keys = np.round(coords / precision).astype(np.int64)
+    keys, first, nodes = np.unique(
+        keys, axis=0, return_index=True, return_inverse=True)
+    nodes = nodes.ravel()
+    node_coords = coords[first]
+
+    same_line = line_ids[:-1] == line_ids[1:]
+    u = nodes[:-1][same_line]
+    v = nodes[1:][same_line]
+    lengths = np.hypot(*(coords[1:][same_line] - coords[:-1][same_line]).T)
+
+    keep = u != v
+    u, v, lengths = np.minimum(u, v)[keep], np.maximum(u, v)[keep], lengths[keep]
+
+    order = np.lexsort((lengths, v, u))
+    u, v, lengths = u[order], v[order], lengths[order]
+    first_edge = np.ones(len(u), dtype=bool)
+    first_edge[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+
+    graph = csr_matrix(
+        (lengths[first_edge], (u[first_edge], v[first_edge])),
+        shape=(len(node_coords), len(node_coords)))
+
+    return {
+        'graph': graph,
+        'nodes': node_coords,
+        'tree': cKDTree(node_coords),
+    }
+
+
+def snap_points(network, points):
+    """
+    Return the nearest road node to each point feature, and the distance
+    to it.
+
+    """
+    coords = np.array(
+        [point['geometry']['coordinates'][:2] for point in points], dtype=float)
+
+    distances, nodes = network['tree'].query(coords.reshape(-1, 2))
+
+    return nodes, distances
+
+
+def route_to_nearest(network, dest_nodes):
+    """
+    Search from all destination nodes at once, returning for every road
+    node the distance to its nearest destination node, the predecessor of
+    each node on that path and the destination node reached.
+
+    """
+    return dijkstra(network['graph'], directed=False,
+        indices=np.unique(dest_nodes), return_predecessors=True, min_only=True)
+
+
+def path_nodes(predecessors, node):
+    """
+    Follow the predecessors from a node back to its source node.
+
+    """
+    output = [node]
+
+    while predecessors[node] >= 0:
+        node = predecessors[node]
+        output.append(node)
+
+    return output
+
+
+def route_sites(network, origin_points, dest_points):
+    """
+    Route each origin point to its nearest destination by road.
+
+    Returns the position of each origin's destination (-1 where it cannot
+    reach any destination) and its length in metres, including the
+    straight distance from each point to the road, with the origin nodes
+    and the predecessors of the search for building paths on demand with
+    route_path.
+
+    """
+    origin_nodes, origin_snaps = snap_points(network, origin_points)
+    dest_nodes, dest_snaps = snap_points(network, dest_points)
+
+    distances, predecessors, sources = route_to_nearest(network, dest_nodes)
+
+    #the first destination snapped to each node is the one linked to
+    unique_nodes, first = np.unique(dest_nodes, return_index=True)
+
+    road_distances = distances[origin_nodes]
+    routed = np.isfinite(road_distances)
+
+    destinations = np.full(len(origin_nodes), -1)
+    destinations[routed] = first[
+        np.searchsorted(unique_nodes, sources[origin_nodes[routed]])]
+
+    lengths = np.full(len(origin_nodes), np.inf)
+    lengths[routed] = (origin_snaps[routed] + road_distances[routed] +
+        dest_snaps[destinations[routed]])
+
+    return {
+        'destinations': destinations,
+        'lengths': lengths,
+        'origin_nodes': origin_nodes,
+        'predecessors': predecessors,
+    }
+
+
+def route_path(network, routes, position):
+    """
+    Return the coordinates of the road nodes on the route of an origin
+    point to its destination, from route_sites.
+
+    """
+    return [
+        tuple(network['nodes'][n]) for n in path_nodes(
+            routes['predecessors'], routes['origin_nodes'][position])
+    ]
+
+
+def generate_link_routed(origin_points, dest_points, network, idx=None,
+    paths=False):
+    """
+    Link each origin point to its nearest destination along the road
+    network, returning sites and links as generate_link_straight_line.
+
+    Link lengths are the road distance in metres, plus the straight
+    distance from each point to the road. Links are drawn as straight
+    lines to the destination, unless paths is True, in which case they
+    follow the roads (building each path is much slower than the search
+    itself at national scale).
+
+    Origins which cannot reach any destination by road get a straight
+    line link (using idx if given), and are added after the routed
+    origins.
+
+    """
+    origin_points = list(origin_points)
+    dest_points = list(dest_points)
+
+    routes = route_sites(network, origin_points, dest_points)
+
+    processed_sites = []
+    links = []
+    unrouted = []
+
+    for position, origin_point in enumerate(origin_points):
+
+        dest_position = routes['destinations'][position]
+        if dest_position < 0:
+            unrouted.append(origin_point)
+            continue
+
+        exchange = dest_points[dest_position]
+        length = float(routes['lengths'][position])
+
+        coordinates = [tuple(origin_point['geometry']['coordinates'][:2])]
+        if paths:
+            coordinates.extend(route_path(network, routes, position))
+        coordinates.append(tuple(exchange['geometry']['coordinates'][:2]))
+
+        site_properties = {
+            'id': origin_point['properties']['id'],
+            'name': origin_point['properties']['name'],
+            'lte_4G': origin_point['properties']['lte_4G'],
+            'exchange_id': exchange['properties']['exchange_id'],
+            'backhaul_length_m': length,
+            }
+        link_properties = {
+            "origin_id": origin_point['properties']['name'],
+            "dest_id": exchange['properties']['exchange_id'],
+            "length": length,
+        }
+        if 'operator' in origin_point['properties']:
+            site_properties['operator'] = origin_point['properties']['operator']
+            link_properties['operator'] = origin_point['properties']['operator']
+
+        processed_sites.append({
+            'type': 'Feature',
+            'geometry': origin_point['geometry'],
+            'properties': site_properties,
+        })
+
+        links.append({
+            'type': "Feature",
+            'geometry': mapping(LineString(coordinates)),
+            'properties': link_properties,
+        })
+
+    if len(unrouted) > 0:
+        print('Using straight line links for {} sites with no road route'.format(
+            len(unrouted)))
+        fallback_sites, fallback_links = generate_link_straight_line(
+            unrouted, dest_points, idx)
+        processed_sites.extend(fallback_sites)
+        links.extend(fallback_links)
+
+    return processed_sites, links
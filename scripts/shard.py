@@ -0,0 +1,617 @@
+"""
+Sharded runs across machines sharing a job directory.
+
+Written by Ed Oughton
+
+parallel.py and evaluate.py spread the per-LAD preprocessing and the
+capacity margins over the processes of one machine. For national runs of
+many scenarios, this script instead splits the work into jobs of a group
+of LADs and a block of scenarios, listed in a manifest in a shared
+directory (e.g. on a network file system). Any number of workers, on any
+number of machines, then claim and run jobs until none are left, and a
+merge step assembles the results. No scheduler or server is needed.
+
+A job is claimed by creating its claim file with O_CREAT | O_EXCL, which
+only one worker can do. Workers touch their claim file while a job runs,
+so the claims of workers which died can be broken once they are older
+than the lease, and remove it when the job finishes or fails, so a failed
+job can be retried. Every output is written to a temporary file and moved
+into place, so a job's output only exists once it is complete, and a job
+whose output exists is done. Workers keep polling until every job is
+done, so jobs left by workers which died are picked up once their claims
+can be broken.
+
+Each job first runs the per-LAD stages of parallel.py for its group of
+LADs, then evaluates the capacity margins of the group's sectors for its
+block of scenarios. The per-LAD stages are shared by the jobs of a group,
+so are claimed and cached separately, and the group's jobs wait until
+they are done.
+
+Usage:
+
+    python -m scripts.shard plan /shared/run --groups 40 --scenario-blocks 3
+    python -m scripts.shard work /shared/run --processes 8
+    python -m scripts.shard merge /shared/run
+
+"""
+import os
+import argparse
+import json
+import socket
+import threading
+import time
+
+from multiprocessing import Process
+
+import pandas as pd
+
+from shapely.geometry import shape
+from rtree import index
+
+from scripts.capacity import load_capacity_lookup_table
+from scripts.evaluate import (SCENARIOS, sectors_to_frame, evaluate_margins,
+    sector_index)
+from scripts.geoparquet import read_features, write_features
+from scripts.parallel import shard_by_lad, process_lad_shard, wkb_to_features
+from scripts.pipeline import CHECKPOINTS, CRS, checkpoint_path
+from scripts.config import BASE_PATH
+
+DATA_RAW = os.path.join(BASE_PATH, 'raw')
+
+#Seconds after which the claim of a worker which stopped touching it can
+#be broken
+LEASE = 600
+
+#Seconds workers wait before checking again when every job left is claimed
+POLL = 10
+
+
+def group_lads(postcode_sectors, lad_ids, groups):
+    """
+    Split the LADs into groups, balancing the number of postcode sectors
+    in each group, and keeping the LADs of each group in lad_ids order.
+
+    """
+    sizes = {lad_id: 0 for lad_id in lad_ids}
+    for postcode_sector in postcode_sectors:
+        if postcode_sector['properties']['lad'] in sizes:
+            sizes[postcode_sector['properties']['lad']] += 1
+
+    totals = [0] * groups
+    members = [[] for i in range(groups)]
+
+    for lad_id in sorted(lad_ids, key=lambda lad_id: -sizes[lad_id]):
+        if sizes[lad_id] == 0:
+            continue
+        smallest = totals.index(min(totals))
+        members[smallest].append(lad_id)
+        totals[smallest] += sizes[lad_id]
+
+    position = {lad_id: i for i, lad_id in enumerate(lad_ids)}
+
+    return [
+        sorted(group, key=lambda lad_id: position[lad_id])
+        for group in members if group
+    ]
+
+
+def scenario_blocks(scenarios, blocks):
+    """
+    Split the scenarios into contiguous blocks of (start, end) positions.
+
+    """
+    size = -(-len(scenarios) // max(1, blocks))
+
+    return [
+        (start, min(start + size, len(scenarios)))
+        for start in range(0, len(scenarios), size)
+    ]
+
+
+def shard_path(directory, *parts):
+    """
+    Return a path in the shard directory.
+
+    """
+    return os.path.join(directory, *parts)
+
+
+def write_atomic(write, path):
+    """
+    Write a file with write(temp_path), moving it into place once it is
+    complete, with a temporary path unique to this process.
+
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    temp_path = '{}.{}.{}.part'.format(path, socket.gethostname(), os.getpid())
+    write(temp_path)
+    os.replace(temp_path, path)
+
+
+def write_json_atomic(data, path):
+    """
+    Write a json file in a single step.
+
+    """
+    def write(temp_path):
+        with open(temp_path, 'w') as sink:
+            json.dump(data, sink, indent=2)
+
+    write_atomic(write, path)
+
+
+def read_json_file(path):
+    """
+    Read a json file.
+
+    """
+    with open(path, 'r') as source:
+        return json.load(source)
+
+
+def plan_shards(directory, postcode_sectors, weights, sites, lads, scenarios,
+    groups, blocks, capacity_path):
+    """
+    Write the manifest of jobs (LAD groups by scenario blocks) to the
+    shared directory, with the inputs of each LAD group.
+
+    postcode_sectors, weights, sites and lads are the pipeline datasets
+    sectors_lad, weights, sites and lads.
+
+    """
+    lad_ids = [lad['properties']['name'] for lad in lads]
+    lad_groups = group_lads(postcode_sectors, lad_ids, groups)
+    block_ranges = scenario_blocks(scenarios, blocks)
+
+    idx = index.Index(
+        (i, shape(site['geometry']).bounds, None) for i, site in enumerate(sites))
+
+    weights_by_id = {}
+    for weight in weights:
+        weights_by_id.setdefault(weight['id'].replace(' ', ''), []).append(weight)
+
+    for g, group in enumerate(lad_groups):
+
+        members = set(group)
+        group_sectors = [
+            s for s in postcode_sectors if s['properties']['lad'] in members]
+
+        group_weights = []
+        site_ids = set()
+        for postcode_sector in group_sectors:
+            group_weights.extend(weights_by_id.get(
+                postcode_sector['properties']['id'].replace(' ', ''), []))
+            site_ids.update(
+                idx.intersection(shape(postcode_sector['geometry']).bounds))
+
+        for dataset, data in [
+            ('postcode_sectors', group_sectors),
+            ('weights', group_weights),
+            ('sites', [sites[i] for i in sorted(site_ids)])]:
+            path = shard_path(directory, 'inputs',
+                'group_{}_{}.parquet'.format(g, dataset))
+            write_atomic(lambda temp_path: write_features(data, temp_path, CRS),
+                path)
+
+    jobs = [
+        {
+            'id': 'group_{}_block_{}'.format(g, b),
+            'group': g,
+            'block': b,
+        }
+        for g in range(len(lad_groups))
+        for b in range(len(block_ranges))
+    ]
+
+    manifest = {
+        'lads': lad_ids,
+        'groups': lad_groups,
+        'blocks': block_ranges,
+        'capacity_lookup_table': os.path.abspath(capacity_path),
+        'jobs': jobs,
+    }
+
+    write_json_atomic(scenarios, shard_path(directory, 'scenarios.json'))
+    write_json_atomic(manifest, shard_path(directory, 'manifest.json'))
+
+    print('Planned {} jobs ({} LAD groups, {} scenario blocks)'.format(
+        len(jobs), len(lad_groups), len(block_ranges)))
+
+    return manifest
+
+
+def claim_path(directory, name):
+    """
+    Return the path of the claim file for a job or group.
+
+    """
+    return shard_path(directory, 'claims', '{}.claim'.format(name))
+
+
+def claim(path, worker, lease=LEASE):
+    """
+    Claim a job or group, returning True if this worker now holds it.
+
+    A claim older than the lease is broken first. Only the worker which
+    creates the claim's break file can break it, and it checks the claim
+    is still stale before removing it.
+
+    """
+    if lease is not None and os.path.exists(path):
+        try:
+            stale = time.time() - os.path.getmtime(path) > lease
+        except FileNotFoundError:
+            stale = False
+        if stale:
+            break_claim(path, lease)
+
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(fd, 'w') as sink:
+        json.dump({'worker': worker, 'claimed': time.time()}, sink)
+
+    return True
+
+
+def break_claim(path, lease):
+    """
+    Remove a claim which has not been touched within the lease.
+
+    A worker which dies while breaking a claim leaves its break file
+    behind, so a break file older than the lease is removed, and the
+    claim is broken on a later poll.
+
+    """
+    try:
+        fd = os.open(path + '.break', os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(path + '.break') > lease:
+                print('Removing stale break file for {}'.format(
+                    os.path.basename(path)))
+                os.remove(path + '.break')
+        except FileNotFoundError:
+            pass
+        return
+    os.close(fd)
+
+    try:
+        if time.time() - os.path.getmtime(path) > lease:
+            print('Breaking stale claim {}'.format(os.path.basename(path)))
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    finally:
+        os.remove(path + '.break')
+
+
+def touch_claim(path, stop, interval):
+    """
+    Touch a claim file every interval seconds until stop is set.
+
+    """
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return
+
+
+def run_claimed(path, lease, function, *args):
+    """
+    Run function while touching the claim at path, removing the claim
+    once it returns or raises.
+
+    """
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=touch_claim,
+        args=(path, stop, max(1, (lease or LEASE) / 4)), daemon=True)
+    heartbeat.start()
+
+    try:
+        return function(*args)
+    finally:
+        stop.set()
+        heartbeat.join()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def group_counts_path(directory, g):
+    """
+    Return the path of a LAD group's site counts, the last of its cached
+    results to be written.
+
+    """
+    return shard_path(directory, 'groups', 'group_{}_counts.json'.format(g))
+
+
+def group_done(directory, g):
+    """
+    Check if the per-LAD stages of a LAD group have been run.
+
+    """
+    return os.path.exists(group_counts_path(directory, g))
+
+
+def preprocess_group(directory, manifest, g):
+    """
+    Run the per-LAD stages for a LAD group, reading the cached results if
+    another job of the group has already run them.
+
+    Returns the postcode sectors and sites, and the number of sites from
+    each LAD of the group (as sites on a boundary can be in more than one
+    LAD's results).
+
+    """
+    paths = {
+        dataset: shard_path(directory, 'groups',
+            'group_{}_{}.parquet'.format(g, dataset))
+        for dataset in ['sectors_coverage', 'sites_coverage']
+    }
+    counts_path = group_counts_path(directory, g)
+
+    if os.path.exists(counts_path):
+        return (read_features(paths['sectors_coverage']),
+            read_features(paths['sites_coverage']), read_json_file(counts_path))
+
+    inputs = {
+        dataset: read_features(shard_path(directory, 'inputs',
+            'group_{}_{}.parquet'.format(g, dataset)))
+        for dataset in ['postcode_sectors', 'weights', 'sites']
+    }
+
+    sectors = []
+    sites = []
+    counts = []
+
+    for shard in shard_by_lad(inputs['postcode_sectors'], inputs['weights'],
+        inputs['sites'], manifest['groups'][g]):
+        shard_sectors, shard_sites = process_lad_shard(shard)
+        sectors.extend(wkb_to_features(shard_sectors))
+        sites.extend(wkb_to_features(shard_sites))
+        counts.append([shard['lad'], len(shard_sites)])
+
+    for path, data in [(paths['sectors_coverage'], sectors),
+        (paths['sites_coverage'], sites)]:
+        write_atomic(lambda temp_path: write_features(data, temp_path, CRS), path)
+
+    #written last, so the cache is only used once it is complete
+    write_json_atomic(counts, counts_path)
+
+    return sectors, sites, counts
+
+
+def run_job(directory, manifest, scenarios, job):
+    """
+    Run one job, writing the capacity margins of its LAD group and
+    scenario block.
+
+    """
+    sectors, sites, counts = preprocess_group(directory, manifest, job['group'])
+
+    start, end = manifest['blocks'][job['block']]
+    capacity_lookup_table = load_capacity_lookup_table(
+        manifest['capacity_lookup_table'])
+
+    margins = evaluate_margins(sectors_to_frame(sectors, sites),
+        capacity_lookup_table, scenarios[start:end])
+
+    write_atomic(lambda temp_path: margins.to_parquet(temp_path, index=False),
+        shard_path(directory, 'outputs', '{}.parquet'.format(job['id'])))
+
+
+def job_done(directory, job):
+    """
+    Check if a job's output exists.
+
+    """
+    return os.path.exists(
+        shard_path(directory, 'outputs', '{}.parquet'.format(job['id'])))
+
+
+def work(directory, lease=LEASE, max_jobs=None, poll=POLL):
+    """
+    Claim and run jobs until every job is done, returning the number of
+    jobs run.
+
+    The per-LAD stages of a job's group are claimed and run first, if
+    they are not done. When every job left is claimed by another worker
+    (or waiting on its group), the worker waits poll seconds and checks
+    again, breaking any claims which have gone stale.
+
+    """
+    manifest = read_json_file(shard_path(directory, 'manifest.json'))
+    scenarios = read_json_file(shard_path(directory, 'scenarios.json'))
+
+    os.makedirs(shard_path(directory, 'claims'), exist_ok=True)
+
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    count = 0
+
+    while max_jobs is None or count < max_jobs:
+
+        pending = [job for job in manifest['jobs'] if not job_done(directory, job)]
+        if not pending:
+            break
+
+        progress = False
+
+        for job in pending:
+
+            if max_jobs is not None and count >= max_jobs:
+                break
+
+            g = job['group']
+            if not group_done(directory, g):
+                path = claim_path(directory, 'group_{}'.format(g))
+                if not claim(path, worker, lease):
+                    continue
+                #the group may have been run since it was checked
+                if not group_done(directory, g):
+                    print('{} preprocessing group {}'.format(worker, g))
+                    run_claimed(path, lease, preprocess_group,
+                        directory, manifest, g)
+                else:
+                    os.remove(path)
+                progress = True
+
+            path = claim_path(directory, job['id'])
+            if job_done(directory, job) or not claim(path, worker, lease):
+                continue
+
+            #the output may have been written since it was checked
+            if job_done(directory, job):
+                os.remove(path)
+                continue
+
+            print('{} running {}'.format(worker, job['id']))
+            run_claimed(path, lease, run_job, directory, manifest, scenarios, job)
+            count += 1
+            progress = True
+
+        if not progress:
+            time.sleep(poll)
+
+    return count
+
+
+def work_locally(directory, processes, lease=LEASE, poll=POLL):
+    """
+    Run several workers as local processes, as on separate machines.
+
+    """
+    workers = [
+        Process(target=work, args=(directory, lease, None, poll))
+        for i in range(processes)
+    ]
+
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+
+def merge_shards(directory):
+    """
+    Assemble the outputs of every job into the postcode sectors and sites
+    (in the LAD order of parallel.process_by_lad) and the capacity margins
+    (in the order of evaluate.evaluate_margins), written to 'merged'.
+
+    """
+    manifest = read_json_file(shard_path(directory, 'manifest.json'))
+    scenarios = read_json_file(shard_path(directory, 'scenarios.json'))
+
+    missing = [job['id'] for job in manifest['jobs'] if not job_done(directory, job)]
+    if missing:
+        raise FileNotFoundError('{} jobs are not done: {}'.format(
+            len(missing), ', '.join(missing[:10])))
+
+    lad_order = {lad_id: i for i, lad_id in enumerate(manifest['lads'])}
+
+    sectors = []
+    sites = []
+    for g in range(len(manifest['groups'])):
+        group_sectors, group_sites, counts = preprocess_group(
+            directory, manifest, g)
+        sectors.extend(group_sectors)
+        start = 0
+        for lad_id, count in counts:
+            sites.append((lad_order[lad_id], group_sites[start:start + count]))
+            start += count
+
+    sectors.sort(key=lambda sector: lad_order[sector['properties']['lad']])
+    sites = [
+        site for lad, lad_sites in sorted(sites, key=lambda item: item[0])
+        for site in lad_sites
+    ]
+
+    margins = pd.concat([
+        pd.read_parquet(
+            shard_path(directory, 'outputs', '{}.parquet'.format(job['id'])))
+        for job in manifest['jobs']
+    ], ignore_index=True)
+
+    frame = sectors_to_frame(sectors, sites)
+    sector_order = pd.Series(range(len(frame)), index=sector_index(frame))
+    scenario_order = {
+        (s['scenario'], s['year']): i for i, s in enumerate(scenarios)}
+
+    margins['_scenario'] = [
+        scenario_order[key] for key in zip(margins['scenario'], margins['year'])]
+    margins['_sector'] = sector_order.reindex(sector_index(margins)).to_numpy()
+    margins = margins.sort_values(['_scenario', '_sector'], kind='stable')
+    margins = margins.drop(columns=['_scenario', '_sector']).reset_index(drop=True)
+
+    merged = shard_path(directory, 'merged')
+    write_features(sectors, os.path.join(merged, 'sectors_coverage.parquet'), CRS)
+    write_features(sites, os.path.join(merged, 'sites_coverage.parquet'), CRS)
+    margins.to_parquet(os.path.join(merged, 'capacity_margins.parquet'), index=False)
+
+    print('Merged {} jobs'.format(len(manifest['jobs'])))
+
+    return sectors, sites, margins
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Plan, run and merge sharded jobs in a shared directory.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan = subparsers.add_parser('plan', help='write the job manifest')
+    plan.add_argument('directory')
+    plan.add_argument('--checkpoints', default=CHECKPOINTS,
+        help='pipeline checkpoint directory, run up to the buffering stage')
+    plan.add_argument('--groups', type=int, default=40,
+        help='number of LAD groups')
+    plan.add_argument('--scenario-blocks', type=int, default=1,
+        help='number of scenario blocks')
+    plan.add_argument('--scenarios',
+        help='json file of scenarios (by default those of evaluate.py)')
+    plan.add_argument('--capacity-lookup-table', default=os.path.join(
+        DATA_RAW, 'capacity_lut_by_frequency_10.csv'))
+
+    worker = subparsers.add_parser('work', help='claim and run jobs')
+    worker.add_argument('directory')
+    worker.add_argument('--processes', type=int, default=1,
+        help='number of worker processes on this machine')
+    worker.add_argument('--lease', type=float, default=LEASE,
+        help='seconds after which an untouched claim can be broken')
+    worker.add_argument('--poll', type=float, default=POLL,
+        help='seconds to wait before checking again when all jobs left are '
+        'claimed')
+
+    merge = subparsers.add_parser('merge', help='assemble the job outputs')
+    merge.add_argument('directory')
+
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        scenarios = SCENARIOS
+        if args.scenarios:
+            scenarios = read_json_file(args.scenarios)
+        datasets = {
+            dataset: read_features(checkpoint_path(args.checkpoints, dataset))
+            for dataset in ['sectors_lad', 'weights', 'sites', 'lads']
+        }
+        plan_shards(args.directory, datasets['sectors_lad'], datasets['weights'],
+            datasets['sites'], datasets['lads'], scenarios, args.groups,
+            args.scenario_blocks, args.capacity_lookup_table)
+
+    elif args.command == 'work':
+        if args.processes > 1:
+            work_locally(args.directory, args.processes, args.lease, args.poll)
+        else:
+            work(args.directory, args.lease, poll=args.poll)
+
+    elif args.command == 'merge':
+        merge_shards(args.directory)
@@ -0,0 +1,124 @@
+"""
+Simplified boundary cache for point-in-polygon tests.
+
+Written by Ed Oughton
+
+The LAD and postcode sector boundaries are full resolution coastline
+polygons, so testing whether a point or site falls within them is slow
+and the shapes take a lot of memory. Most points are nowhere near a
+boundary, so these tests can be answered from a simplified boundary.
+
+Each polygon is simplified (preserving topology) at a tolerance, then
+buffered inwards and outwards. A geometry which intersects the inner
+boundary intersects the polygon, and a geometry which misses the outer
+boundary misses it. Only geometries in the band between the two are
+tested against the full resolution polygon, so results are exact.
+
+The inner and outer boundaries are cached to disk as Parquet, keyed on
+the source hash and the tolerance.
+
+"""
+import os
+
+from shapely import wkb
+from shapely.geometry import shape
+from shapely.prepared import prep
+
+from scripts.geoparquet import read_features, write_features
+from scripts.config import BASE_PATH
+
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+
+SIMPLIFIED_DIRECTORY = os.path.join(DATA_INTERMEDIATE, 'simplified')
+
+#Buffer by twice the tolerance, so the coarse (2 segments per quarter
+#circle) buffer still clears every point within the tolerance
+BUFFER_FACTOR = 2
+
+BUFFER_RESOLUTION = 2
+
+
+def simplify_boundary(geometry, tolerance):
+    """
+    Return the bounds, inner and outer boundaries (as WKB) of a polygon
+    simplified at a tolerance.
+
+    """
+    polygon = shape(geometry)
+    simplified = polygon.simplify(tolerance, preserve_topology=True)
+    distance = tolerance * BUFFER_FACTOR
+
+    return {
+        'bounds': list(polygon.bounds),
+        'inner': simplified.buffer(-distance, BUFFER_RESOLUTION).wkb,
+        'outer': simplified.buffer(distance, BUFFER_RESOLUTION).wkb,
+    }
+
+
+def load_boundaries(records):
+    """
+    Decode and prepare cached boundaries for fast predicates.
+
+    """
+    return [
+        {
+            'bounds': tuple(record['bounds']),
+            'inner': prep(wkb.loads(record['inner'])),
+            'outer': prep(wkb.loads(record['outer'])),
+        }
+        for record in records
+    ]
+
+
+def simplify_boundaries(features, tolerance):
+    """
+    Simplify the boundaries of a list of polygon features, in order.
+
+    """
+    return load_boundaries(
+        [simplify_boundary(feature['geometry'], tolerance) for feature in features])
+
+
+def cached_boundaries(name, features, tolerance, source_hash,
+    directory=SIMPLIFIED_DIRECTORY):
+    """
+    Read the simplified boundaries for this name, source hash and
+    tolerance, simplifying and saving them first if they do not exist.
+
+    As with spatial_index.cached_index, boundaries are stored by position,
+    so the source hash should identify both the source file and the
+    features selected from it.
+
+    """
+    path = os.path.join(directory, '{}_{}_{}.parquet'.format(
+        name, source_hash[:16], tolerance))
+
+    if os.path.exists(path):
+        records = read_features(path)
+        if len(records) == len(features):
+            return load_boundaries(records)
+
+    records = [
+        simplify_boundary(feature['geometry'], tolerance) for feature in features
+    ]
+
+    if len(records) > 0:
+        write_features(records, path)
+
+    return load_boundaries(records)
+
+
+def boundary_intersects(boundary, geometry, exact):
+    """
+    Test whether a geometry intersects a polygon from its simplified
+    boundary, only calling exact() for the full resolution polygon when
+    the geometry is near its edge.
+
+    """
+    if boundary['inner'].intersects(geometry):
+        return True
+
+    if not boundary['outer'].intersects(geometry):
+        return False
+
+    return exact().intersects(geometry)
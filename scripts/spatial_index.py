@@ -0,0 +1,144 @@
+"""
+Persistent on-disk spatial indexes.
+
+Written by Ed Oughton
+
+LAD, postcode sector and exchange boundaries change at most once a year,
+yet each run rebuilds the same rtree indexes from scratch. These
+functions build file-backed rtree indexes once, keyed on the hash of the
+source data, and reopen them on later runs.
+
+Indexes store the position of each feature in its list, rather than the
+feature itself, so the features must be read in the same order as when
+the index was built. This is guaranteed by keying the index on the
+source file hash (and any filters applied when reading it).
+
+"""
+import os
+
+from shapely.geometry import shape
+
+from rtree import index
+
+from scripts.config import BASE_PATH
+
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+
+INDEX_DIRECTORY = os.path.join(DATA_INTERMEDIATE, 'indexes')
+
+
+def feature_bounds(features):
+    """
+    Return the bounds of each feature's geometry.
+
+    """
+    return [shape(feature['geometry']).bounds for feature in features]
+
+
+def build_index(bounds, basename=None, stream=True):
+    """
+    Build an rtree index from a list of bounds, with the position of each
+    item as its id, either in memory or in files at basename.
+
+    Bulk loading from a stream gives a better packed tree, while inserting
+    one item at a time matches indexes built incrementally.
+
+    """
+    args = [] if basename is None else [basename]
+
+    if stream and len(bounds) > 0:
+        return index.Index(*args, ((i, b, None) for i, b in enumerate(bounds)))
+
+    idx = index.Index(*args)
+    for i, b in enumerate(bounds):
+        idx.insert(i, b)
+
+    return idx
+
+
+def index_size(idx):
+    """
+    Return the number of items in an rtree index.
+
+    """
+    bounds = idx.bounds
+
+    if bounds[0] > bounds[2]:
+        return 0
+
+    return idx.count(bounds)
+
+
+def index_basename(name, source_hash, directory=INDEX_DIRECTORY):
+    """
+    Return the basename of the file-backed index for a name and source
+    hash.
+
+    """
+    return os.path.join(directory, '{}_{}'.format(name, source_hash[:16]))
+
+
+def open_cached_index(name, source_hash, size, directory=INDEX_DIRECTORY):
+    """
+    Open the file-backed index for this name and source hash if it exists
+    and holds size items, or else return None.
+
+    """
+    basename = index_basename(name, source_hash, directory)
+
+    if os.path.exists(basename + '.idx') and os.path.exists(basename + '.dat'):
+        idx = index.Index(basename)
+        if index_size(idx) == size:
+            return idx
+        idx.close()
+
+    return None
+
+
+def cached_index(name, bounds, source_hash, directory=INDEX_DIRECTORY,
+    stream=True):
+    """
+    Open the file-backed index for this name and source hash, building and
+    saving it first if it does not exist.
+
+    An index with the wrong number of items (e.g. after an interrupted
+    build) is rebuilt.
+
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    idx = open_cached_index(name, source_hash, len(bounds), directory)
+    if idx is not None:
+        return idx
+
+    basename = index_basename(name, source_hash, directory)
+
+    temp_basename = '{}_{}'.format(basename, os.getpid())
+    idx = build_index(bounds, temp_basename, stream)
+    idx.close()
+
+    for extension in ['.idx', '.dat']:
+        os.replace(temp_basename + extension, basename + extension)
+
+    return index.Index(basename)
+
+
+def cached_feature_index(name, features, source_hash, directory=INDEX_DIRECTORY,
+    stream=True):
+    """
+    Open the file-backed index of a list of features for this name and
+    source hash, only decoding the feature geometries if the index has to
+    be built.
+
+    The source hash should identify the features without reading their
+    geometries (e.g. the source file hash and the features selected from
+    it), so reopening a cached index costs no more than opening its files.
+
+    """
+    idx = open_cached_index(name, source_hash, len(features), directory)
+    if idx is not None:
+        return idx
+
+    return cached_index(name, feature_bounds(features), source_hash, directory,
+        stream)
@@ -0,0 +1,323 @@
+"""
+Parameter sweep of the fixed network architecture.
+
+Written by Ed Oughton
+
+core.connect makes the 1,000 most populous lower exchanges tier_1 nodes,
+and connects each outer core, metro, tier_1 and MSAN node to its 4, 3, 3
+and 3 nearest nodes in the layer above. This script compares the number
+of nodes, edges and the network length over grids of these parameters.
+
+Each layer of links only depends on some of the parameters (e.g. metro
+links only on the metro fan-out, MSAN links on the tier_1 count and MSAN
+fan-out), so each layer is summarised once for each distinct combination
+of the parameters it depends on, and the summaries are reused across
+configurations. The population ranking of lower exchanges and the core
+and metro indexes are built once in each worker, and the tier_1 split
+and index once for each tier_1 count.
+
+Usage:
+
+    python -m scripts.sweep --tier-1-counts 500 1000 2000 --msan-links 1 2 3
+    python -m scripts.sweep --catchment-population
+
+"""
+import os
+import argparse
+import itertools
+import math
+
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from shapely.geometry import shape
+
+from scripts.core import (TIER_1_COUNT, CORE_LINKS, METRO_LINKS, TIER_1_LINKS,
+    MSAN_LINKS, POSTCODE_SECTOR_PATH, EXCHANGE_AREA_PATH, catchment_population,
+    read_existing_nodes, read_lookup, determine_nodes,
+    import_islands, process_islands, rank_exchanges, split_lower_exchanges,
+    inner_core_links, nearest_links, island_links)
+from scripts.spatial_index import feature_bounds, build_index
+from scripts.config import BASE_PATH
+
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+
+PARAMETERS = ['tier_1_count', 'core_links', 'metro_links', 'tier_1_links',
+    'msan_links']
+
+DEFAULTS = {
+    'tier_1_count': TIER_1_COUNT,
+    'core_links': CORE_LINKS,
+    'metro_links': METRO_LINKS,
+    'tier_1_links': TIER_1_LINKS,
+    'msan_links': MSAN_LINKS,
+}
+
+#The parameters each level of links depends on
+LEVEL_PARAMETERS = {
+    'core': ['core_links'],
+    'metro': ['metro_links'],
+    'tier_1': ['tier_1_count', 'tier_1_links'],
+    'msan': ['tier_1_count', 'msan_links'],
+    'island': ['tier_1_count'],
+}
+
+STATE = {}
+
+
+def init_worker(exchanges, islands, islands_lut):
+    """
+    Rank the exchanges and build the core and metro indexes once for
+    each worker process.
+
+    """
+    inner, outer, metro, lower, ranked = rank_exchanges(exchanges)
+
+    STATE.clear()
+    STATE.update({
+        'exchanges': exchanges,
+        'islands': islands,
+        'islands_lut': islands_lut,
+        'inner': inner,
+        'outer': outer,
+        'metro': metro,
+        'lower': lower,
+        'ranked': ranked,
+        'coords': shape(exchanges[-1]['geometry']),
+        'indexes': {
+            name: build_index(feature_bounds(layer), stream=False)
+            for name, layer in [('inner', inner), ('outer', outer), ('metro', metro)]
+        },
+        'tiers': {},
+    })
+
+
+def tiers(tier_1_count):
+    """
+    Return the tier_1 nodes, MSANs and tier_1 index for a tier_1 count,
+    splitting the ranked lower exchanges once for each count.
+
+    """
+    if tier_1_count not in STATE['tiers']:
+        tier_1, msan = split_lower_exchanges(
+            STATE['lower'], STATE['ranked'], tier_1_count)
+        idx_tier_1 = build_index(feature_bounds(tier_1), stream=False)
+        STATE['tiers'][tier_1_count] = (tier_1, msan, idx_tier_1)
+
+    return STATE['tiers'][tier_1_count]
+
+
+def level_links(level, parameters):
+    """
+    Generate one level of links as core.connect does, for the parameters
+    that level depends on.
+
+    """
+    indexes = STATE['indexes']
+    output = []
+
+    if level == 'island':
+        tier_1, msan, idx_tier_1 = tiers(parameters['tier_1_count'])
+        return island_links(STATE['islands'], STATE['islands_lut'],
+            tier_1, idx_tier_1)
+
+    if level in ('core', 'metro'):
+        #the tier_1 and MSAN copies of lower exchanges keep their core and
+        #metro flags, so any split gives the same core and metro links
+        exchanges = STATE['metro'] + STATE['lower']
+    else:
+        tier_1, msan, idx_tier_1 = tiers(parameters['tier_1_count'])
+        exchanges = STATE['metro'] + msan + tier_1
+
+    for exchange in exchanges:
+
+        if level == 'core':
+            if int(exchange['properties']['inner']) > 0:
+                output.extend(inner_core_links(exchange, STATE['inner'],
+                    indexes['inner'], STATE['coords']))
+            if int(exchange['properties']['outer']) > 0:
+                output.extend(nearest_links(exchange, STATE['outer'],
+                    indexes['outer'], parameters['core_links'], 'core',
+                    origin=STATE['coords']))
+
+        elif level == 'metro' and int(exchange['properties']['metro']) > 0:
+            output.extend(nearest_links(exchange, STATE['outer'],
+                indexes['outer'], parameters['metro_links'], 'metro'))
+
+        elif level == 'tier_1' and int(exchange['properties']['tier_1']) > 0:
+            output.extend(nearest_links(exchange, STATE['metro'],
+                indexes['metro'], parameters['tier_1_links'], 'tier_1'))
+
+        elif level == 'msan' and int(exchange['properties']['msan']) > 0:
+            output.extend(nearest_links(exchange, tier_1, idx_tier_1,
+                parameters['msan_links'], 'msan', reverse=True))
+
+    return output
+
+
+def link_length(link):
+    """
+    Return the length of a straight line link.
+
+    """
+    coordinates = link['geometry']['coordinates']
+
+    return sum(
+        math.hypot(x2 - x1, y2 - y1)
+        for (x1, y1), (x2, y2) in zip(coordinates[:-1], coordinates[1:])
+    )
+
+
+def summarise_level(task):
+    """
+    Count the edges, and their total length (km), in one level of the
+    network for the parameters it depends on.
+
+    """
+    level, parameters = task
+    parameters = dict(parameters)
+
+    links = level_links(level, parameters)
+
+    return {
+        'edges': len(links),
+        'length_km': sum(link_length(link) for link in links) / 1e3,
+    }
+
+
+def level_key(level, configuration):
+    """
+    Return the key of a level's links for a configuration.
+
+    """
+    return (level, tuple(
+        (name, configuration[name]) for name in LEVEL_PARAMETERS[level]))
+
+
+def sweep(exchanges, islands, islands_lut, grid, workers=None):
+    """
+    Summarise the network for every combination of the parameters in
+    grid, a dict of parameter lists (using the defaults for any missing).
+
+    Returns a DataFrame with one row per configuration, giving the number
+    of nodes in each layer, and the edges and length of each level.
+
+    """
+    workers = workers or os.cpu_count() or 1
+
+    values = [grid.get(name, [DEFAULTS[name]]) for name in PARAMETERS]
+    configurations = [
+        dict(zip(PARAMETERS, combination))
+        for combination in itertools.product(*values)
+    ]
+
+    tasks = sorted(set(
+        level_key(level, configuration)
+        for configuration in configurations
+        for level in LEVEL_PARAMETERS
+    ))
+
+    print('Summarising {} levels for {} configurations'.format(
+        len(tasks), len(configurations)))
+
+    if workers == 1:
+        init_worker(exchanges, islands, islands_lut)
+        summaries = [summarise_level(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+            initargs=(exchanges, islands, islands_lut)) as executor:
+            summaries = list(executor.map(summarise_level, tasks))
+
+    summaries = dict(zip(tasks, summaries))
+
+    inner, outer, metro, lower, ranked = rank_exchanges(exchanges)
+
+    output = []
+
+    for configuration in configurations:
+
+        tier_1_ids = set(
+            e['properties']['OLO'] for e in ranked[:configuration['tier_1_count']])
+        tier_1_nodes = sum(
+            1 for e in lower if e['properties']['OLO'] in tier_1_ids)
+
+        row = dict(configuration)
+        row.update({
+            'inner_nodes': len(inner),
+            'outer_nodes': len(outer),
+            'metro_nodes': len(metro),
+            'tier_1_nodes': tier_1_nodes,
+            'msan_nodes': len(lower) - tier_1_nodes,
+        })
+
+        for level in LEVEL_PARAMETERS:
+            summary = summaries[level_key(level, configuration)]
+            row['{}_edges'.format(level)] = summary['edges']
+            row['{}_length_km'.format(level)] = summary['length_km']
+
+        row['total_edges'] = sum(
+            row['{}_edges'.format(level)] for level in LEVEL_PARAMETERS)
+        row['total_length_km'] = sum(
+            row['{}_length_km'.format(level)] for level in LEVEL_PARAMETERS)
+
+        output.append(row)
+
+    return pd.DataFrame(output)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Sweep the tier_1 count and nearest node fan-outs.')
+    parser.add_argument('--tier-1-counts', nargs='+', type=int,
+        default=[TIER_1_COUNT])
+    parser.add_argument('--core-links', nargs='+', type=int, default=[CORE_LINKS])
+    parser.add_argument('--metro-links', nargs='+', type=int, default=[METRO_LINKS])
+    parser.add_argument('--tier-1-links', nargs='+', type=int,
+        default=[TIER_1_LINKS])
+    parser.add_argument('--msan-links', nargs='+', type=int, default=[MSAN_LINKS])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default=os.path.join(
+        DATA_INTERMEDIATE, 'sweep', 'connect_sweep.parquet'))
+    parser.add_argument('--catchment-population', action='store_true',
+        help='rank exchanges by the population of their catchment, as with '
+        'core.py --catchment-population')
+    args = parser.parse_args()
+
+    population = None
+    if args.catchment_population:
+        for path in [POSTCODE_SECTOR_PATH, EXCHANGE_AREA_PATH]:
+            if not os.path.exists(path):
+                parser.error('--catchment-population needs {}'.format(path))
+        print('Loading catchment population')
+        population = catchment_population(POSTCODE_SECTOR_PATH, EXCHANGE_AREA_PATH)
+
+    print('Loading exchanges')
+    exchanges = read_existing_nodes(os.path.join(BASE_PATH, 'telecoms_nodes.shp'),
+        population=population)
+    lookup = read_lookup(os.path.join(BASE_PATH, 'core_bt_21cn.csv'))
+    exchanges = determine_nodes(exchanges, lookup)
+
+    islands_lut = import_islands(
+        os.path.join(DATA_INTERMEDIATE, 'islands', 'all_islands.csv'))
+    exchanges, islands, island_edges = process_islands(exchanges, islands_lut)
+
+    grid = {
+        'tier_1_count': args.tier_1_counts,
+        'core_links': args.core_links,
+        'metro_links': args.metro_links,
+        'tier_1_links': args.tier_1_links,
+        'msan_links': args.msan_links,
+    }
+
+    results = sweep(exchanges, islands, islands_lut, grid, args.workers)
+
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    results.to_parquet(args.output, index=False)
+
+    print(results[['tier_1_count', 'core_links', 'metro_links', 'tier_1_links',
+        'msan_links', 'tier_1_nodes', 'total_edges', 'total_length_km']])
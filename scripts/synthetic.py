@@ -0,0 +1,455 @@
+"""
+Synthetic UK-scale fixtures.
+
+Written by Ed Oughton
+
+Deterministic generators for the inputs of the preprocessing, core network
+and capacity scripts, for benchmarking and checking faster code paths
+without the licensed raw data. The same seed and scale always produce
+the same data.
+
+LADs are squares on a regular grid within the British National Grid
+extent, with densified boundaries, and postcode sectors tessellate each
+LAD as a jittered grid. Sites, exchanges and capacity curves are random
+but reproducible.
+
+"""
+import os
+import csv
+import math
+import random
+
+from shapely.geometry import Polygon, mapping
+
+#Approximate counts at each scale, where 'national' is close to the full
+#UK (Great Britain) extent of each dataset
+SCALES = {
+    '1x': {
+        'lads': 20,
+        'sectors_per_lad': 25,
+        'sites': 500,
+        'exchanges': 300,
+        'island_nodes': 20,
+        'densities': 1000,
+    },
+    '10x': {
+        'lads': 200,
+        'sectors_per_lad': 25,
+        'sites': 5000,
+        'exchanges': 3000,
+        'island_nodes': 60,
+        'densities': 10000,
+    },
+    'national': {
+        'lads': 380,
+        'sectors_per_lad': 25,
+        'sites': 50000,
+        'exchanges': 5600,
+        'island_nodes': 150,
+        'densities': 100000,
+    },
+}
+
+LAD_SIZE = 20000
+
+BOUNDARY_VERTICES = 100
+
+FREQUENCIES = [
+    ('700', '10', '5G'),
+    ('800', '10', '4G'),
+    ('1800', '10', '4G'),
+    ('2600', '10', '4G'),
+    ('3500', '40', '5G'),
+]
+
+
+def densify(start, end, vertices):
+    """
+    Return points along a straight edge, excluding the end point.
+
+    """
+    return [
+        (
+            start[0] + (end[0] - start[0]) * i / vertices,
+            start[1] + (end[1] - start[1]) * i / vertices,
+        )
+        for i in range(vertices)
+    ]
+
+
+def lad_grid(count):
+    """
+    Return the origin of each LAD square on a regular grid.
+
+    """
+    columns = int(math.ceil(math.sqrt(count)))
+
+    return [
+        ((i % columns) * LAD_SIZE, (i // columns) * LAD_SIZE)
+        for i in range(count)
+    ]
+
+
+def generate_lads(scale='1x', seed=42):
+    """
+    Generate LAD polygons, as returned by preprocess.read_lads.
+
+    """
+    output = []
+
+    for i, (x, y) in enumerate(lad_grid(SCALES[scale]['lads'])):
+
+        corners = [
+            (x, y), (x + LAD_SIZE, y),
+            (x + LAD_SIZE, y + LAD_SIZE), (x, y + LAD_SIZE),
+        ]
+
+        ring = []
+        for start, end in zip(corners, corners[1:] + corners[:1]):
+            ring.extend(densify(start, end, BOUNDARY_VERTICES))
+
+        output.append({
+            'type': 'Feature',
+            'geometry': mapping(Polygon(ring)),
+            'properties': {
+                'name': 'E0{}'.format(str(7000000 + i)),
+                'desc': 'Synthetic LAD {}'.format(i),
+            }
+        })
+
+    return output
+
+
+def generate_postcode_sectors(scale='1x', seed=42):
+    """
+    Generate postcode sector polygons, as returned by
+    preprocess.read_postcode_sectors.
+
+    Sectors tessellate each LAD as a grid with jittered interior vertices.
+    Ids follow real RMSect values, a district and a single digit sector
+    (e.g. 'S12 3'), so they stay unique once the space is stripped.
+
+    """
+    rng = random.Random(seed)
+
+    side = int(math.sqrt(SCALES[scale]['sectors_per_lad']))
+    step = LAD_SIZE / side
+    districts_per_lad = int(math.ceil(side * side / 10))
+
+    output = []
+
+    for i, (x, y) in enumerate(lad_grid(SCALES[scale]['lads'])):
+
+        vertices = {}
+        for a in range(side + 1):
+            for b in range(side + 1):
+                interior = 0 < a < side and 0 < b < side
+                jitter_x = rng.uniform(-0.3, 0.3) * step if interior else 0
+                jitter_y = rng.uniform(-0.3, 0.3) * step if interior else 0
+                vertices[(a, b)] = (x + a * step + jitter_x, y + b * step + jitter_y)
+
+        for a in range(side):
+            for b in range(side):
+                district, sector = divmod(a * side + b, 10)
+                output.append({
+                    'type': 'Feature',
+                    'geometry': mapping(Polygon([
+                        vertices[(a, b)], vertices[(a + 1, b)],
+                        vertices[(a + 1, b + 1)], vertices[(a, b + 1)],
+                    ])),
+                    'properties': {
+                        'RMSect': 'S{} {}'.format(
+                            i * districts_per_lad + district, sector),
+                    }
+                })
+
+    return output
+
+
+def generate_weights(postcode_sectors, seed=42):
+    """
+    Generate population weights, as returned by preprocess.load_in_weights.
+
+    """
+    rng = random.Random(seed)
+
+    return [
+        {
+            'id': sector['properties']['RMSect'],
+            'population': int(rng.lognormvariate(7, 1)),
+        }
+        for sector in postcode_sectors
+    ]
+
+
+def generate_sectors_with_population(scale='1x', seed=42):
+    """
+    Generate postcode sectors with LAD, population and density, as
+    returned by preprocess.calculate_lad_population.
+
+    """
+    rng = random.Random(seed)
+
+    sectors = generate_postcode_sectors(scale, seed)
+    side = int(math.sqrt(SCALES[scale]['sectors_per_lad']))
+    lads = generate_lads(scale, seed)
+
+    output = []
+
+    for i, sector in enumerate(sectors):
+        lad = lads[i // (side * side)]
+        area_km2 = Polygon(sector['geometry']['coordinates'][0]).area / 1e6
+        population = float(int(rng.lognormvariate(8, 1)))
+        output.append({
+            'type': 'Feature',
+            'geometry': sector['geometry'],
+            'properties': {
+                'id': sector['properties']['RMSect'].replace(' ', ''),
+                'lad': lad['properties']['name'],
+                'population': population,
+                'weight': rng.random(),
+                'area_km2': area_km2,
+                'pop_density_km2': population / area_km2,
+            }
+        })
+
+    return output
+
+
+def generate_sitefinder(scale='1x', seed=42):
+    """
+    Generate sitefinder sites, as returned by
+    preprocess.import_sitefinder_data.
+
+    Around a third of sites are placed within 100m of the previous site,
+    so that buffering and dissolving finds co-located assets.
+
+    """
+    rng = random.Random(seed)
+
+    lads = lad_grid(SCALES[scale]['lads'])
+
+    output = []
+
+    for i in range(SCALES[scale]['sites']):
+
+        if i > 0 and rng.random() < 0.3:
+            x = x + rng.uniform(-60, 60)
+            y = y + rng.uniform(-60, 60)
+        else:
+            origin_x, origin_y = lads[rng.randrange(len(lads))]
+            x = origin_x + rng.uniform(0, LAD_SIZE)
+            y = origin_y + rng.uniform(0, LAD_SIZE)
+
+        output.append({
+            'type': "Feature",
+            'geometry': {
+                "type": "Point",
+                "coordinates": [x, y]
+            },
+            'properties': {
+                'name': 'site_' + str(i),
+                'Operator': rng.choice(['O2', 'Vodafone']),
+                'Opref': 'OP{}'.format(i),
+                'Sitengr': 'NGR{}'.format(i),
+                'Antennaht': '15',
+                'Transtype': 'Macro',
+                'Freqband': rng.choice(['800', '1800', '2600']),
+                'Anttype': 'MACRO',
+                'Powerdbw': '30',
+                'Maxpwrdbw': '32',
+                'Maxpwrdbm': '62',
+                'Sitelat': 50.0 + y / 111000,
+                'Sitelng': -6.0 + x / 70000,
+            }
+        })
+
+    return output
+
+
+def generate_coverage_data(lads, seed=42):
+    """
+    Generate Ofcom Connected Nations coverage rows for each LAD.
+
+    """
+    rng = random.Random(seed)
+
+    output = []
+
+    for lad in lads:
+        row = {
+            'laua': lad['properties']['name'],
+            'laua_name': lad['properties']['desc'],
+        }
+        for generation in ['2G', '3G', '4G']:
+            values = sorted([round(rng.uniform(0, 100), 2) for i in range(5)])
+            for operators, value in enumerate(reversed(values)):
+                row['{}_geo_out_{}'.format(generation, operators)] = value
+        output.append(row)
+
+    return output
+
+
+def write_coverage_data(lads, directory, seed=42):
+    """
+    Write Ofcom coverage rows where preprocess.load_coverage_data expects
+    to find them, relative to a raw data directory.
+
+    """
+    rows = generate_coverage_data(lads, seed)
+
+    folder = os.path.join(directory, 'ofcom_2018')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    with open(os.path.join(folder, '201809_mobile_laua_r02.csv'), 'w') as sink:
+        writer = csv.DictWriter(sink, list(rows[0].keys()), lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def generate_exchanges(scale='1x', seed=42):
+    """
+    Generate exchanges, as returned by preprocess.read_exchanges.
+
+    """
+    rng = random.Random(seed)
+
+    lads = lad_grid(SCALES[scale]['lads'])
+
+    output = []
+
+    for i in range(SCALES[scale]['exchanges']):
+        origin_x, origin_y = lads[rng.randrange(len(lads))]
+        output.append({
+            'type': "Feature",
+            'geometry': {
+                "type": "Point",
+                "coordinates": [
+                    origin_x + rng.uniform(0, LAD_SIZE),
+                    origin_y + rng.uniform(0, LAD_SIZE),
+                ]
+            },
+            'properties': {
+                'exchange_id': 'exchange_EX{}'.format(i),
+                'exchange_name': 'Exchange {}'.format(i),
+                'id': 'P{}'.format(i),
+            }
+        })
+
+    return output
+
+
+def generate_core_nodes(scale='1x', seed=42):
+    """
+    Generate exchanges with core network roles, as returned by
+    core.determine_nodes.
+
+    Around 1% of exchanges are inner core and metro nodes, 2% are outer
+    core nodes and 3% are metro nodes only.
+
+    """
+    rng = random.Random(seed)
+
+    output = []
+
+    for i, exchange in enumerate(generate_exchanges(scale, seed)):
+
+        draw = rng.random()
+        inner = 1 if draw < 0.01 else 0
+        outer = 1 if 0.01 <= draw < 0.03 else 0
+        metro = 1 if draw < 0.01 or 0.03 <= draw < 0.06 else 0
+        lower = 1 if metro or not (inner or outer) else 0
+
+        output.append({
+            'type': 'Feature',
+            'geometry': exchange['geometry'],
+            'properties': {
+                'OLO': 'EX{}'.format(i),
+                'population': int(rng.lognormvariate(8, 1.5)),
+                'inner': inner,
+                'outer': outer,
+                'metro': metro,
+                'tier_1': 0,
+                'msan': 0,
+                'lower': lower,
+            }
+        })
+
+    return output
+
+
+def generate_island_nodes(scale='1x', seed=42):
+    """
+    Generate a set of nodes, as passed to core.design_network.
+
+    """
+    rng = random.Random(seed)
+
+    return [
+        {
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [rng.uniform(0, 50000), rng.uniform(0, 50000)],
+            },
+            'properties': {
+                'OLO': 'ISL{}'.format(i),
+            }
+        }
+        for i in range(SCALES[scale]['island_nodes'])
+    ]
+
+
+def generate_islands_lut(exchanges, scale='1x', seed=42):
+    """
+    Assign a sample of exchanges to islands, as read by
+    core.import_islands, using island names known to core.process_islands.
+
+    """
+    rng = random.Random(seed)
+
+    count = min(SCALES[scale]['island_nodes'], len(exchanges))
+    sampled = rng.sample(exchanges, count)
+
+    return [
+        {
+            'OLO': exchange['properties']['OLO'],
+            'island': ['skye', 'orkney', 'shetland'][i % 3],
+        }
+        for i, exchange in enumerate(sampled)
+    ]
+
+
+def generate_capacity_lookup_table(points=50, seed=42):
+    """
+    Generate a capacity lookup table, as returned by
+    capacity.load_capacity_lookup_table, with monotone curves.
+
+    """
+    rng = random.Random(seed)
+
+    output = {}
+
+    for environment in ['urban', 'suburban', 'rural']:
+        for frequency, bandwidth, generation in FREQUENCIES:
+            density = 0
+            capacity = 0
+            curve = []
+            for i in range(points):
+                density += rng.uniform(0.01, 0.2)
+                capacity += rng.uniform(1, 50)
+                curve.append((density, capacity))
+            output[(environment, 'macro', frequency, bandwidth, generation)] = curve
+
+    return output
+
+
+def generate_site_densities(scale='1x', seed=42):
+    """
+    Generate site densities (sites per km^2) for capacity lookups.
+
+    """
+    rng = random.Random(seed)
+
+    return [rng.uniform(0, 12) for i in range(SCALES[scale]['densities'])]
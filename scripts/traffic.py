@@ -0,0 +1,256 @@
+"""
+Busy hour traffic loading of the fixed network hierarchy.
+
+Written by Ed Oughton
+
+core.py connects each MSAN to its three nearest tier_1 nodes, each tier_1
+node to its three nearest metro nodes, and each metro node to its three
+nearest core nodes, but does not estimate the traffic each link carries.
+
+These functions push the demand of each exchange up this hierarchy. Each
+node is given a rank (MSAN 0, tier_1 1, metro 2, core 3) from the edges
+it is part of, and its traffic (its own demand plus everything below it)
+is split over its uplinks to higher ranked nodes, using configurable
+shares for the nearest, second nearest and third nearest uplink. As every
+uplink goes to a higher rank, one pass over the ranks in order loads the
+whole tree.
+
+Edges between nodes of the same rank (such as the core mesh, the
+spanning tree within each island, or between exchanges which are both
+metro and tier_1 nodes) are peer links. They carry the traffic of their
+source node, split equally, but do not pass it on.
+
+Demand is held as an array with one column per scenario, so many
+scenarios are loaded at once.
+
+"""
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from scripts.demand import calculate_user_demand, total_demand
+from scripts.geoparquet import read_features
+from scripts.preprocess import read_shapefile
+from scripts.config import BASE_PATH
+
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+
+#The rank of the source of each level of edge in core.connect and
+#core.process_islands, where the sink of an uplink is one rank higher
+LEVEL_RANKS = {
+    'msan': 0,
+    'island': 0,
+    'island_tree': 0,
+    'tier_1': 1,
+    'metro': 2,
+    'core': 3,
+}
+
+#The levels of edge whose sink has the same rank as their source
+PEER_LEVELS = ['island_tree', 'core']
+
+#The low, baseline and high demand scenarios
+SCENARIOS = [
+    {
+        'scenario': scenario,
+        'monthly_data_consumption_GB': monthly_data,
+        'busy_hour_traffic_percentage': 20,
+        'penetration_percentage': 80,
+        'market_share_percentage': 25,
+    }
+    for scenario, monthly_data in [('low', 3), ('baseline', 5), ('high', 10)]
+]
+
+#The share of traffic on the nearest, second and third nearest uplink
+UPLINK_SHARES = {
+    'msan': [1/3, 1/3, 1/3],
+    'island': [1],
+    'tier_1': [1/3, 1/3, 1/3],
+    'metro': [1/3, 1/3, 1/3],
+}
+
+
+def node_ranks(edges):
+    """
+    Return the position of each node by id, and the rank of each node,
+    as the highest rank implied by the edges it is the source or sink of.
+
+    """
+    unknown = set(edge['properties']['level'] for edge in edges) - set(LEVEL_RANKS)
+    if unknown:
+        raise ValueError('Edges have levels with no rank: {}'.format(
+            ', '.join(sorted(str(level) for level in unknown))))
+
+    nodes = {}
+    ranks = []
+
+    for edge in edges:
+
+        level = edge['properties']['level']
+        source_rank = LEVEL_RANKS[level]
+        sink_rank = source_rank if level in PEER_LEVELS else source_rank + 1
+
+        for node, rank in [
+            (edge['properties']['source'], source_rank),
+            (edge['properties']['sink'], sink_rank)]:
+            if node not in nodes:
+                nodes[node] = len(ranks)
+                ranks.append(rank)
+            else:
+                ranks[nodes[node]] = max(ranks[nodes[node]], rank)
+
+    return nodes, np.array(ranks, dtype=int)
+
+
+def uplink_weights(edges, sources, sinks, ranks, uplink_shares=UPLINK_SHARES):
+    """
+    Return the share of its source's traffic carried by each edge which is
+    an uplink (with a higher ranked sink), or zero for other edges.
+
+    Uplinks are given shares in the order they appear for each source (as
+    core.connect adds them nearest first), normalised to sum to one over
+    all the source's uplinks.
+
+    """
+    weights = np.zeros(len(edges))
+    position = {}
+
+    for e, edge in enumerate(edges):
+        if ranks[sinks[e]] <= ranks[sources[e]]:
+            continue
+        level = edge['properties']['level']
+        k = position.get((sources[e], level), 0)
+        position[(sources[e], level)] = k + 1
+        shares = uplink_shares[level]
+        weights[e] = shares[k] if k < len(shares) else 0
+
+    totals = np.zeros(len(ranks))
+    np.add.at(totals, sources, weights)
+
+    uplinks = weights > 0
+    weights[uplinks] = weights[uplinks] / totals[sources[uplinks]]
+
+    return weights
+
+
+def scenario_demand(populations, scenarios):
+    """
+    Return the busy hour demand (Mbps) of each node in each scenario, as
+    an array of shape (nodes, scenarios), from demand.total_demand.
+
+    """
+    per_person = np.array([
+        total_demand(calculate_user_demand(scenario), 1, 1, scenario)
+        for scenario in scenarios
+    ])
+
+    return np.outer(np.asarray(populations, dtype=float), per_person)
+
+
+def load_edges(edges, demand, nodes, ranks, uplink_shares=UPLINK_SHARES):
+    """
+    Load each edge with the busy hour traffic of the nodes below it.
+
+    demand is an array of shape (nodes, scenarios), in the node order
+    given by node_ranks. Returns the load on each edge, with shape
+    (edges, scenarios), and the total traffic through each node.
+
+    """
+    sources = np.array(
+        [nodes[edge['properties']['source']] for edge in edges], dtype=int)
+    sinks = np.array(
+        [nodes[edge['properties']['sink']] for edge in edges], dtype=int)
+
+    weights = uplink_weights(edges, sources, sinks, ranks, uplink_shares)
+    uplink = weights > 0
+
+    traffic = np.array(demand, dtype=float)
+    loads = np.zeros((len(edges), traffic.shape[1]))
+
+    for rank in range(ranks.max() + 1 if len(ranks) > 0 else 0):
+        selected = np.where(uplink & (ranks[sources] == rank))[0]
+        loads[selected] = traffic[sources[selected]] * weights[selected, None]
+        np.add.at(traffic, sinks[selected], loads[selected])
+
+    peer = ~uplink & (sources != sinks) & (ranks[sinks] <= ranks[sources])
+    peer_counts = np.bincount(sources[peer], minlength=len(ranks))
+    selected = np.where(peer)[0]
+    loads[selected] = (traffic[sources[selected]] /
+        peer_counts[sources[selected], None])
+
+    return loads, traffic
+
+
+def edge_loads(edges, node_populations, scenarios, uplink_shares=UPLINK_SHARES):
+    """
+    Estimate the busy hour load (Mbps) on every edge in every scenario,
+    from the population of each node (by id).
+
+    Returns a DataFrame with one row per edge and scenario.
+
+    """
+    nodes, ranks = node_ranks(edges)
+
+    populations = np.zeros(len(nodes))
+    for node, position in nodes.items():
+        populations[position] = node_populations.get(node, 0)
+
+    demand = scenario_demand(populations, scenarios)
+    loads, traffic = load_edges(edges, demand, nodes, ranks, uplink_shares)
+
+    frame = pd.DataFrame({
+        'edge': np.repeat(np.arange(len(edges)), len(scenarios)),
+        'source': np.repeat([e['properties']['source'] for e in edges], len(scenarios)),
+        'sink': np.repeat([e['properties']['sink'] for e in edges], len(scenarios)),
+        'level': np.repeat([e['properties']['level'] for e in edges], len(scenarios)),
+        'scenario': np.tile([s['scenario'] for s in scenarios], len(edges)),
+        'load_mbps': loads.ravel(),
+    })
+
+    return frame
+
+
+def read_network(directory, name, properties, input_format):
+    """
+    Read nodes or edges written by core.py, from shapefile or GeoParquet.
+
+    """
+    if input_format == 'geoparquet':
+        return read_features(
+            os.path.join(directory, '{}.parquet'.format(name)),
+            columns=properties)
+
+    return read_shapefile(os.path.join(directory, '{}.shp'.format(name)),
+        properties=properties)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Load the fixed network with busy hour traffic.')
+    parser.add_argument('--input-format', choices=['shapefile', 'geoparquet'],
+        default='shapefile',
+        help='read nodes and edges from shapefile, or GeoParquet, as '
+        'written by core.py --output-format')
+    args = parser.parse_args()
+
+    print('Loading nodes')
+    nodes = read_network(DATA_INTERMEDIATE, 'nodes', ['OLO', 'population'],
+        args.input_format)
+    node_populations = {
+        node['properties']['OLO']: node['properties']['population'] or 0
+        for node in nodes
+    }
+
+    print('Loading edges')
+    edges = read_network(DATA_INTERMEDIATE, 'edges',
+        ['source', 'sink', 'level'], args.input_format)
+
+    print('Loading edges with busy hour traffic')
+    loads = edge_loads(edges, node_populations, SCENARIOS)
+
+    print('Writing edge loads')
+    loads.to_parquet(
+        os.path.join(DATA_INTERMEDIATE, 'edge_loads.parquet'), index=False)
@@ -0,0 +1,289 @@
+"""
+Infrastructure upgrade optimisation.
+
+Written by Ed Oughton
+
+This method takes the capacity margins estimated in evaluate.py and finds
+the cheapest way to close any capacity shortfall in each postcode sector,
+either by building new sites, by deploying additional spectrum bands on
+the existing sites, or both.
+
+The density to capacity curves in the lookup table are monotone, so the
+site density required to meet demand can be found by inverting the
+(summed) curve for the deployed bands. This is carried out as a binary
+search over all sectors at once, rather than by trying one additional
+site at a time. Years are processed in order, so that sites and spectrum
+added in one year are available in all later years.
+
+"""
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from scripts.capacity import (load_capacity_lookup_table,
+    find_frequency_bandwidth, find_generation, lookup_capacity_array)
+from scripts.config import BASE_PATH
+
+DATA_RAW = os.path.join(BASE_PATH, 'raw')
+DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
+DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
+
+
+def build_capacity_curve(capacity_lookup_table, environment, frequencies,
+    simulation_parameters):
+    """
+    Sum the density to capacity curves of the deployed frequency bands
+    into a single piecewise linear curve.
+
+    Returns arrays of site densities and capacities, starting at zero
+    density. A point is added immediately below the lowest density of
+    each band, so the step from zero capacity is kept when inverting.
+
+    """
+    keys = []
+    densities = set([0.0])
+
+    for frequency in frequencies:
+        bandwidth = str(find_frequency_bandwidth(frequency, simulation_parameters))
+        generation = find_generation(frequency)
+        key = (environment, 'macro', str(frequency), bandwidth, generation)
+
+        if key not in capacity_lookup_table:
+            raise KeyError("Combination %s not found in lookup table", key)
+
+        keys.append(key)
+
+        density_capacities = capacity_lookup_table[key]
+        lowest_density = density_capacities[0][0]
+        if lowest_density > 0:
+            densities.add(float(np.nextafter(lowest_density, 0)))
+        for density, capacity in density_capacities:
+            densities.add(float(density))
+
+    densities = np.array(sorted(densities))
+    capacities = np.zeros(len(densities))
+
+    for key in keys:
+        capacities += lookup_capacity_array(
+            capacity_lookup_table, *key, densities)
+
+    #the lookup table curves are monotone, but guard against noise
+    capacities = np.maximum.accumulate(capacities)
+
+    return densities, capacities
+
+
+def invert_capacity_curve(densities, capacities, demand):
+    """
+    Find the minimum site density providing the demanded capacity, by
+    inverse interpolation on a monotone capacity curve.
+
+    The curve segment is located for every demand value at once using a
+    binary search. Demand which exceeds the highest capacity on the
+    curve cannot be met, and is returned as NaN.
+
+    """
+    demand = np.asarray(demand, dtype=float)
+
+    upper = np.searchsorted(capacities, demand, side='left')
+    feasible = upper < len(capacities)
+
+    upper = np.clip(upper, 1, len(capacities) - 1)
+    lower = upper - 1
+
+    x0, x1 = densities[lower], densities[upper]
+    y0, y1 = capacities[lower], capacities[upper]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(y1 > y0, (demand - y0) / (y1 - y0), 1.0)
+
+    density = x0 + np.clip(fraction, 0, 1) * (x1 - x0)
+    density = np.where(demand <= capacities[0], densities[0], density)
+
+    return np.where(feasible, density, np.nan)
+
+
+def required_sites(densities, capacities, demand, area):
+    """
+    Find the minimum number of sites needed to meet demand in each area,
+    returning NaN where demand cannot be met.
+
+    """
+    density = invert_capacity_curve(densities, capacities, demand)
+
+    with np.errstate(invalid='ignore'):
+        sites = np.ceil(density * area - 1e-9)
+
+        #guard against rounding placing the site count just below the target
+        capacity = np.interp(sites / area, densities, capacities)
+        sites = np.where(capacity < demand, sites + 1, sites)
+
+    return sites
+
+
+def optimise_upgrades(margins, capacity_lookup_table, scenarios):
+    """
+    Find the cheapest upgrade closing the capacity shortfall in each
+    postcode sector, for each scenario and year.
+
+    Each scenario dict (as used in evaluate.py) also needs an ordered
+    list of 'upgrade_frequencies' which can be added to existing sites,
+    the 'site_cost' of a new site and the 'spectrum_cost' of deploying
+    a new band on one site.
+
+    """
+    parameters = {(s['scenario'], s['year']): s for s in scenarios}
+
+    output = []
+
+    for scenario, scenario_margins in margins.groupby('scenario', sort=False):
+
+        years = sorted(scenario_margins['year'].unique())
+
+        first_year = scenario_margins[scenario_margins['year'] == years[0]]
+        sector_ids = first_year['id'].to_numpy()
+        lads = first_year['lad'].to_numpy()
+
+        #sectors split between LADs share an id, so rows are matched on both
+        sectors = pd.MultiIndex.from_arrays([sector_ids, lads])
+        area = first_year['area_km2'].to_numpy(dtype=float)
+
+        total_sites = first_year['sites'].to_numpy(dtype=float)
+        deployed = np.zeros(len(sector_ids), dtype=int)
+
+        for year in years:
+
+            simulation_parameters = parameters[(scenario, year)]
+            upgrade_frequencies = list(
+                simulation_parameters.get('upgrade_frequencies', []))
+
+            year_margins = scenario_margins[
+                scenario_margins['year'] == year].set_index(['id', 'lad'])
+            demand = year_margins['demand_mbps_km2'].reindex(
+                sectors).to_numpy(dtype=float)
+
+            environment = year_margins['environment'].reindex(
+                sectors).to_numpy()
+
+            options = len(upgrade_frequencies) + 1
+
+            curves = {}
+            for geotype in np.unique(environment):
+                for k in range(options):
+                    curves[(geotype, k)] = build_capacity_curve(
+                        capacity_lookup_table,
+                        geotype,
+                        list(simulation_parameters['frequencies']) +
+                            upgrade_frequencies[:k],
+                        simulation_parameters,
+                    )
+
+            current_capacity = np.zeros(len(sector_ids))
+            sites = np.full((len(sector_ids), options), np.nan)
+
+            for geotype in np.unique(environment):
+                in_geotype = environment == geotype
+
+                for k in np.unique(deployed[in_geotype]):
+                    mask = in_geotype & (deployed == k)
+                    densities, capacities = curves[(geotype, k)]
+                    current_capacity[mask] = np.interp(
+                        total_sites[mask] / area[mask], densities, capacities)
+
+                for k in range(options):
+                    mask = in_geotype & (deployed <= k)
+                    if not mask.any():
+                        continue
+                    densities, capacities = curves[(geotype, k)]
+                    sites[mask, k] = np.maximum(
+                        required_sites(densities, capacities,
+                            demand[mask], area[mask]),
+                        total_sites[mask],
+                    )
+
+            new_sites = sites - total_sites[:, None]
+            new_bands = np.arange(options)[None, :] - deployed[:, None]
+
+            cost = (
+                new_sites * simulation_parameters['site_cost'] +
+                new_bands * sites * simulation_parameters['spectrum_cost']
+            )
+            cost = np.where(np.isnan(cost), np.inf, cost)
+
+            choice = np.argmin(cost, axis=1)
+            rows = np.arange(len(sector_ids))
+            feasible = np.isfinite(cost[rows, choice])
+
+            choice = np.where(feasible, choice, deployed)
+            chosen_sites = np.where(feasible, sites[rows, choice], total_sites)
+
+            output.append(pd.DataFrame({
+                'scenario': scenario,
+                'year': year,
+                'lad': lads,
+                'id': sector_ids,
+                'demand_mbps_km2': demand,
+                'capacity_mbps_km2': current_capacity,
+                'shortfall_mbps_km2': np.maximum(demand - current_capacity, 0),
+                'new_sites': (chosen_sites - total_sites).astype(int),
+                'new_frequencies': [
+                    ';'.join(upgrade_frequencies[start:end])
+                    for start, end in zip(deployed, choice)
+                ],
+                'total_sites': chosen_sites.astype(int),
+                'required_site_density_km2': chosen_sites / area,
+                'cost': np.where(feasible, cost[rows, choice], np.nan),
+                'feasible': feasible,
+            }))
+
+            total_sites = chosen_sites
+            deployed = choice
+
+    return pd.concat(output, ignore_index=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Plan capacity upgrades.')
+    parser.add_argument('--capacity-lookup-table', default=os.path.join(
+        DATA_RAW, 'capacity_lut_by_frequency_10.csv'))
+    args = parser.parse_args()
+
+    SCENARIOS = []
+    for year in range(2020, 2031):
+        for scenario, monthly_data in [('low', 3), ('baseline', 5), ('high', 10)]:
+            SCENARIOS.append({
+                'scenario': scenario,
+                'year': year,
+                'monthly_data_consumption_GB': monthly_data,
+                'busy_hour_traffic_percentage': 20,
+                'penetration_percentage': 80,
+                'market_share_percentage': 25,
+                'frequencies': ['800', '1800', '2600'],
+                'upgrade_frequencies': ['700', '3500'],
+                'channel_bandwidth_700': '10',
+                'channel_bandwidth_800': '10',
+                'channel_bandwidth_1800': '10',
+                'channel_bandwidth_2600': '10',
+                'channel_bandwidth_3500': '40',
+                'site_cost': 150000,
+                'spectrum_cost': 50000,
+            })
+
+    print('Loading capacity margins')
+    margins = pd.read_parquet(
+        os.path.join(DATA_PROCESSED, 'capacity_margins.parquet'))
+
+    print('Loading capacity lookup table')
+    capacity_lookup_table = load_capacity_lookup_table(
+        args.capacity_lookup_table)
+
+    print('Optimising infrastructure upgrades')
+    schedule = optimise_upgrades(margins, capacity_lookup_table, SCENARIOS)
+
+    print('Writing upgrade schedule')
+    schedule.to_parquet(
+        os.path.join(DATA_PROCESSED, 'upgrade_schedule.parquet'), index=False)
@@ -0,0 +1,19 @@
+"""
+Install the scripts with the uk-digital-networks command.
+
+"""
+from setuptools import setup
+
+setup(
+    name='uk-digital-networks',
+    version='0.1.0',
+    description='Digital network models for the UK',
+    license='MIT',
+    packages=['scripts'],
+    package_data={'scripts': ['script_config.ini']},
+    entry_points={
+        'console_scripts': [
+            'uk-digital-networks = scripts.cli:main',
+        ],
+    },
+)